@@ -0,0 +1,79 @@
+"""Microbenchmark of client CPU per lock operation
+
+Runs against redis-server on localhost, client CPU time is measured by
+process_time, so redis-server time is not included.
+
+Usage: python3 bench/bench_lock.py [port [count]]
+"""
+from redisrwlock import Rwlock, RwlockClient
+from redis import StrictRedis
+
+import sys
+import time
+
+
+def measure(title, count, func):
+    cpu, wall = time.process_time(), time.perf_counter()
+    for i in range(count):
+        func(i)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    print('%-24s %8.1f us cpu %8.1f us wall' % (
+        title, cpu * 1e6 / count, wall * 1e6 / count))
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6379
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    redis = StrictRedis(port=port)
+    client = RwlockClient(redis)
+    client._clear_all()
+
+    def lock_unlock(i):
+        client.unlock(client.lock('bench', Rwlock.READ))
+    measure('lock+unlock', count, lock_unlock)
+
+    # Grant kept after unlock, taken back locally
+    sticky = RwlockClient(StrictRedis(port=port), pid='sticky', linger=60)
+
+    def lock_unlock_sticky(i):
+        sticky.unlock(sticky.lock('bench-sticky', Rwlock.READ))
+    measure('lock+unlock (linger)', count, lock_unlock_sticky)
+    sticky.close()
+
+    # Unlock alone, then pipelined by background thread
+    deferred = RwlockClient(StrictRedis(port=port), pid='deferred',
+                            defer_unlock=1000)
+    for title, unlocker in (('unlock', client),
+                            ('unlock (deferred)', deferred)):
+        rwlocks = [unlocker.lock('bench-unlock-' + str(i), Rwlock.WRITE)
+                   for i in range(count)]
+
+        def unlock(i):
+            unlocker.unlock(rwlocks[i])
+        measure(title, count, unlock)
+        unlocker.flush()
+    deferred.close()
+
+    # Deadlock check against many readers, each waiting for other
+    readers = [RwlockClient(StrictRedis(port=port), pid=str(i))
+               for i in range(1, 51)]
+    for reader in readers:
+        reader.lock('bench', Rwlock.READ)
+        redis.sadd('wait:' + reader.get_owner(), '__dummy_seed_waitee__')
+
+    def deadlock(i):
+        client._deadlock(['bench'], Rwlock.WRITE)
+    measure('deadlock check (50)', count // 10, deadlock)
+    client.backend.clear_wait(client.get_owner())
+
+    # Gc of stale owners, disconnected
+    for reader in readers:
+        for i in range(20):
+            reader.lock('bench-' + str(i), Rwlock.READ)
+        reader.redis.connection_pool.disconnect()
+    measure('gc (1050 locks)', 1, lambda i: client.backend.gc())
+    client._clear_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,11 @@
 import logging
-from .redisrwlock import _cmp_time, Rwlock, RwlockClient
+from .redisrwlock import _cmp_time, Fence, Rwlock, RwlockClient
+from .redisrwlock import Backend, RedisBackend
+from .compact import CompactRedisBackend
+from .local import LocalBackend
+from .agent import RwlockAgent, RwlockAgentClient
+from .gcdaemon import RwlockGcDaemon
+from .trace import Tracer
 
 __version__ = '0.1.3'
 
@@ -12,4 +18,6 @@ except ImportError:  # pragma: no cover
             pass
 
 logging.getLogger(__name__).addHandler(NullHandler())
-__all__ = [_cmp_time, Rwlock, RwlockClient]
+__all__ = [_cmp_time, Fence, Rwlock, RwlockClient, Backend, RedisBackend,
+           CompactRedisBackend, LocalBackend, RwlockAgent, RwlockAgentClient,
+           RwlockGcDaemon, Tracer]
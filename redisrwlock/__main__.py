@@ -1,4 +1,8 @@
-from .redisrwlock import RwlockClient
+from .redisrwlock import RedisBackend
+from .agent import DEFAULT_SOCKET, RwlockAgent
+from .compact import CompactRedisBackend, migrate
+from .gcdaemon import RwlockGcDaemon, parse_target, read_targets
+from . import trace
 from . import __version__
 from redis import StrictRedis
 import getopt
@@ -6,7 +10,6 @@ import logging
 import logging.config
 import os
 import sys
-import time
 
 
 def logging_config():
@@ -47,10 +50,19 @@ def logging_config():
 
 
 def usage():
-    print("Usage: %s -m %s [option] ..." %
+    print("Usage: %s -m %s [agent|compact|replay] [option] ... [trace]" %
           (os.path.basename(sys.executable), __package__))
     print("")
     print("""\
+Without command, runs gc of redis-server given by --server and --port,
+or of every target given by --target or --config concurrently, each
+repeated at interval shortened while stale locks found.  With 'agent'
+command, runs node-local agent serving locks for local processes
+(Control-C to quit).  With 'compact' command, moves locks to compact
+layout and reports bytes per grant (stop clients using default layout
+first).  With 'replay' command, simulates locks of trace file written
+by Tracer and reports latency recorded and simulated.
+
 Options:
   -h, --help      print this help message and exit
   -V, --version   print version and exit
@@ -59,7 +71,18 @@ Options:
   -i, --interval  interval of the periodic gc in seconds (default 5)
   -s, --server    redis-server host to connect (default localhost)
   -p, --port      redis-server port to connect (default 6379)
-""")
+  -t, --target    host[:port][/db][@replica_host[:replica_port]] to gc,
+                  may be given many times, scans read replica if given
+  --replica       replica_host[:replica_port] of --server to scan
+  -c, --config    file listing targets to gc, one per line
+  -u, --socket    unix socket path of agent
+                  (default %s)
+  --timeout       replay with lock timeout in seconds (default traced)
+  --retry-interval
+                  replay with retry interval in seconds (default traced)
+  --name-depth    replay with resource names cut to first N parts
+                  separated by ':' (default whole names)
+""" % DEFAULT_SOCKET)
 
 
 def version():
@@ -74,12 +97,24 @@ def main():
     opt_interval = 5
     opt_server = "localhost"
     opt_port = 6379
+    opt_socket = DEFAULT_SOCKET
+    opt_targets = list()
+    opt_replica = None
+    opt_timeout = None
+    opt_retry_interval = None
+    opt_name_depth = None
+    argv = sys.argv[1:]
+    command = argv[0] if argv[:1] in (['agent'], ['compact'], ['replay']) \
+        else None
+    if command:
+        argv = argv[1:]
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:],
-            "hVri:s:p:",
+            argv,
+            "hVri:s:p:u:t:c:",
             ["help", "version", "repeat", "interval=", "server=", "port=",
-             "__unhandled__"])
+             "socket=", "target=", "config=", "replica=", "timeout=",
+             "retry-interval=", "name-depth=", "__unhandled__"])
     except getopt.GetoptError as err:
         print("ERROR:", err)
         sys.exit(os.EX_USAGE)
@@ -113,19 +148,115 @@ def main():
             except:
                 print("ERROR: specify port as number in [0, 65535]")
                 sys.exit(os.EX_USAGE)
+        elif opt in ("-u", "--socket"):
+            opt_socket = opt_arg
+            if len(opt_socket) == 0:
+                print("ERROR: specify path of unix socket for agent")
+                sys.exit(os.EX_USAGE)
+        elif opt in ("-t", "--target"):
+            try:
+                opt_targets.append(parse_target(opt_arg))
+            except ValueError:
+                print("ERROR: specify target as "
+                      "host[:port][/db][@replica_host[:replica_port]]")
+                sys.exit(os.EX_USAGE)
+        elif opt == "--replica":
+            try:
+                opt_replica = parse_target(opt_arg)
+                if opt_replica[2:] != (0, None):
+                    raise ValueError
+            except ValueError:
+                print("ERROR: specify replica as host[:port]")
+                sys.exit(os.EX_USAGE)
+        elif opt in ("-c", "--config"):
+            try:
+                opt_targets.extend(read_targets(opt_arg))
+            except (OSError, ValueError) as err:
+                print("ERROR: config:", err)
+                sys.exit(os.EX_USAGE)
+        elif opt == "--timeout":
+            try:
+                opt_timeout = float(opt_arg)
+                if opt_timeout < 0 and opt_timeout != -1:
+                    raise ValueError
+            except:
+                print("ERROR: specify timeout as seconds, -1 for forever")
+                sys.exit(os.EX_USAGE)
+        elif opt == "--retry-interval":
+            try:
+                opt_retry_interval = float(opt_arg)
+                if opt_retry_interval <= 0:
+                    raise ValueError
+            except:
+                print("ERROR: specify retry interval as positive seconds")
+                sys.exit(os.EX_USAGE)
+        elif opt == "--name-depth":
+            try:
+                opt_name_depth = int(opt_arg)
+                if opt_name_depth <= 0:
+                    raise ValueError
+            except:
+                print("ERROR: specify name depth as positive number")
+                sys.exit(os.EX_USAGE)
         else:
             print("ERROR: unhandled option")
             sys.exit(os.EX_USAGE)
+    if opt_replica is not None and opt_targets:
+        print("ERROR: give replica of target after '@', not --replica")
+        sys.exit(os.EX_USAGE)
+    if command == 'replay':
+        if len(args) != 1:
+            print("ERROR: specify one trace file to replay")
+            sys.exit(os.EX_USAGE)
+        events = trace.load(args[0])
+        rename = None
+        if opt_name_depth is not None:
+            def rename(name):
+                return ':'.join(name.split(':')[:opt_name_depth])
+        simulated = trace.replay(events, opt_timeout, opt_retry_interval,
+                                 rename)
+        for title, results in (('recorded', trace.recorded(events)),
+                               ('simulated', simulated)):
+            stats = trace.summary(results)
+            print("%s: %d lock(s), %d attempt(s), wait mean %.6f "
+                  "p50 %.6f p99 %.6f max %.6f, %s" % (
+                      title, stats['count'], stats['attempts'],
+                      stats['mean'], stats['p50'], stats['p99'],
+                      stats['max'],
+                      ' '.join('%s %d' % item
+                               for item in sorted(stats['status'].items()))))
+        return
     logging_config()
     logger = logging.getLogger(__name__)
-    # Gc periodically
-    client = RwlockClient(StrictRedis(host=opt_server, port=opt_port))
-    while True:
-        logger.info('redisrwlock gc')
-        client.gc()
-        if not opt_repeat:
-            break
-        time.sleep(opt_interval)
+    if command == 'agent':
+        logger.info('redisrwlock agent')
+        RwlockAgent(StrictRedis(host=opt_server, port=opt_port),
+                    opt_socket).serve_forever()
+        return
+    if command == 'compact':
+        redis = StrictRedis(host=opt_server, port=opt_port)
+        before = RedisBackend(redis).memory_usage()
+        try:
+            migrate(redis)
+        except ValueError as err:
+            print("ERROR:", err)
+            sys.exit(os.EX_TEMPFAIL)
+        after = CompactRedisBackend(redis).memory_usage()
+        for layout, (total, grants) in (('default', before),
+                                        ('compact', after)):
+            print("%s: %d bytes, %d grant(s), %d bytes/grant" % (
+                layout, total, grants, total // grants if grants else 0))
+        return
+    # Gc targets concurrently, periodically if repeat
+    if not opt_targets:
+        opt_targets.append((opt_server, opt_port, 0,
+                            opt_replica[:2] if opt_replica else None))
+    logger.info('redisrwlock gc')
+    daemon = RwlockGcDaemon(opt_targets, opt_interval)
+    if opt_repeat:
+        daemon.serve_forever()
+    if None in daemon.run_once():
+        sys.exit(os.EX_UNAVAILABLE)
 
 
 try:
@@ -0,0 +1,460 @@
+from .redisrwlock import Rwlock, RwlockClient
+from redis import StrictRedis
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/tmp/redisrwlock-agent.sock'
+
+# Node-local agent
+#
+# Local processes connect to the agent through unix domain socket and
+# send lock/unlock requests instead of talking to the backend directly.
+# The agent keeps few backend connections for all of them:
+#
+# - one dispatcher thread does every grant and unlock
+# - requests arrived meanwhile are sent in a batch (one round trip for
+#   backends pipelining grant_many and release_many)
+# - waiting is done by the agent, not by polling local processes
+# - readers waiting for same resource retry with one representative,
+#   others granted in the same round when it is granted
+# - requests are ranked and queued by priority and deadline as by
+#   RwlockClient, so they keep the order of queue with direct clients
+# - deadlock detection after failed attempt is done by detector threads,
+#   then the request is back to the dispatcher for retry
+#
+# Locks are owned by {node}/{pid} of the local process as if it used
+# RwlockClient, so deadlock detection works across agents and clients.
+# Proxied owners are registered to the backend by register_proxy (listed
+# in agent:{owner of agent} for RedisBackend), gc regards them active
+# while the agent is active.  Locks of local process are released by the
+# agent when the process disconnects.
+#
+# Handler of connection only reads requests, responses are written by
+# the thread finishing them, so the handler sees EOF of a process gone
+# while its request waits, and the request is cancelled.
+#
+# Protocol: one JSON object per line for request and response
+#
+# {"op": "hello", "node": node, "pid": pid}          -> {}
+# {"op": "lock", "name": name, "mode": mode,
+#  "timeout": timeout, "retry_interval": interval,
+#  "capacity": capacity, "priority": priority,
+#  "deadline": deadline}                              -> {"status": status,
+#                                                        "token": token}
+#                                                     or {"error": message}
+# {"op": "unlock", "name": name, "mode": mode}       -> {"ok": true|false}
+
+
+# RwlockClient of a local process, backend accessed by agent's threads
+class _ProxyClient(RwlockClient):
+
+    def __init__(self, agent, node, pid):
+        self.agent = agent
+        super().__init__(node=node, pid=pid, backend=agent.backend)
+
+    def _register(self):
+        self.backend.register_proxy(self.agent.client.get_owner(),
+                                    self.get_owner())
+
+
+class _Request:
+
+    def __init__(self, op, owner, name=None, mode=None,
+                 timeout=0, retry_interval=0.1, capacity=1, priority=0,
+                 deadline=None, reply=None):
+        self.op = op
+        self.owner = owner
+        self.name = name
+        self.mode = mode
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.capacity = capacity
+        self.priority = priority
+        self.deadline = deadline
+        self.reply = reply  # called with result, if given
+        self.result = None
+        self.done = threading.Event()
+        self.cancelled = False
+        # for lock request
+        self.start = None
+        self.due = None
+        self.lock_time = None
+        self.rank = None
+        self.urgency = None
+        self.tried = False
+        self.waited = False
+
+
+class RwlockAgent:
+
+    def __init__(self, redis=None, path=DEFAULT_SOCKET, backend=None,
+                 detectors=4):
+        if backend is None and redis is None:
+            redis = StrictRedis()
+        self.client = RwlockClient(redis, backend=backend)
+        self.backend = self.client.backend
+        self.redis = self.client.redis
+        self.path = path
+        self.detectors = detectors
+        self._queue = queue.Queue()
+        self._detections = queue.Queue()
+        self._proxies = dict()      # owner -> _ProxyClient
+        self._connections = dict()  # owner -> number of connections
+        self._running = False
+        self._server = None
+        self._dispatcher = None
+        self._detectors = list()
+
+    def agent_key(self):
+        return 'agent:' + self.client.get_owner()
+
+    def start(self):
+        """Starts dispatcher and listens on unix socket in background"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = _AgentServer(self.path, _AgentHandler)
+        self._server.agent = self
+        self._running = True
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.start()
+        self._detectors = [threading.Thread(target=self._detect)
+                           for i in range(self.detectors)]
+        for detector in self._detectors:
+            detector.start()
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        logger.info('agent: listening on %s', self.path)
+
+    def stop(self):
+        """Stops serving, locks of local processes are released"""
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.path)
+        self._running = False
+        self._dispatcher.join()
+        for detector in self._detectors:
+            self._detections.put(None)
+        for detector in self._detectors:
+            detector.join()
+        # Requests back from detectors after dispatcher stopped
+        while not self._queue.empty():
+            request = self._queue.get()
+            if request.op == 'lock':
+                self._finish_lock(request, Rwlock.FAIL)
+            else:
+                self._finish(request, dict(ok=False)
+                             if request.op == 'unlock' else dict())
+        for owner in list(self._proxies):
+            self._release(owner)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def submit(self, request):
+        """Queues request for dispatcher, returns result when done,
+        or None right away if request has reply to get result"""
+        self._queue.put(request)
+        if request.reply is not None:
+            return None
+        request.done.wait()
+        return request.result
+
+    # Dispatcher: the only thread granting and releasing locks
+    def _dispatch(self):
+        waiting = list()
+        while self._running:
+            now = time.monotonic()
+            wait = 0.5
+            for request in waiting:
+                wait = min(wait, max(0, request.due - now))
+            batch = list()
+            try:
+                batch.append(self._queue.get(timeout=wait))
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            unlocks = list()
+            for request in batch:
+                if request.op == 'lock':
+                    # new, or back from detector with due of retry
+                    if request.start is None and not self._begin(request):
+                        continue
+                    waiting.append(request)
+                elif request.op == 'unlock':
+                    unlocks.append(request)
+                elif request.op == 'hello':
+                    self._hello(request.owner)
+                    self._finish(request, dict())
+                elif request.op == 'bye':
+                    self._bye(request.owner)
+                    self._finish(request, dict())
+            waiting = self._round(unlocks, waiting)
+        for request in waiting:
+            self._finish_lock(request, Rwlock.FAIL)
+
+    # Ranks new lock request as RwlockClient does, returns False if
+    # finished with error
+    def _begin(self, request):
+        request.start = request.due = time.monotonic()
+        request.lock_time = self.backend.now()
+        try:
+            request.rank, request.urgency, request.timeout = \
+                self.client._rank(request.lock_time, request.timeout,
+                                  request.priority, request.deadline)
+        except ValueError as e:
+            self._finish_lock(request, None, error=str(e))
+            return False
+        return True
+
+    # One round of batched unlocks and lock attempts,
+    # returns lock requests still waiting
+    def _round(self, unlocks, waiting):
+        now = time.monotonic()
+        attempts, skipped, still = list(), list(), list()
+        representatives = set()
+        for request in waiting:
+            if request.cancelled:
+                self._finish_lock(request, Rwlock.FAIL)
+            elif request.due > now:
+                still.append(request)
+            elif request.mode == Rwlock.READ and request.tried:
+                # Coalesce retrying readers of same resource
+                if request.name in representatives:
+                    skipped.append(request)
+                else:
+                    representatives.add(request.name)
+                    attempts.append(request)
+            else:
+                attempts.append(request)
+        if unlocks:
+            results = self.backend.release_many(
+                [(request.name, request.mode, request.owner)
+                 for request in unlocks])
+            for request, ok in zip(unlocks, results):
+                self._finish(request, dict(ok=ok))
+        if not attempts and not skipped:
+            return still
+        failed = list()
+        granted = self._attempt(attempts, failed)
+        # Representative granted, others granted with it right now
+        followers = list()
+        for request in skipped:
+            if request.name in granted:
+                followers.append(request)
+            else:
+                failed.append(request)
+        self._attempt(followers, failed)
+        for request in failed:
+            if request.timeout == 0:
+                self._finish_lock(request, Rwlock.FAIL)
+                continue
+            request.waited = True
+            # Retried when back from detector
+            self._detections.put(request)
+        return still
+
+    # Tries lock requests in one batch, finishes granted ones, appends
+    # failed ones, returns names granted to READ
+    def _attempt(self, attempts, failed):
+        if not attempts:
+            return set()
+        results = self.backend.grant_many(
+            [(request.name, request.mode, request.owner, request.lock_time,
+              request.capacity, not request.tried, request.rank)
+             for request in attempts])
+        granted = set()
+        for request, retval in zip(attempts, results):
+            request.tried = True
+            if isinstance(retval, ValueError):
+                self._finish_lock(request, None, error=str(retval))
+            elif retval:
+                self._finish_lock(request, Rwlock.OK,
+                                  None if retval is True else retval)
+                if request.mode == Rwlock.READ:
+                    granted.add(request.name)
+            else:
+                failed.append(request)
+        return granted
+
+    # Detector: deadlock detection and timeout of failed attempt
+    def _detect(self):
+        while True:
+            request = self._detections.get()
+            if request is None:
+                return
+            try:
+                proxy = self._proxies.get(request.owner)
+                if request.cancelled or proxy is None or \
+                        not self._running:
+                    self._finish_lock(request, Rwlock.FAIL)
+                elif proxy._deadlock([request.name], request.mode,
+                                     request.capacity, request.rank,
+                                     request.urgency):
+                    self._finish_lock(request, Rwlock.DEADLOCK)
+                elif request.timeout != Rwlock.FOREVER and \
+                        time.monotonic() - request.start > request.timeout:
+                    self._finish_lock(request, Rwlock.TIMEOUT)
+                else:
+                    request.due = time.monotonic() + request.retry_interval
+                    self._queue.put(request)
+            except Exception as e:
+                logger.warning('agent: %s: %s', request.owner, e)
+                self._finish_lock(request, Rwlock.FAIL)
+
+    def _finish_lock(self, request, status, token=None, error=None):
+        if request.waited:
+            self.backend.clear_wait(request.owner)
+        if error is not None:
+            self._finish(request, dict(error=error))
+        else:
+            self._finish(request, dict(status=status, token=token))
+
+    def _finish(self, request, result):
+        request.result = result
+        request.done.set()
+        if request.reply is not None and not request.cancelled:
+            try:
+                request.reply(result)
+            except OSError as e:
+                logger.debug('agent: %s: %s', request.owner, e)
+
+    def _hello(self, owner):
+        if owner not in self._proxies:
+            node, pid = owner.rsplit('/', 1)
+            self._proxies[owner] = _ProxyClient(self, node, pid)
+            logger.debug('agent: hello %s', owner)
+        self._connections[owner] = self._connections.get(owner, 0) + 1
+
+    def _bye(self, owner):
+        self._connections[owner] -= 1
+        if self._connections[owner] == 0:
+            self._release(owner)
+
+    # Releases all locks held by disconnected local process
+    def _release(self, owner):
+        proxy = self._proxies.pop(owner)
+        self._connections.pop(owner, None)
+        count = proxy.unlock_all()
+        if count:
+            logger.info('agent: released %d lock(s) of %s', count, owner)
+        self.backend.unregister_proxy(self.client.get_owner(), owner)
+        logger.debug('agent: bye %s', owner)
+
+
+class _AgentServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        agent = self.server.agent
+        owner = None
+        request = None
+        try:
+            for line in self.rfile:
+                message = json.loads(line.decode())
+                op = message['op']
+                if op == 'hello':
+                    if owner is not None:
+                        break
+                    owner = message['node'] + '/' + str(message['pid'])
+                    request = _Request('hello', owner, reply=self._reply)
+                elif owner is None:
+                    break
+                elif op == 'lock':
+                    request = _Request(
+                        'lock', owner, message['name'], message['mode'],
+                        message.get('timeout', 0),
+                        message.get('retry_interval', 0.1),
+                        message.get('capacity', 1),
+                        message.get('priority', 0), message.get('deadline'),
+                        reply=self._reply)
+                elif op == 'unlock':
+                    request = _Request('unlock', owner, message['name'],
+                                       message['mode'], reply=self._reply)
+                else:
+                    break
+                agent.submit(request)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('agent: %s: %s', owner, e)
+        finally:
+            # Process gone while its request in progress
+            if request is not None and not request.done.is_set():
+                request.cancelled = True
+                logger.info('agent: %s gone, %s cancelled', owner,
+                            request.op)
+            if owner is not None:
+                agent.submit(_Request('bye', owner))
+
+    def _reply(self, result):
+        self.wfile.write(json.dumps(result).encode() + b'\n')
+
+
+class RwlockAgentClient:
+    """Locks through node-local agent, same usage as RwlockClient"""
+
+    def __init__(self, path=DEFAULT_SOCKET, node=None, pid=None):
+        if node is None:
+            node = socket.gethostname()
+        if pid is None:
+            pid = os.getpid()
+        self.node = node
+        self.pid = str(pid)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rwb')
+        self._call(dict(op='hello', node=self.node, pid=self.pid))
+
+    def close(self):
+        """Disconnects from agent, locks not unlocked are released"""
+        self._file.close()
+        self._sock.close()
+
+    def get_owner(self):
+        return self.node + '/' + self.pid
+
+    def _call(self, message):
+        self._file.write(json.dumps(message).encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('agent closed connection')
+        return json.loads(line.decode())
+
+    def lock(self, name, mode, timeout=0, retry_interval=0.1, capacity=1,
+             priority=0, deadline=None):
+        """Same as RwlockClient.lock, waiting is done by the agent"""
+        rwlock = Rwlock(name, mode, self.node, self.pid)
+        result = self._call(dict(op='lock', name=name, mode=mode,
+                                 timeout=timeout,
+                                 retry_interval=retry_interval,
+                                 capacity=capacity, priority=priority,
+                                 deadline=deadline))
+        if 'error' in result:
+            raise ValueError(result['error'])
+        rwlock.status = result['status']
+        rwlock.token = result.get('token')
+        return rwlock
+
+    def unlock(self, rwlock):
+        """Same as RwlockClient.unlock"""
+        result = self._call(dict(op='unlock', name=rwlock.name,
+                                 mode=rwlock.mode))
+        return result['ok']
@@ -0,0 +1,513 @@
+from .redisrwlock import Backend
+from .redisrwlock import _active_owners, _RedisClock, _time_usec
+from .redisrwlock import _wait_alternatives
+from redis import StrictRedis
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Compact data structure for resource, owner, lock
+#
+# Resource names and owners are interned into integer ids, so each grant
+# is stored as one small hash field and one small sorted set member with
+# integer value, instead of a key per lock and strings repeated in sets.
+# Small hashes and sorted sets are stored compactly by redis (listpack).
+#
+# HASH:  {c}:rid    -> name: rid
+# HASH:  {c}:oid    -> owner: oid
+# HASH:  {c}:owner  -> oid: owner
+# STR:   {c}:next   -> last id given to rid or oid
+# HASH:  {c}:g:rid  -> 'n': name, 'c': capacity of counted,
+#                      {mode}{oid}: ref-count             (grants)
+# ZSET:  {c}:o:oid  -> {mode}{rid} scored by lock time   (accesses)
+# SET:   {c}:w:oid  -> set of waitee oid, '0' as seed    (wait-for graph)
+#                      prefixed by '{index}|' for lock_any
+# HASH:  {c}:ver    -> name: version, odd while written  (optimistic read)
+# SET:   {c}:a:agt  -> owners proxied by agent of owner agt
+#
+# A resource id is released when its last grant is released, an owner id
+# when the owner is gc-ed.
+#
+# Scripts declare the fixed keys rid, oid, owner, next and ver as KEYS.
+# Keys of ids, g, o and w, are known only inside scripts, so all keys of
+# the layout share hash tag {c}: they are in the slot of declared keys,
+# and scripts run on one node of redis cluster.
+#
+# Conflict cache requires the default layout.  Wait queue of priority
+# and deadline is not kept, so lock with them raises ValueError, and
+# deadlock victim is chosen by lock time only.  Call sites noted by
+# watchdog are not kept, holders have site None.
+
+# KEYS of all scripts
+_KEYS = ('{c}:rid', '{c}:oid', '{c}:owner', '{c}:next', '{c}:ver')
+
+_DECLARE = """\
+local RID, OID, OWNER, NEXT, VER = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+"""
+
+_INTERN = _DECLARE + """\
+local function intern(name_key, id_key, name)
+    local id = redis.call('hget', name_key, name)
+    if not id then
+        id = tostring(redis.call('incr', NEXT))
+        redis.call('hset', name_key, name, id)
+        if id_key then
+            redis.call('hset', id_key, id, name)
+        end
+    end
+    return id
+end
+-- returns true if conflicting, 'capacity' if capacity differs from
+-- counted holders
+local function conflicts(g, mode, oid, capacity)
+    local fields = redis.call('hkeys', g)
+    local holders = 0
+    for i, field in ipairs(fields) do
+        if field ~= 'n' and field ~= 'c' and
+                string.sub(field, 2) ~= oid then
+            local grant_mode = string.sub(field, 1, 1)
+            if grant_mode == 'S' and mode == 'S' then
+                holders = holders + 1
+            elseif not (grant_mode == 'R' and mode == 'R') then
+                return true
+            end
+        end
+    end
+    if mode ~= 'S' or not capacity then
+        return false
+    end
+    local stored = tonumber(redis.call('hget', g, 'c'))
+    if holders > 0 and stored and stored ~= capacity then
+        return 'capacity'
+    end
+    return holders >= capacity
+end
+local function remove_grant(oid, mode, rid)
+    local g = '{c}:g:'..rid
+    local name = redis.call('hget', g, 'n')
+    redis.call('hdel', g, mode..oid)
+    redis.call('zrem', '{c}:o:'..oid, mode..rid)
+    if mode == 'W' then
+        redis.call('hincrby', VER, name, 1)
+    end
+    if redis.call('hlen', g) == 1 + redis.call('hexists', g, 'c') then
+        redis.call('hdel', RID, name)
+        redis.call('del', g)
+    end
+end
+local function release_all(oid)
+    local accesses = redis.call('zrange', '{c}:o:'..oid, 0, -1)
+    for i, access in ipairs(accesses) do
+        remove_grant(oid, string.sub(access, 1, 1), string.sub(access, 2))
+    end
+    redis.call('del', '{c}:o:'..oid, '{c}:w:'..oid)
+    return #accesses
+end
+-- returns false if not granted, fencing token for WRITE, 0 for others,
+-- -2 if capacity differs, capacity not checked if nil
+local function grant(name, mode, oid, time, capacity)
+    local rid = redis.call('hget', RID, name)
+    if rid then
+        local conflict = conflicts('{c}:g:'..rid, mode, oid, capacity)
+        if conflict == 'capacity' then
+            return -2
+        elseif conflict then
+            return false
+        end
+    else
+        rid = intern(RID, nil, name)
+        redis.call('hset', '{c}:g:'..rid, 'n', name)
+    end
+    if mode == 'S' and capacity then
+        redis.call('hset', '{c}:g:'..rid, 'c', capacity)
+    end
+    local token = 0
+    if redis.call('hincrby', '{c}:g:'..rid, mode..oid, 1) == 1 then
+        redis.call('zadd', '{c}:o:'..oid, time, mode..rid)
+        if mode == 'W' then
+            token = redis.call('hincrby', VER, name, 1)
+        end
+    elseif mode == 'W' then
+        token = tonumber(redis.call('hget', VER, name)) or 0
+    end
+    return token
+end
+"""
+
+# ARGV: name, mode, owner, time, capacity (optional)
+# returns fencing token for WRITE, 0 for others, -1 if not granted,
+# -2 if capacity differs
+_LOCK_SCRIPT = _INTERN + """\
+local name, mode, owner, time = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local oid = intern(OID, OWNER, owner)
+return grant(name, mode, oid, time, tonumber(ARGV[5])) or -1
+"""
+
+# ARGV: mode, owner, time, capacity, offset, names
+# returns index of granted name and fencing token (0 unless WRITE,
+# -2 if capacity differs), -1 if none
+_LOCK_ANY_SCRIPT = _INTERN + """\
+local mode, owner, time = ARGV[1], ARGV[2], ARGV[3]
+local capacity, offset = tonumber(ARGV[4]), tonumber(ARGV[5])
+local oid = intern(OID, OWNER, owner)
+local count = #ARGV - 5
+for i = 0, count - 1 do
+    local j = (offset + i) % count
+    local token = grant(ARGV[6 + j], mode, oid, time, capacity)
+    if token then
+        return {j, token}
+    end
+end
+return -1
+"""
+
+# ARGV: name, mode, owner
+_UNLOCK_SCRIPT = _INTERN + """\
+local name, mode, owner = ARGV[1], ARGV[2], ARGV[3]
+local rid = redis.call('hget', RID, name)
+local oid = redis.call('hget', OID, owner)
+if not rid or not oid then
+    return 0
+end
+local rcnt = tonumber(redis.call('hget', '{c}:g:'..rid, mode..oid))
+if not rcnt then
+    return 0
+elseif rcnt == 1 then
+    remove_grant(oid, mode, rid)
+else
+    redis.call('hincrby', '{c}:g:'..rid, mode..oid, -1)
+end
+return 1
+"""
+
+# ARGV: owner
+_UNLOCK_ALL_SCRIPT = _INTERN + """\
+local oid = redis.call('hget', OID, ARGV[1])
+if not oid then
+    return 0
+end
+return release_all(oid)
+"""
+
+# ARGV: owners
+# returns number of locks and waits removed
+_GC_SCRIPT = _INTERN + """\
+local lock_count, wait_count = 0, 0
+for i, owner in ipairs(ARGV) do
+    local oid = redis.call('hget', OID, owner)
+    if oid then
+        wait_count = wait_count + redis.call('exists', '{c}:w:'..oid)
+        lock_count = lock_count + release_all(oid)
+        redis.call('hdel', OID, owner)
+        redis.call('hdel', OWNER, oid)
+    end
+end
+return {lock_count, wait_count}
+"""
+
+# ARGV: owner, mode, capacity, names
+# returns waitees for each of names, see _blocking_waitees for rules
+_WAITSET_SCRIPT = _INTERN + """\
+local owner, mode, capacity = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local oid = intern(OID, OWNER, owner)
+local w = '{c}:w:'..oid
+local owners, alternatives = {}, {}
+local stuck = true
+for k = 4, #ARGV do
+    local conflicts, holders = {}, {}
+    local rid = redis.call('hget', RID, ARGV[k])
+    local fields = rid and redis.call('hkeys', '{c}:g:'..rid) or {}
+    for i, field in ipairs(fields) do
+        local grant_mode = string.sub(field, 1, 1)
+        local grant_oid = string.sub(field, 2)
+        if field ~= 'n' and field ~= 'c' and grant_oid ~= oid then
+            owners[grant_oid] = redis.call('scard', '{c}:w:'..grant_oid) > 0
+            if grant_mode == 'S' and mode == 'S' then
+                table.insert(holders, grant_oid)
+            elseif not (grant_mode == 'R' and mode == 'R') then
+                table.insert(conflicts, grant_oid)
+            end
+        end
+    end
+    local all_waiting = #holders >= capacity
+    for i, holder in ipairs(holders) do
+        all_waiting = all_waiting and owners[holder]
+    end
+    if all_waiting then
+        for i, holder in ipairs(holders) do
+            table.insert(conflicts, holder)
+        end
+    end
+    local blocking = {}
+    for i, grant_oid in ipairs(conflicts) do
+        if owners[grant_oid] then
+            blocking[grant_oid] = true
+        end
+    end
+    stuck = stuck and next(blocking) ~= nil
+    table.insert(alternatives, blocking)
+end
+redis.call('del', w)
+redis.call('sadd', w, '0')
+local waitees = {}
+if stuck then
+    for i, blocking in ipairs(alternatives) do
+        local names = {}
+        for grant_oid in pairs(blocking) do
+            if #alternatives > 1 then
+                redis.call('sadd', w, (i - 1)..'|'..grant_oid)
+            else
+                redis.call('sadd', w, grant_oid)
+            end
+            table.insert(names, redis.call('hget', OWNER, grant_oid))
+        end
+        table.insert(waitees, names)
+    end
+end
+return waitees
+"""
+
+# ARGV: owner
+# returns wait set members with owners for oids
+_WAITEES_SCRIPT = _DECLARE + """\
+local oid = redis.call('hget', OID, ARGV[1])
+local waitees = {}
+if oid then
+    for i, waitee in ipairs(redis.call('smembers', '{c}:w:'..oid)) do
+        if waitee ~= '0' then
+            local prefix = string.match(waitee, '^%d+|') or ''
+            local waitee_oid = string.sub(waitee, #prefix + 1)
+            table.insert(waitees, prefix..
+                         redis.call('hget', OWNER, waitee_oid))
+        end
+    end
+end
+return waitees
+"""
+
+# ARGV: owner
+_CLEAR_WAIT_SCRIPT = _DECLARE + """\
+local oid = redis.call('hget', OID, ARGV[1])
+if oid then
+    redis.call('del', '{c}:w:'..oid)
+end
+"""
+
+# ARGV: owner
+_OLDEST_SCRIPT = _DECLARE + """\
+local oid = redis.call('hget', OID, ARGV[1])
+if not oid then
+    return false
+end
+local oldest = redis.call('zrange', '{c}:o:'..oid, 0, 0, 'withscores')
+return oldest[2] or false
+"""
+
+# ARGV: name
+# returns mode and owner of each grant, flattened
+_HOLDERS_SCRIPT = _DECLARE + """\
+local rid = redis.call('hget', RID, ARGV[1])
+local holders = {}
+if rid then
+    for i, field in ipairs(redis.call('hkeys', '{c}:g:'..rid)) do
+        if field ~= 'n' and field ~= 'c' then
+            table.insert(holders, string.sub(field, 1, 1))
+            table.insert(holders, redis.call('hget', OWNER,
+                                             string.sub(field, 2)))
+        end
+    end
+end
+return holders
+"""
+
+
+class CompactRedisBackend(Backend):
+    """Lock table in redis-server with interned ids, for less memory"""
+
+    def __init__(self, redis=None):
+        if redis is None:
+            redis = StrictRedis()
+        self.redis = redis
+        self._clock = _RedisClock(redis)
+        # EVALSHA, not to send script text every call
+        self._lock_script = redis.register_script(_LOCK_SCRIPT)
+        self._lock_any_script = redis.register_script(_LOCK_ANY_SCRIPT)
+        self._unlock_script = redis.register_script(_UNLOCK_SCRIPT)
+        self._unlock_all_script = redis.register_script(_UNLOCK_ALL_SCRIPT)
+        self._gc_script = redis.register_script(_GC_SCRIPT)
+        self._waitset_script = redis.register_script(_WAITSET_SCRIPT)
+        self._waitees_script = redis.register_script(_WAITEES_SCRIPT)
+        self._clear_wait_script = redis.register_script(_CLEAR_WAIT_SCRIPT)
+        self._oldest_script = redis.register_script(_OLDEST_SCRIPT)
+        self._holders_script = redis.register_script(_HOLDERS_SCRIPT)
+
+    def register(self, owner):
+        self.redis.client_setname('redisrwlock:' + owner)
+
+    def register_proxy(self, agent, owner):
+        self.redis.sadd('{c}:a:' + agent, owner)
+
+    def unregister_proxy(self, agent, owner):
+        self.redis.srem('{c}:a:' + agent, owner)
+
+    def now(self):
+        return self._clock.now()
+
+    def grant(self, name, mode, owner, time, capacity=1, rank=None,
+              notify=True):
+        token = self._lock_script(_KEYS, (name, mode, owner, time, capacity))
+        if token == -2:
+            raise ValueError('capacity differs from holders of ' + name)
+        if token < 0:
+            return False
+        return token or True
+
+    def release(self, name, mode, owner):
+        return self._unlock_script(_KEYS, (name, mode, owner)) == 1
+
+    def release_all(self, owner):
+        return self._unlock_all_script(_KEYS, (owner,))
+
+    def grant_any(self, names, mode, owner, time, capacity=1, offset=0,
+                  rank=None, notify=True):
+        retval = self._lock_any_script(
+            _KEYS, [mode, owner, time, capacity, offset] + list(names))
+        if retval == -1:
+            return None
+        if retval[1] == -2:
+            raise ValueError('capacity differs from holders of ' +
+                             names[retval[0]])
+        return retval[0], retval[1] or None
+
+    def waitset(self, owner, names, mode, capacity=1, rank=None,
+                urgency=None):
+        return [[waitee.decode() for waitee in waitees]
+                for waitees in self._waitset_script(
+                    _KEYS, [owner, mode, capacity] + list(names))]
+
+    def waitees(self, owner):
+        return _wait_alternatives(waitee.decode() for waitee in
+                                  self._waitees_script(_KEYS, (owner,)))
+
+    def clear_wait(self, owner):
+        self._clear_wait_script(_KEYS, (owner,))
+
+    def oldest_grant_time(self, owner):
+        oldest = self._oldest_script(_KEYS, (owner,))
+        return None if oldest is None else int(float(oldest))
+
+    def version(self, name):
+        return int(self.redis.hget('{c}:ver', name) or 0)
+
+    # Call sites are not noted in this layout
+    def holders(self, name):
+        holders = self._holders_script(_KEYS, (name,))
+        return [(holders[i].decode(), holders[i + 1].decode(), None)
+                for i in range(0, len(holders), 2)]
+
+    def gc(self):
+        # Owners before active client list, see RedisBackend.gc
+        owners = set(owner.decode()
+                     for owner in self.redis.hkeys('{c}:oid'))
+        agents = list(self.redis.scan_iter(match='{c}:a:*', count=128))
+        active = _active_owners(self.redis)
+        # Owners proxied by active agents are active, too
+        for agent_key in agents:
+            if agent_key.decode()[len('{c}:a:'):] in active:
+                active.update(owner.decode() for owner
+                              in self.redis.smembers(agent_key))
+            else:
+                self.redis.delete(agent_key)
+        stale_owners = owners - active
+        if not stale_owners:
+            return 0, 0, 0
+        for owner in stale_owners:
+            logger.info('gc: owner %s', owner)
+        lock_count, wait_count = self._gc_script(_KEYS, list(stale_owners))
+        return lock_count, wait_count, len(stale_owners)
+
+    def clear_all(self):
+        count = 0
+        for key in self.redis.scan_iter(match='{c}:*', count=128):
+            logger.debug('_clear_all: ' + key.decode())
+            deleted = self.redis.delete(key)
+            # Versions outlive locks, not counted as leftovers
+            if key != b'{c}:ver':
+                count += deleted
+        return count > 0
+
+    def memory_usage(self):
+        """returns bytes used by keys of this layout and number of grants"""
+        total, grants = 0, 0
+        for key in self.redis.scan_iter(match='{c}:*', count=128):
+            if key == b'{c}:ver':
+                continue
+            total += self.redis.memory_usage(key, samples=0) or 0
+            if key.startswith(b'{c}:o:'):
+                grants += self.redis.zcard(key)
+        return total, grants
+
+
+# Owners of default layout active, or proxied by active agent
+def _default_layout_active(redis):
+    owners = set()
+    for pattern in ('owner:*', 'wait:*'):
+        owners.update(key.decode().partition(':')[2] for key
+                      in redis.scan_iter(match=pattern, count=128))
+    active = _active_owners(redis)
+    for agent_key in list(redis.scan_iter(match='agent:*', count=128)):
+        if agent_key.decode()[len('agent:'):] in active:
+            active.update(owner.decode() for owner
+                          in redis.smembers(agent_key))
+    return owners & active
+
+
+def migrate(redis):
+    """Moves locks from default layout to compact layout.
+
+    Run while no client is using the default layout, raises ValueError
+    if some owner of the default layout is active, or a lock conflicts
+    with one in the compact layout, the lock kept in the default layout
+    then.  Waits and agents are not moved.
+
+    returns number of grants moved
+    """
+    active = _default_layout_active(redis)
+    if active:
+        raise ValueError('default layout in use by ' +
+                         ', '.join(sorted(active)))
+    count = 0
+    for owner_key in list(redis.scan_iter(match='owner:*', count=128)):
+        owner = re.match(r'owner:(.+)', owner_key.decode()).group(1)
+        for access in redis.smembers(owner_key):
+            mode, name = re.match(r'([RWS]):(.+)', access.decode()).group(1, 2)
+            lock_key = 'lock:' + name + ':' + mode + ':' + owner
+            lock = redis.get(lock_key)
+            if lock is not None:
+                rcnt, time = re.match(r'(.+):(.+)', lock.decode()).group(1, 2)
+                args = [name, mode, owner, _time_usec(time)]
+                capacity = redis.get('cap:' + name) if mode == 'S' else None
+                if capacity is not None:
+                    args.append(int(capacity))
+                for i in range(int(rcnt)):
+                    token = redis.eval(_LOCK_SCRIPT, len(_KEYS), *_KEYS,
+                                       *args)
+                    if token < 0:
+                        raise ValueError('lock conflicts in compact layout: ' +
+                                         lock_key)
+                count += 1
+            redis.delete(lock_key)
+            redis.srem('rsrc:' + name, mode + ':' + owner)
+        redis.delete(owner_key, 'otime:' + owner, 'wait:' + owner)
+    for ver_key in list(redis.scan_iter(match='ver:*', count=128)):
+        name = re.match(r'ver:(.+)', ver_key.decode()).group(1)
+        redis.hset('{c}:ver', name, int(redis.get(ver_key)))
+        redis.delete(ver_key)
+    # Capacity moved with grants
+    for cap_key in list(redis.scan_iter(match='cap:*', count=128)):
+        redis.delete(cap_key)
+    logger.info('migrate: %d grant(s)', count)
+    return count
+
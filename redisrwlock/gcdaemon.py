@@ -0,0 +1,154 @@
+from .redisrwlock import RwlockClient
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Gc daemon for many redis-servers and databases
+#
+# Each target is collected by a worker of a thread pool, so a slow or
+# unreachable server does not delay others.  Interval of each target
+# adapts to stale locks found by its last pass:
+#
+# - stale locks found: interval halved, down to min_interval
+# - nothing found: interval doubled, up to interval given
+# - error: retried after interval given
+#
+# so targets with crashing clients are collected more often while idle
+# ones cost one pass per interval.
+#
+# A target may name its replica after '@', so scans of gc read replica,
+# not to take CPU of primary from locking.
+
+
+def _parse_address(address, target):
+    host, _, port = address.partition(':')
+    if not host:
+        raise ValueError('host missing in target: ' + target)
+    port = int(port) if port else 6379
+    if not 0 <= port <= 65535:
+        raise ValueError('invalid port in target: ' + target)
+    return host, port
+
+
+def parse_target(target):
+    """Parses 'host[:port][/db][@replica_host[:replica_port]]' into
+    (host, port, db, replica), replica is (host, port) or None"""
+    target, _, replica = target.partition('@')
+    host, _, db = target.partition('/')
+    host, port = _parse_address(host, target)
+    db = int(db) if db else 0
+    if db < 0:
+        raise ValueError('invalid db in target: ' + target)
+    if replica:
+        replica = _parse_address(replica, target)
+    return host, port, db, replica or None
+
+
+def read_targets(path):
+    """Reads targets from file, one per line, '#' begins comment"""
+    targets = list()
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                targets.append(parse_target(line))
+    return targets
+
+
+class _Target:
+
+    def __init__(self, host, port, db, interval, replica=None):
+        self.name = '%s:%d/%d' % (host, port, db)
+        self.redis = StrictRedis(host=host, port=port, db=db)
+        self.replica = None
+        if replica is not None:
+            self.name += '@%s:%d' % replica
+            self.replica = StrictRedis(host=replica[0], port=replica[1],
+                                       db=db)
+        self.client = None  # connected by first pass
+        self.interval = interval
+        self.elapsed = None
+        self.counts = None
+
+
+class RwlockGcDaemon:
+
+    def __init__(self, targets, interval=5, min_interval=None,
+                 workers=None):
+        if min_interval is None:
+            min_interval = interval / 8
+        self.max_interval = interval
+        self.min_interval = min(min_interval, interval)
+        # targets are (host, port, db) or (host, port, db, replica)
+        self.targets = [_Target(*target[:3], interval, *target[3:])
+                        for target in targets]
+        if workers is None:
+            workers = min(32, len(self.targets))
+        self.workers = max(1, workers)
+
+    def collect(self, target):
+        """Runs gc of target, adapts its interval and reports timing
+
+        returns numbers of locks, waits and owners removed,
+        None if failed
+        """
+        t1 = time.monotonic()
+        try:
+            if target.client is None:
+                target.client = RwlockClient(target.redis,
+                                             replica=target.replica)
+            counts = target.client.gc()
+        except RedisError as e:
+            counts = None
+            target.interval = self.max_interval
+            logger.warning('gc %s: %s', target.name, e)
+        else:
+            if counts[0]:
+                target.interval = max(self.min_interval, target.interval / 2)
+            else:
+                target.interval = min(self.max_interval, target.interval * 2)
+        target.elapsed = time.monotonic() - t1
+        target.counts = counts
+        if counts is not None:
+            logger.info('gc %s: %d lock(s), %d wait(s), %d owner(s) '
+                        'in %.1f ms, next in %.2f s', target.name,
+                        counts[0], counts[1], counts[2],
+                        target.elapsed * 1000, target.interval)
+        return counts
+
+    def run_once(self):
+        """Collects all targets concurrently, once
+
+        returns results of collect for targets in order
+        """
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(self.collect, self.targets))
+
+    def serve_forever(self):
+        """Collects each target repeatedly at its adaptive interval"""
+        pool = ThreadPoolExecutor(self.workers)
+        due = [(0.0, i) for i in range(len(self.targets))]
+        running = dict()  # future -> index of target
+        try:
+            while True:
+                now = time.monotonic()
+                while due and due[0][0] <= now:
+                    i = heapq.heappop(due)[1]
+                    future = pool.submit(self.collect, self.targets[i])
+                    running[future] = i
+                timeout = max(0.0, due[0][0] - now) if due else None
+                done, _ = wait(running, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    future.result()  # unexpected error stops daemon
+                    heapq.heappush(due, (time.monotonic() +
+                                         self.targets[i].interval, i))
+        finally:
+            pool.shutdown(wait=False)
@@ -0,0 +1,517 @@
+from .redisrwlock import _blocking_waitees, _conflicts, Backend, Rwlock
+from .redisrwlock import _DUMMY_SEED_WAITEE, _wait_alternatives
+from .redisrwlock import _wait_members
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lock table shared by processes on one machine
+#
+# The table is a dict in a memory mapped file, protected by flock
+# between processes and by a mutex between threads.  Every operation is
+# done atomically while holding both of them, so no network round trip
+# and no redis-server needed.  Decoded table is cached by each process.
+#
+# File layout:
+#
+# header = epoch, offset, length, snapshot  (4 unsigned 64-bit integers)
+# data   = two halves of equal capacity following header
+#
+# Data is lines of JSON, each a list of [section, key, value] records,
+# value null for deleted entry.  First line is snapshot of whole table
+# written in the epoch, following lines are entries changed by each
+# operation.  A process applies only lines appended since it read, and
+# an operation writes only entries it changed, not whole table.
+#
+# When no room left for changes, snapshot of the table is written to the
+# half not in use with new epoch, then header switched to it, so a
+# process killed while writing does not corrupt the table.  Half is kept
+# twice as large as snapshot, so snapshot written once per changes of
+# its size.
+#
+# File is created by and must be owned by the user, JSON decodes data
+# only, no code.
+#
+# Table:
+#
+# rsrc:  name -> set of (mode, owner)          grants
+# lock:  (name, mode, owner) -> [rcnt, time]
+# owner: owner -> {(mode, name): time}         accesses
+# wait:  owner -> set of waitee, prefixed by '{index}|' for lock_any
+# live:  owner -> pid of registered process    (for gc)
+# ver:   name -> version, odd while written     (optimistic read)
+# queue: name -> {(mode, owner): rank}          waitors queued by rank
+# prio:  owner -> (priority, deadline)          of queued waitor
+# site:  owner -> {(mode, name): site}         noted by watchdog
+# cap:   name -> capacity of counted grants     while granted
+
+_HEADER = struct.Struct('QQQQ')
+
+
+def _default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+    return os.path.join(directory, 'redisrwlock-%d' % os.getuid())
+
+
+# Opens table file, created with O_EXCL or existing one owned by user
+def _open(path):
+    try:
+        return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL |
+                       os.O_NOFOLLOW, 0o600)
+    except FileExistsError:
+        pass
+    fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+        os.close(fd)
+        raise PermissionError('not a file owned by user: ' + path)
+    return fd
+
+
+def _pairs(mapping):
+    return [list(key) + [value] for key, value in mapping.items()]
+
+
+def _unpairs(pairs):
+    return dict((tuple(pair[:-1]), pair[-1]) for pair in pairs)
+
+
+def _identity(value):
+    return value
+
+
+# Sections of table, encoder and decoder of their values
+_ENCODE = dict(rsrc=lambda grants: [list(grant) for grant in grants],
+               lock=_identity, owner=_pairs, wait=list, live=_identity,
+               ver=_identity, queue=_pairs, prio=list, site=_pairs,
+               cap=_identity)
+_DECODE = dict(rsrc=lambda grants: set(tuple(grant) for grant in grants),
+               lock=_identity, owner=_unpairs, wait=set, live=_identity,
+               ver=_identity, queue=_unpairs, prio=tuple, site=_unpairs,
+               cap=_identity)
+
+
+# Line of records of table entries of changes, (section, key) pairs
+def _encode(table, changes):
+    records = list()
+    for section, key in changes:
+        value = table[section].get(key)
+        records.append([section, list(key) if isinstance(key, tuple)
+                        else key,
+                        None if value is None else _ENCODE[section](value)])
+    return json.dumps(records, separators=(',', ':')).encode() + b'\n'
+
+
+def _apply(table, data):
+    for line in data.splitlines():
+        for section, key, value in json.loads(line.decode()):
+            if isinstance(key, list):
+                key = tuple(key)
+            if value is None:
+                table[section].pop(key, None)
+            else:
+                table[section][key] = _DECODE[section](value)
+
+
+# Entries changed by grant or release of lock
+def _grant_changes(name, mode, owner):
+    return [('rsrc', name), ('cap', name), ('lock', (name, mode, owner)),
+            ('owner', owner), ('ver', name)]
+
+
+def _empty_table():
+    return dict(rsrc=dict(), lock=dict(), owner=dict(), wait=dict(),
+                live=dict(), ver=dict(), queue=dict(), prio=dict(),
+                site=dict(), cap=dict())
+
+
+# Removes waitor from wait queues, returns entries changed
+def _dequeue(table, owner):
+    if table.get('prio', dict()).pop(owner, None) is None:
+        return []
+    changes = [('prio', owner)]
+    queues = table['queue']
+    for name in list(queues):
+        queue = queues[name]
+        entries = [entry for entry in queue if entry[1] == owner]
+        for entry in entries:
+            del queue[entry]
+        if entries:
+            changes.append(('queue', name))
+        if not queue:
+            del queues[name]
+    return changes
+
+
+# Version incremented when write lock granted or released, returned as
+# fencing token when granted
+def _bump_version(table, name):
+    versions = table.setdefault('ver', dict())
+    versions[name] = versions.get(name, 0) + 1
+    return versions[name]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LocalBackend(Backend):
+    """Lock table in shared memory for processes on one machine"""
+
+    ranked = True
+
+    def __init__(self, path=None, size=1 << 16):
+        if path is None:
+            path = _default_path()
+        self.path = path
+        self._fd = _open(path)
+        self._mutex = threading.Lock()
+        self._table = None
+        self._epoch = None
+        self._applied = 0  # length of data applied to cached table
+        with self._mutex:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size < _HEADER.size + 2:
+                    os.ftruncate(self._fd, max(size, _HEADER.size + 2))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, 0)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    # Runs func(table) atomically, func returns (result, changes),
+    # changes list of (section, key) of entries changed, or True if
+    # changed too many to list
+    def _transact(self, func):
+        with self._mutex:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return self._transact_locked(func)
+            except BaseException:
+                self._table = None
+                raise
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _transact_locked(self, func):
+        size = os.fstat(self._fd).st_size
+        if size != len(self._map):
+            # grown by other process
+            self._map.close()
+            self._map = mmap.mmap(self._fd, size)
+        epoch, offset, length, snapshot = _HEADER.unpack_from(self._map, 0)
+        if self._table is None or epoch != self._epoch:
+            self._table = _empty_table()
+            self._epoch = epoch
+            self._applied = 0
+        if self._applied < length:
+            _apply(self._table,
+                   self._map[offset + self._applied:offset + length])
+            self._applied = length
+        result, changes = func(self._table)
+        if not changes:
+            return result
+        capacity = (len(self._map) - _HEADER.size) // 2
+        if changes is not True and offset:
+            data = _encode(self._table, set(changes))
+            if length + len(data) <= capacity:
+                self._map[offset + length:offset + length + len(data)] = data
+                length += len(data)
+                _HEADER.pack_into(self._map, 0, epoch, offset, length,
+                                  snapshot)
+                self._applied = length
+                return result
+        data = _encode(self._table,
+                       [(section, key) for section in _ENCODE
+                        for key in self._table[section]])
+        if len(data) * 2 > capacity:
+            # New second half begins after end of current data,
+            # which is kept until header switched
+            capacity = max(len(data) * 2, capacity * 2)
+            os.ftruncate(self._fd, _HEADER.size + capacity * 2)
+            self._map.close()
+            self._map = mmap.mmap(self._fd, 0)
+            offset = _HEADER.size
+        if offset == _HEADER.size:
+            offset += capacity
+        else:
+            offset = _HEADER.size
+        self._map[offset:offset + len(data)] = data
+        epoch += 1
+        _HEADER.pack_into(self._map, 0, epoch, offset, len(data), len(data))
+        self._epoch = epoch
+        self._applied = len(data)
+        return result
+
+    def register(self, owner):
+        def register(table):
+            table['live'][owner] = os.getpid()
+            return None, [('live', owner)]
+        self._transact(register)
+
+    # Proxied owner is live while process of agent is
+    def register_proxy(self, agent, owner):
+        self.register(owner)
+
+    def unregister_proxy(self, agent, owner):
+        def unregister_proxy(table):
+            if table['live'].pop(owner, None) is None:
+                return None, False
+            return None, [('live', owner)]
+        self._transact(unregister_proxy)
+
+    def now(self):
+        return int(time.time() * 1000000)
+
+    def grant(self, name, mode, owner, time, capacity=1, rank=None,
+              notify=True):
+        def grant(table):
+            granted = self._grant(table, name, mode, owner, time, capacity,
+                                  rank)
+            return granted, granted and _grant_changes(name, mode, owner)
+        return self._transact(grant)
+
+    def grant_any(self, names, mode, owner, time, capacity=1, offset=0,
+                  rank=None, notify=True):
+        def grant_any(table):
+            for i in range(len(names)):
+                index = (offset + i) % len(names)
+                granted = self._grant(table, names[index], mode, owner, time,
+                                      capacity, rank)
+                if granted:
+                    return (index, None if granted is True else granted), \
+                        _grant_changes(names[index], mode, owner)
+            return None, False
+        return self._transact(grant_any)
+
+    @staticmethod
+    def _queued_ahead(table, name, mode, owner, rank):
+        queue = table.get('queue', dict()).get(name, dict())
+        return [queued_owner
+                for (queued_mode, queued_owner), queued_rank in queue.items()
+                if queued_rank < rank and queued_owner != owner and
+                _conflicts(mode, queued_mode) and table['wait'].get(
+                    queued_owner)]
+
+    @staticmethod
+    def _grant(table, name, mode, owner, time, capacity, rank=None):
+        if rank is not None and \
+                LocalBackend._queued_ahead(table, name, mode, owner, rank):
+            return False
+        grants = table['rsrc'].get(name, set())
+        holders = 0
+        for grant_mode, grant_owner in grants:
+            if grant_owner != owner:
+                if grant_mode == mode == Rwlock.COUNTED:
+                    holders += 1
+                elif _conflicts(mode, grant_mode):
+                    return False
+        if mode == Rwlock.COUNTED:
+            caps = table.setdefault('cap', dict())
+            if holders and caps.get(name, capacity) != capacity:
+                raise ValueError('capacity differs from holders of ' + name)
+            if holders >= capacity:
+                return False
+            caps[name] = capacity
+        table['rsrc'][name] = grants
+        grants.add((mode, owner))
+        lock = table['lock'].get((name, mode, owner))
+        if lock is None:
+            table['lock'][(name, mode, owner)] = [1, time]
+            table['owner'].setdefault(owner, dict())[(mode, name)] = time
+            if mode == Rwlock.WRITE:
+                return _bump_version(table, name)
+        else:
+            lock[0] += 1
+            if mode == Rwlock.WRITE:
+                return table['ver'][name]
+        return True
+
+    def release(self, name, mode, owner):
+        def release(table):
+            lock = table['lock'].get((name, mode, owner))
+            if lock is None:
+                return False, False
+            if lock[0] == 1:
+                del table['lock'][(name, mode, owner)]
+                self._remove_grant(table, name, mode, owner)
+            else:
+                lock[0] -= 1
+            return True, _grant_changes(name, mode, owner)
+        return self._transact(release)
+
+    @staticmethod
+    def _remove_grant(table, name, mode, owner):
+        grants = table['rsrc'][name]
+        grants.discard((mode, owner))
+        if not grants:
+            del table['rsrc'][name]
+            table.get('cap', dict()).pop(name, None)
+        accesses = table['owner'][owner]
+        del accesses[(mode, name)]
+        if not accesses:
+            del table['owner'][owner]
+        if mode == Rwlock.WRITE:
+            _bump_version(table, name)
+
+    def release_all(self, owner):
+        def release_all(table):
+            accesses = table['owner'].pop(owner, dict())
+            changes = [('wait', owner), ('site', owner)]
+            for mode, name in accesses:
+                changes += _grant_changes(name, mode, owner)
+                del table['lock'][(name, mode, owner)]
+                grants = table['rsrc'][name]
+                grants.discard((mode, owner))
+                if not grants:
+                    del table['rsrc'][name]
+                    table.get('cap', dict()).pop(name, None)
+                if mode == Rwlock.WRITE:
+                    _bump_version(table, name)
+            table['wait'].pop(owner, None)
+            changes += _dequeue(table, owner)
+            table.get('site', dict()).pop(owner, None)
+            return len(accesses), changes
+        return self._transact(release_all)
+
+    def waitset(self, owner, names, mode, capacity=1, rank=None,
+                urgency=None):
+        def waitset(table):
+            waits = table['wait']
+            wait = waits.setdefault(owner, set())
+            wait.add(_DUMMY_SEED_WAITEE)
+            changes = [('wait', owner)]
+            if urgency is not None:
+                table.setdefault('prio', dict())[owner] = urgency
+                queues = table.setdefault('queue', dict())
+                for name in names:
+                    queues.setdefault(name, dict())[(mode, owner)] = rank
+                changes.append(('prio', owner))
+                changes += [('queue', name) for name in names]
+            blockers, owners = list(), set()
+            for name in names:
+                conflicts, holders = list(), list()
+                for grant_mode, grant_owner in table['rsrc'].get(name, ()):
+                    if grant_owner != owner:
+                        if grant_mode == mode == Rwlock.COUNTED:
+                            holders.append(grant_owner)
+                        elif _conflicts(mode, grant_mode):
+                            conflicts.append(grant_owner)
+                if rank is not None:
+                    conflicts += self._queued_ahead(table, name, mode, owner,
+                                                    rank)
+                blockers.append((conflicts, holders))
+                owners.update(conflicts, holders)
+            waiting = dict((grant_owner, bool(waits.get(grant_owner)))
+                           for grant_owner in owners)
+            alternatives = _blocking_waitees(blockers, waiting, capacity)
+            wait.clear()
+            wait.add(_DUMMY_SEED_WAITEE)
+            wait.update(_wait_members(alternatives))
+            return [list(waitees) for waitees in alternatives], changes
+        return self._transact(waitset)
+
+    def waitees(self, owner):
+        def waitees(table):
+            return _wait_alternatives(table['wait'].get(owner, ())), False
+        return self._transact(waitees)
+
+    def clear_wait(self, owner):
+        def clear_wait(table):
+            changes = _dequeue(table, owner)
+            if table['wait'].pop(owner, None) is not None:
+                changes.append(('wait', owner))
+            return None, changes
+        self._transact(clear_wait)
+
+    def oldest_grant_time(self, owner):
+        def oldest_grant_time(table):
+            accesses = table['owner'].get(owner)
+            return min(accesses.values()) if accesses else None, False
+        return self._transact(oldest_grant_time)
+
+    def urgency(self, owner):
+        def urgency(table):
+            return table.get('prio', dict()).get(owner, (0, None)), False
+        return self._transact(urgency)
+
+    def version(self, name):
+        def version(table):
+            return table.get('ver', dict()).get(name, 0), False
+        return self._transact(version)
+
+    def annotate(self, owner, name, mode, site):
+        def annotate(table):
+            sites = table.setdefault('site', dict())
+            if site is not None:
+                sites.setdefault(owner, dict())[(mode, name)] = site
+                return None, [('site', owner)]
+            notes = sites.get(owner, dict())
+            if notes.pop((mode, name), None) is None:
+                return None, False
+            if not notes:
+                del sites[owner]
+            return None, [('site', owner)]
+        return self._transact(annotate)
+
+    def holders(self, name):
+        def holders(table):
+            sites = table.get('site', dict())
+            return [(mode, owner, sites.get(owner, dict()).get((mode, name)))
+                    for mode, owner in table['rsrc'].get(name, ())], False
+        return self._transact(holders)
+
+    def gc(self):
+        def gc(table):
+            live = table['live']
+            for owner, pid in list(live.items()):
+                if not _alive(pid):
+                    del live[owner]
+            stale_owners = set(table['owner']) - set(live)
+            stale_waitors = set(table['wait']) - set(live)
+            lock_count = 0
+            for owner in stale_owners:
+                accesses = table['owner'][owner]
+                # oldest first
+                for mode, name in sorted(accesses, key=accesses.get):
+                    del table['lock'][(name, mode, owner)]
+                    self._remove_grant(table, name, mode, owner)
+                    lock_count += 1
+                    logger.info('gc: lock %s:%s:%s', name, mode, owner)
+                table.get('site', dict()).pop(owner, None)
+                logger.info('gc: owner %s', owner)
+            for waitor in stale_waitors:
+                del table['wait'][waitor]
+                _dequeue(table, waitor)
+                logger.info('gc: wait %s', waitor)
+            return (lock_count, len(stale_waitors), len(stale_owners)), True
+        return self._transact(gc)
+
+    def clear_all(self):
+        def clear_all(table):
+            found = any(table[key] for key in ('rsrc', 'lock', 'owner',
+                                               'wait'))
+            table.clear()
+            table.update(_empty_table())
+            return found, True
+        return self._transact(clear_all)
@@ -1,29 +1,39 @@
 from __future__ import print_function
-from redis import StrictRedis
+from redis import ConnectionPool, StrictRedis
+from redis.client import PubSub
 
 import logging
 import logging.config
+import atexit
 import os
-import re
+import queue
+import signal
 import socket
+import sys
+import threading
 import time
+import traceback
+import zlib
 
 logger = logging.getLogger(__name__)
 
 # (1) Primary data structure for resource, owner, lock
 #
 # name  = resource name
-# mode  = R|W
+# mode  = R|W|S  (S: counted, shared by holders up to capacity)
 # owner = node/pid
-# time  = sec.usec (from redis time command)
+# time  = usec (microseconds of redis time, estimated by client)
+#         or sec.usec written by older clients
 #
 # SET:    rsrc -> set of lock grants
 # STR:    lock -> ref-count:time      (time added for victim selection)
 # SET:   owner -> set of rsrc access  (this set is for victim selection)
+# ZSET:  otime -> rsrc access scored by lock time (oldest grant first)
 #
 # rsrc_key   = rsrc:{name}
 # lock_key   = lock:{name}:{mode}:{owner}
 # owner_key  = owner:{owner}
+# otime_key  = otime:{owner}
 #
 # grant      = {mode}:{owner}
 # access     = {mode}:{name}
@@ -34,40 +44,171 @@ logger = logging.getLogger(__name__)
 #
 # waitor_key = wait:{owner}
 # waitee     = {owner}
+#
+# (3) Additional data structure for owners proxied by agent
+#
+# SET:  agent -> set of owner  (active as long as agent is active)
+#
+# agent_key  = agent:{owner}
+#
+# (4) Additional data structure for optimistic read (seqlock)
+#
+# STR:  ver -> version of resource, odd while write lock granted
+#
+# ver_key    = ver:{name}
+#
+# Incremented when write lock granted and when released (by unlock,
+# unlock_all, or gc), so readers can validate nothing written meanwhile.
+# Kept after locks released, not to reuse versions.  Version just after
+# write lock granted is the fencing token of the grant, increasing with
+# each write grant of the resource.
+#
+# (5) Additional data structure for priority and deadline of waitors
+#
+# ZSET: queue -> waiting grant scored by rank (lower granted first)
+# STR:  prio  -> priority:deadline of waitor (deadline empty if none)
+#
+# queue_key  = queue:{name}
+# prio_key   = prio:{owner}
+#
+# Only waitors given priority or deadline are queued.  Lock requests
+# carrying rank are not granted while conflicting waitor of lower rank
+# is queued.  Entries are removed when waitor stops waiting, and by gc
+# when waitor is no more active.
+#
+# (6) Additional data structure for capacity of counted lock
+#
+# STR:  cap -> capacity given by counted holders
+#
+# cap_key    = cap:{name}
+#
+# Set by each counted grant, and requests giving other capacity are
+# rejected while others hold the resource counted.  Kept after locks
+# released like version, overwritten by next counted grant.
 
 # atomic:
-# - checking if any conflicting locks granted
+# - checking if conflicting waitor queued ahead, when rank given
+# - checking if any conflicting locks granted, notifying their owners
+#   keeping grants (listed in sticky set) on 'revoke:{owner}' channel
+#   with name, when notify given
+# - checking if counted locks granted less than capacity, and granted
+#   with the same capacity
 # - adding lock if no confliction
-_LOCK_SCRIPT = """\
-local rsrc_key = KEYS[1]
-local lock_key = KEYS[2]
-local owner_key = KEYS[3]
-local name = string.match(lock_key, 'lock:(.+):[RW]:.+')
-local mode = string.match(lock_key, 'lock:.+:([RW]):.+')
-local owner = string.match(lock_key, 'lock:.+:[RW]:(.+)')
-local grants = redis.call('smembers', rsrc_key)
-for i, grant in ipairs(grants) do
-    local grant_mode = string.match(grant, '([RW]):.+')
-    local grant_owner = string.match(grant, '[RW]:(.+)')
-    if grant_owner ~= owner then
-        if not (grant_mode == 'R' and mode == 'R') then
-            return 'false'
+# returns false if not granted, fencing token for WRITE, true for others,
+# -1 if capacity differs from counted holders
+_GRANT_FUNCTION = """\
+local function grant(rsrc_key, lock_key, owner_key, otime_key, ver_key,
+                     queue_key, sticky_key, cap_key, time, capacity, rank,
+                     notify)
+    local name = string.match(lock_key, 'lock:(.+):[RWS]:.+')
+    local mode = string.match(lock_key, 'lock:.+:([RWS]):.+')
+    local owner = string.match(lock_key, 'lock:.+:[RWS]:(.+)')
+    if rank then
+        local queued = redis.call('zrangebyscore', queue_key,
+                                  '-inf', '('..rank)
+        for i, entry in ipairs(queued) do
+            local queued_mode = string.match(entry, '([RWS]):.+')
+            local queued_owner = string.match(entry, '[RWS]:(.+)')
+            if queued_owner ~= owner and
+                    not (queued_mode == mode and mode ~= 'W') then
+                return false
+            end
+        end
+    end
+    local grants = redis.call('smembers', rsrc_key)
+    local holders = 0
+    local blocked = false
+    for i, grant in ipairs(grants) do
+        local grant_mode = string.match(grant, '([RWS]):.+')
+        local grant_owner = string.match(grant, '[RWS]:(.+)')
+        if grant_owner ~= owner then
+            if grant_mode == 'S' and mode == 'S' then
+                holders = holders + 1
+            elseif not (grant_mode == 'R' and mode == 'R') then
+                -- ask holder to give up grant kept after unlock
+                if notify and redis.call('sismember', sticky_key,
+                                         grant_owner) == 1 then
+                    redis.call('publish', 'revoke:'..grant_owner, name)
+                end
+                blocked = true
+            end
+        end
+    end
+    if blocked then
+        return false
+    end
+    if mode == 'S' then
+        local stored = tonumber(redis.call('get', cap_key))
+        if holders > 0 and stored and stored ~= capacity then
+            return -1
+        end
+        if holders >= capacity then
+            return false
+        end
+        if stored ~= capacity then
+            redis.call('set', cap_key, capacity)
         end
     end
+    -- add as grant and acccess, set lock k=v
+    redis.call('sadd', rsrc_key, mode..':'..owner)
+    redis.call('sadd', owner_key, mode..':'..name)
+    local rcnt = '1'
+    local token = true
+    local retval = redis.call('get', lock_key)
+    if retval ~= false then
+        rcnt = tonumber(string.match(retval, '(.+):.+')) + 1
+        time = string.match(retval, '.+:(.+)')
+        if mode == 'W' then
+            token = tonumber(redis.call('get', ver_key)) or true
+        end
+    else
+        redis.call('zadd', otime_key, time, mode..':'..name)
+        if mode == 'W' then
+            token = redis.call('incr', ver_key)
+        end
+    end
+    redis.call('set', lock_key, rcnt..':'..time)
+    return token
 end
--- add as grant and acccess, set lock k=v
-redis.call('sadd', rsrc_key, mode..':'..owner)
-redis.call('sadd', owner_key, mode..':'..name)
-local rcnt = '1'
-local time = ARGV[1]
-local retval = redis.call('get', lock_key)
-if retval ~= false then
-    rcnt = tonumber(string.match(retval, '(.+):.+')) + 1
-    time = string.match(retval, '.+:(.+)')
-    redis.call('set', lock_key, '1:'..time)
+"""
+
+# KEYS: rsrc, lock, owner, otime, ver, queue, sticky, cap
+# ARGV: time, capacity, notify ('1' or '0'), rank (optional)
+# returns 'false', fencing token for WRITE, 'true', or -1 if capacity
+# differs
+_LOCK_SCRIPT = _GRANT_FUNCTION + """\
+local token = grant(KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6],
+                    KEYS[7], KEYS[8], ARGV[1], tonumber(ARGV[2]), ARGV[4],
+                    ARGV[3] == '1')
+if token == true then
+    return 'true'
+elseif token then
+    return token
 end
-redis.call('set', lock_key, rcnt..':'..time)
-return 'true'
+return 'false'
+"""
+
+# atomic:
+# - trying each of resources from offset, until one granted
+# KEYS: owner, otime, sticky, then rsrc, lock, ver, queue, cap for each
+#       resource
+# ARGV: time, capacity, offset, notify ('1' or '0'), rank (optional)
+# returns index of granted resource and fencing token (0 unless WRITE,
+# -1 if capacity differs), -1 if none
+_LOCK_ANY_SCRIPT = _GRANT_FUNCTION + """\
+local count = (#KEYS - 3) / 5
+local offset = tonumber(ARGV[3])
+for i = 0, count - 1 do
+    local j = (offset + i) % count
+    local k = 4 + j * 5
+    local token = grant(KEYS[k], KEYS[k + 1], KEYS[1], KEYS[2], KEYS[k + 2],
+                        KEYS[k + 3], KEYS[3], KEYS[k + 4], ARGV[1],
+                        tonumber(ARGV[2]), ARGV[5], ARGV[4] == '1')
+    if token then
+        return {j, token == true and 0 or token}
+    end
+end
+return -1
 """
 
 # atomic:
@@ -77,9 +218,11 @@ _UNLOCK_SCRIPT = """\
 local rsrc_key = KEYS[1]
 local lock_key = KEYS[2]
 local owner_key = KEYS[3]
-local name = string.match(lock_key, 'lock:(.+):[RW]:.+')
-local mode = string.match(lock_key, 'lock:.+:([RW]):.+')
-local owner = string.match(lock_key, 'lock:.+:[RW]:(.+)')
+local otime_key = KEYS[4]
+local ver_key = KEYS[5]
+local name = string.match(lock_key, 'lock:(.+):[RWS]:.+')
+local mode = string.match(lock_key, 'lock:.+:([RWS]):.+')
+local owner = string.match(lock_key, 'lock:.+:[RWS]:(.+)')
 local retval = redis.call('get', lock_key)
 if retval == false then
     return 'false'
@@ -90,6 +233,10 @@ else
         redis.call('del', lock_key)
         redis.call('srem', rsrc_key, mode..':'..owner)
         redis.call('srem', owner_key, mode..':'..name)
+        redis.call('zrem', otime_key, mode..':'..name)
+        if mode == 'W' then
+            redis.call('incr', ver_key)
+        end
     else
         rcnt = rcnt - 1
         redis.call('set', lock_key, rcnt..':'..time)
@@ -98,29 +245,116 @@ end
 return 'true'
 """
 
-
-# Looks dirty, but OK
-# Compare two time strings given in format of 'sec.usec'
-def _cmp_time(left, right):
-    # Compare seconds part numerically (30 > 4)
-    left_sec = int(re.match(r'(.+)\..+', left).group(1))
-    right_sec = int(re.match(r'(.+)\..+', right).group(1))
-    if left_sec < right_sec:
+# atomic:
+# - delete all locks and grants of owner
+# - delete owner, otime, wait, prio and site of owner
+# Accesses are read by client first, so keys of their locks and
+# resources are given as KEYS (rsrc, lock, ver for each access following
+# keys of owner).  Returns -1 if accesses changed since, to read again.
+_UNLOCK_ALL_SCRIPT = """\
+local owner_key = KEYS[1]
+local owner = ARGV[1]
+local count = #ARGV - 1
+if redis.call('scard', owner_key) ~= count then
+    return -1
+end
+for i = 1, count do
+    if redis.call('sismember', owner_key, ARGV[i + 1]) == 0 then
         return -1
-    elif left_sec == right_sec:
-        # Comapre sub-seconds part also numerically
+    end
+end
+for i = 1, count do
+    local mode = string.sub(ARGV[i + 1], 1, 1)
+    local rsrc_key = KEYS[3 * i + 3]
+    local lock_key = KEYS[3 * i + 4]
+    local ver_key = KEYS[3 * i + 5]
+    redis.call('del', lock_key)
+    redis.call('srem', rsrc_key, mode..':'..owner)
+    if mode == 'W' then
+        redis.call('incr', ver_key)
+    end
+end
+redis.call('del', owner_key, KEYS[2], KEYS[3], KEYS[4], KEYS[5])
+return count
+"""
+
+# Asks owners keeping grants conflicting with mode to give them up, as
+# lock script does for first attempt.  Used when conflict cache fails
+# request without lock script.
+# KEYS: rsrc, sticky
+# ARGV: mode, owner
+_REVOKE_SCRIPT = """\
+local name = string.match(KEYS[1], 'rsrc:(.+)')
+local mode, owner = ARGV[1], ARGV[2]
+local count = 0
+for i, grant in ipairs(redis.call('smembers', KEYS[1])) do
+    local grant_mode = string.match(grant, '([RWS]):.+')
+    local grant_owner = string.match(grant, '[RWS]:(.+)')
+    if grant_owner ~= owner and
+            not (grant_mode == mode and mode ~= 'W') and
+            redis.call('sismember', KEYS[2], grant_owner) == 1 then
+        redis.call('publish', 'revoke:'..grant_owner, name)
+        count = count + 1
+    end
+end
+return count
+"""
+
+
+# Lock time in integer microseconds
+# Accepts also 'sec.usec' format written by older clients
+def _time_usec(time_str):
+    sec, dot, usec = time_str.partition('.')
+    if dot:
         # When input is '0.30' and '0.4' means
         # not 0.30s and 0.4s, but 30us 4us
-        left_usec = int(re.match(r'.+\.(.+)', left).group(1))
-        right_usec = int(re.match(r'.+\.(.+)', right).group(1))
-        if left_usec < right_usec:
-            return -1
-        elif left_usec == right_usec:
-            return 0
-        else:
-            return 1
-    else:
-        return 1
+        return int(sec) * 1000000 + int(usec)
+    return int(time_str)
+
+
+# Compare two time strings given in format of 'usec' or 'sec.usec'
+def _cmp_time(left, right):
+    left_usec, right_usec = _time_usec(left), _time_usec(right)
+    return (left_usec > right_usec) - (left_usec < right_usec)
+
+
+# Estimates redis-server clock without TIME command per lock.
+#
+# Offset between local monotonic clock and redis time is sampled
+# NTP-style: redis time is assumed taken at the middle of the round trip,
+# and the sample with shortest round trip (least uncertainty) is used.
+# Resampled every resync_interval seconds to follow drift.
+class _RedisClock:
+
+    def __init__(self, redis, resync_interval=60.0, samples=3):
+        self.redis = redis
+        self.resync_interval = resync_interval
+        self.samples = samples
+        self._offset = None
+        self._synced = None
+
+    def sync(self):
+        best_rtt = None
+        for i in range(self.samples):
+            t1 = time.monotonic()
+            sec, usec = self.redis.time()
+            t2 = time.monotonic()
+            rtt = t2 - t1
+            if best_rtt is None or rtt < best_rtt:
+                best_rtt = rtt
+                local_usec = int((t1 + t2) * 500000)
+                self._offset = int(sec) * 1000000 + int(usec) - local_usec
+        self._synced = time.monotonic()
+        logger.debug('clock: offset %dus, rtt %dus',
+                     self._offset, int(best_rtt * 1000000))
+
+    def now(self):
+        """Estimated redis time in microseconds"""
+        t = time.monotonic()
+        if self._synced is None or t - self._synced > self.resync_interval:
+            self.sync()
+            t = time.monotonic()
+        return int(t * 1000000) + self._offset
 
 
 # lock result used as token
@@ -128,17 +362,23 @@ class Rwlock:
     """
     Constants for Rwlock
 
-    lock modes: READ, WRITE
+    lock modes: READ, WRITE, COUNTED (shared by holders up to capacity)
 
     special timeout: FOREVER
 
     status: OK, FAIL, TIMEOUT, DEADLOCK,
     and None if not returned from lock method
+
+    token: fencing token of WRITE lock granted, increasing with each
+    write grant of the resource, None otherwise
+
+    stripes: number of stripes of striped resource, 1 if not striped
     """
 
     # lock modes
     READ = 'R'
     WRITE = 'W'
+    COUNTED = 'S'
 
     # timeout
     FOREVER = -1
@@ -149,12 +389,17 @@ class Rwlock:
     TIMEOUT = 2
     DEADLOCK = 3
 
+    __slots__ = ('name', 'mode', 'node', 'pid', 'status', 'token',
+                 'stripes')
+
     def __init__(self, name, mode, node, pid):
         self.name = name
         self.mode = mode
         self.node = node
         self.pid = pid
         self.status = None
+        self.token = None
+        self.stripes = 1
 
     def rsrc_key(self):
         return 'rsrc:' + self.name
@@ -162,117 +407,934 @@ class Rwlock:
     def lock_key(self):
         return self.__str__()
 
+    def ver_key(self):
+        return 'ver:' + self.name
+
     def __str__(self):
         return 'lock:' + self.name + ':' + self.mode + ':' + \
             self.node + '/' + self.pid
 
 
-class RwlockClient:
+class Fence:
+    """Fencing token check on storage side
+
+    Remembers highest token admitted for each resource, so writes by a
+    holder who lost its WRITE lock meanwhile (to gc after a pause, for
+    example) are rejected by comparing tokens, without asking lock
+    server.
+    """
+
+    def __init__(self):
+        self._tokens = dict()
+        self._mutex = threading.Lock()
+
+    def admit(self, name, token):
+        """Checks token of a write to resource and remembers it
+
+        returns true if token is not older than any admitted before
+        """
+        if token is None:
+            return False
+        with self._mutex:
+            if token < self._tokens.get(name, 0):
+                return False
+            self._tokens[name] = token
+            return True
+
+
+# Client-side cache of resources known to be held in a conflicting mode.
+#
+# Filled when try-lock (timeout=0) fails, and consulted by later try-locks
+# so they can fail without a round trip.  Entries are invalidated by redis
+# client tracking: a dedicated connection enables broadcasting tracking
+# for the 'rsrc:' prefix, redirected to itself and subscribed to the
+# '__redis__:invalidate' channel, so any change of rsrc:{name} drops the
+# entry of name.  A stale entry only makes try-lock fail spuriously, never
+# grants a lock, and ttl bounds that staleness in case a notification is
+# lost.  Tracking is enabled again when the connection is reconnected,
+# and entries cached before are dropped.  Requires redis 6 or later.
+#
+# Request failed by an entry is not seen by lock script, so owners
+# keeping grants (linger) are asked to give them up by the client, once
+# for each entry.
+class _ConflictCache:
+
+    _INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+    _CONNECTION_KWARGS = frozenset((
+        'host', 'port', 'path', 'db', 'username', 'password',
+        'credential_provider', 'socket_timeout', 'socket_connect_timeout',
+        'socket_keepalive', 'socket_keepalive_options', 'retry_on_timeout',
+        'retry_on_error', 'retry', 'encoding', 'encoding_errors',
+        'health_check_interval', 'protocol', 'ssl_keyfile', 'ssl_certfile',
+        'ssl_cert_reqs', 'ssl_ca_certs', 'ssl_ca_data', 'ssl_ca_path',
+        'ssl_check_hostname', 'ssl_password'))
+
+    def __init__(self, redis, ttl=1.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = dict()  # name -> (mode, expire)
+        self._pending = dict()  # name -> token
+        self._notified = set()  # names of entries revoke asked for
+        self._running = True
+        # Invalidation messages are delivered as pubsub messages only with
+        # RESP2, so make sure the listener does not negotiate RESP3.
+        # Only arguments to reach the same server are copied, others
+        # differ by redis-py version and are not for a pubsub connection
+        pool = redis.connection_pool
+        kwargs = dict((k, v) for k, v in pool.connection_kwargs.items()
+                      if k in self._CONNECTION_KWARGS)
+        if 'protocol' in kwargs:
+            kwargs['protocol'] = 2
+        self._pubsub = _TrackingPubSub(ConnectionPool(
+            connection_class=pool.connection_class, **kwargs), self)
+        self._pubsub.execute_command('CLIENT', 'ID')
+        client_id = self._pubsub.parse_response(block=True)
+        self._pubsub.execute_command(*self._tracking(client_id))
+        self._pubsub.parse_response(block=True)
+        self._pubsub.subscribe(self._INVALIDATE_CHANNEL)
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _tracking(client_id):
+        return ('CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id,
+                'BCAST', 'PREFIX', 'rsrc:')
+
+    # Called by pubsub reconnected, before subscribing again
+    def _reconnected(self, connection):
+        connection.send_command('CLIENT', 'ID')
+        client_id = connection.read_response()
+        connection.send_command(*self._tracking(client_id))
+        connection.read_response()
+        # Invalidations lost while disconnected
+        self.invalidate()
+        logger.info('conflict cache: tracking enabled again')
+
+    def begin(self, name):
+        """Marks name as being tried, returns token for add()"""
+        token = object()
+        with self._lock:
+            self._pending[name] = token
+        return token
+
+    def add(self, name, mode, token):
+        """Caches conflict unless name invalidated since begin()"""
+        with self._lock:
+            if self._running and self._pending.get(name) is token:
+                del self._pending[name]
+                self._entries[name] = (mode, time.monotonic() + self.ttl)
+                self._notified.discard(name)
+
+    def conflicts(self, name, mode):
+        """Whether locking name with mode is known to fail"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False
+            failed_mode, expire = entry
+            if time.monotonic() > expire:
+                del self._entries[name]
+                self._notified.discard(name)
+                return False
+        # Any failure means someone holds it, conflicting with WRITE.
+        # Failed READ means a writer or counted holders, conflicting with
+        # READ, too.  Failed WRITE may be due to readers only, and failed
+        # COUNTED to capacity only, so other modes can be granted.
+        return mode == Rwlock.WRITE or failed_mode == mode == Rwlock.READ
+
+    def notify(self, name):
+        """Whether holders of name should be asked to give up grants kept,
+        true once for each entry"""
+        with self._lock:
+            if name not in self._entries or name in self._notified:
+                return False
+            self._notified.add(name)
+            return True
+
+    def invalidate(self, names=None):
+        """Drops entries for names, or everything if names is None"""
+        with self._lock:
+            if names is None:
+                self._entries.clear()
+                self._pending.clear()
+                self._notified.clear()
+                return
+            for name in names:
+                self._entries.pop(name, None)
+                self._pending.pop(name, None)
+                self._notified.discard(name)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._pubsub.close()
+
+    def _listen(self):
+        try:
+            while self._running:
+                message = self._pubsub.get_message(timeout=0.1)
+                if message is None or message['type'] != 'message':
+                    continue
+                keys = message['data']
+                if isinstance(keys, list):
+                    self.invalidate([key.decode()[len('rsrc:'):]
+                                     for key in keys])
+                else:
+                    self.invalidate()
+        except Exception as e:
+            # Without notifications entries can not be trusted anymore
+            logger.warning('conflict cache disabled: %s', e)
+        self._running = False
+        self.invalidate()
+
+
+# Pubsub enabling tracking of its connection again when reconnected
+class _TrackingPubSub(PubSub):
+
+    def __init__(self, connection_pool, cache):
+        super().__init__(connection_pool)
+        self.cache = cache
+
+    def on_connect(self, connection):
+        self.cache._reconnected(connection)
+        super().on_connect(connection)
+
+
+# Grants kept after unlock for a linger period (lock caching).
+#
+# Unlock of the last reference keeps the grant in redis-server, so the
+# same process locking it again within linger costs no round trip.
+# Owners keeping grants are listed in 'sticky' set.  Lock script
+# publishes resource name on 'revoke:{owner}' channel of each of them
+# blocking the first attempt of a request, and a listener thread
+# subscribed to it releases the kept grants of the name, or marks the
+# name to be released for real on unlock if the grant is in use.  Expired
+# grants are released by the listener, too.  Releases are done out of
+# the internal lock, as they commute with grants made meanwhile.
+#
+# held   = (name, mode) -> number of references locked through client,
+#          same as ref-count in redis-server
+# sticky = (name, mode) -> (expire, token) kept with ref-count 1
+class _StickyGrants:
+
+    def __init__(self, backend, owner, linger):
+        self.backend = backend
+        self.owner = owner
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._held = dict()
+        self._sticky = dict()
+        self._revoked = dict()  # name -> expire
+        self._running = True
+        self._pubsub = backend.redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe('revoke:' + owner)
+        backend.redis.sadd('sticky', owner)
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def take(self, name, mode):
+        """Takes kept grant back in use, returns (expire, token) of it,
+        None if not kept"""
+        with self._lock:
+            entry = self._sticky.pop((name, mode), None)
+            if entry is not None:
+                self._held[(name, mode)] = 1
+            return entry
+
+    def acquired(self, name, mode):
+        with self._lock:
+            self._held[(name, mode)] = self._held.get((name, mode), 0) + 1
+
+    def keep(self, name, mode, token):
+        """Keeps grant instead of releasing the last reference,
+        returns True if kept, False if already kept (nothing to unlock),
+        None if caller must release it"""
+        with self._lock:
+            count = self._held.get((name, mode))
+            if count is None:
+                return False if (name, mode) in self._sticky else None
+            if count > 1:
+                self._held[(name, mode)] = count - 1
+                return None
+            del self._held[(name, mode)]
+            if self._revoked.pop(name, 0) > time.monotonic() or \
+                    not self._running:
+                return None
+            self._sticky[(name, mode)] = (time.monotonic() + self.linger,
+                                          token)
+            return True
+
+    def clear(self):
+        """Forgets all grants, released by caller, returns number of
+        grants kept"""
+        with self._lock:
+            count = len(self._sticky)
+            self._held.clear()
+            self._sticky.clear()
+            self._revoked.clear()
+            return count
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._pubsub.close()
+        self._release(lambda name, expire: True)
+        self.backend.redis.srem('sticky', self.owner)
+
+    # Releases kept grants matching func(name, expire)
+    def _release(self, func):
+        with self._lock:
+            released = [key for key, (expire, token) in self._sticky.items()
+                        if func(key[0], expire)]
+            for key in released:
+                del self._sticky[key]
+        if released:
+            self.backend.release_many(released, self.owner)
+        return released
+
+    def _revoke(self, name):
+        if self._release(lambda grant_name, expire: grant_name == name):
+            return
+        with self._lock:
+            if any(key[0] == name for key in self._held):
+                self._revoked[name] = time.monotonic() + self.linger
+
+    def _listen(self):
+        try:
+            while self._running:
+                message = self._pubsub.get_message(timeout=0.05)
+                if message is not None and message['type'] == 'message':
+                    self._revoke(message['data'].decode())
+                now = time.monotonic()
+                self._release(lambda name, expire: expire <= now)
+                with self._lock:
+                    for name in [name for name, expire
+                                 in self._revoked.items() if expire <= now]:
+                        del self._revoked[name]
+        except Exception as e:
+            # Without notifications kept grants would block others
+            logger.warning('sticky grants disabled: %s', e)
+            self._running = False
+            try:
+                self._release(lambda name, expire: True)
+            except Exception:
+                pass
+
+
+# Unlocks queued for a background flusher, not to block the caller.
+#
+# Flusher takes whatever queued so far, up to batch, and releases them in
+# one pipelined round trip.  Queue is bounded, unlock blocks while full.
+# Results are not returned to unlock, only unlocks that found nothing to
+# release are counted for flush.
+#
+# Lock waits for queued unlocks of the same names only, and for all of
+# them before it waits for others, so the owner never waits for others
+# or looks for deadlocks holding a lock already unlocked.
+class _DeferredUnlocks:
+
+    def __init__(self, backend, owner, maxsize, batch=128):
+        self.backend = backend
+        self.owner = owner
+        self.batch = batch
+        self._queue = queue.Queue(maxsize)
+        self._done = threading.Condition()
+        self._pending = dict()  # name -> number of queued unlocks
+        self._failed = 0
+        self._thread = threading.Thread(target=self._flush_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def put(self, name, mode):
+        with self._done:
+            self._pending[name] = self._pending.get(name, 0) + 1
+        self._queue.put((name, mode))
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def join(self, names=None):
+        """Waits until queued unlocks of names, or all, done"""
+        if names is None:
+            self._queue.join()
+            return
+        with self._done:
+            self._done.wait_for(
+                lambda: not any(name in self._pending for name in names))
+
+    def flush(self):
+        """Waits until all queued unlocks done, returns number of them
+        found nothing to unlock since last flush"""
+        self._queue.join()
+        with self._done:
+            failed, self._failed = self._failed, 0
+        return failed
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _flush_forever(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            locks = [item for item in batch if item is not None]
+            try:
+                results = self.backend.release_many(locks, self.owner) \
+                    if locks else list()
+                failed = results.count(False)
+            except Exception as e:
+                # Locks left are released by unlock_all or gc
+                logger.warning('deferred unlock: %s', e)
+                failed = len(locks)
+            with self._done:
+                self._failed += failed
+                for name, mode in locks:
+                    if self._pending[name] > 1:
+                        self._pending[name] -= 1
+                    else:
+                        del self._pending[name]
+                self._done.notify_all()
+            for item in batch:
+                self._queue.task_done()
+            if len(locks) < len(batch):
+                return
+
+
+# Watchdog of locks held too long (opt-in).
+#
+# Each grant records the call site out of this package and the thread
+# of lock.  Background thread checks holds every threshold / 4, and once
+# per grant held longer than threshold:
+#
+# - writes the site to 'site:{owner}' HASH field '{mode}:{name}', shown
+#   by holders to others blocked, removed by unlock
+# - reports name, mode, seconds held, site and current stack of the
+#   thread to callback, or logs warning without callback
+class _Watchdog:
+
+    # With separator, not to match siblings like redisrwlock_tests/
+    _package_dir = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+    def __init__(self, backend, owner, threshold, callback=None):
+        self.backend = backend
+        self.owner = owner
+        self.threshold = threshold
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._holds = dict()  # (name, mode) -> [count, since, site,
+                              #                  thread, reported]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    # Innermost frame of caller out of this package
+    def _site(self):
+        frame = sys._getframe(2)
+        while frame is not None and \
+                frame.f_code.co_filename.startswith(self._package_dir):
+            frame = frame.f_back
+        if frame is None:
+            return '?'
+        return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno,
+                                frame.f_code.co_name)
+
+    def acquired(self, name, mode):
+        with self._lock:
+            hold = self._holds.get((name, mode))
+            if hold is not None:
+                hold[0] += 1
+                return
+            self._holds[(name, mode)] = [1, time.monotonic(), self._site(),
+                                         threading.current_thread(), False]
+
+    def released(self, name, mode):
+        with self._lock:
+            hold = self._holds.get((name, mode))
+            if hold is None:
+                return
+            if hold[0] > 1:
+                hold[0] -= 1
+                return
+            del self._holds[(name, mode)]
+        if hold[4]:
+            self.backend.annotate(self.owner, name, mode, None)
+
+    def clear(self):
+        """Forgets all holds, annotations removed by release_all"""
+        with self._lock:
+            self._holds.clear()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 4):
+            now = time.monotonic()
+            with self._lock:
+                late = [(key, list(hold)) for key, hold in self._holds.items()
+                        if not hold[4] and now - hold[1] > self.threshold]
+                for key, hold in late:
+                    self._holds[key][4] = True
+            for (name, mode), (count, since, site, thread, _) in late:
+                try:
+                    self._report(name, mode, now - since, site, thread)
+                except Exception as e:
+                    logger.warning('watchdog: %s', e)
+
+    def _report(self, name, mode, held, site, thread):
+        self.backend.annotate(self.owner, name, mode,
+                              '%s [%s]' % (site, thread.name))
+        frame = sys._current_frames().get(thread.ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        if self.callback is not None:
+            self.callback(name, mode, held, site, stack)
+        else:
+            logger.warning('%s held %s %.3f s, locked at %s [%s]\n%s',
+                           self.owner, mode + ':' + name, held, site,
+                           thread.name, stack)
+
+
+# Whether lock of mode conflicts with lock of grant_mode held by other.
+# Counted locks do not conflict each other, limited by capacity instead.
+def _conflicts(mode, grant_mode):
+    if mode == grant_mode:
+        return mode == Rwlock.WRITE
+    return True
+
+
+# Waitees among owners blocking resources, for wait set of an owner
+# waiting for any of them.
+#
+# blockers = for each resource, (conflicting owners, counted holders)
+# waiting  = owner -> whether owner is waiting
+#
+# Counted holders block only at capacity, and any of them releasing makes
+# room, so waiting for them counts only when all of them are waiting.
+# Likewise any of resources granted is enough, so waiting counts only
+# when every resource is blocked by some waiting owner.
+#
+# returns alternatives, set of waitees for each resource, empty list if
+# not waiting
+def _blocking_waitees(blockers, waiting, capacity):
+    alternatives = list()
+    for conflicts, holders in blockers:
+        if len(holders) < capacity or \
+                not all(waiting[holder] for holder in holders):
+            holders = list()
+        blocking = set(grant_owner for grant_owner in conflicts + holders
+                       if waiting[grant_owner])
+        if not blocking:
+            return list()
+        alternatives.append(blocking)
+    return alternatives
+
+
+_DUMMY_SEED_WAITEE = '__dummy_seed_waitee__'
+
+
+# Members of wait set for alternatives, waitees of one resource as is,
+# of more resources prefixed with index of resource, '{index}|{owner}'
+def _wait_members(alternatives):
+    if len(alternatives) == 1:
+        return set(alternatives[0])
+    return set('%d|%s' % (index, waitee)
+               for index, waitees in enumerate(alternatives)
+               for waitee in waitees)
+
+
+# Alternatives of wait set members, list of set of waitees
+def _wait_alternatives(members):
+    alternatives = dict()
+    for member in members:
+        if member == _DUMMY_SEED_WAITEE:
+            continue
+        index, bar, waitee = member.partition('|')
+        if not bar or not index.isdigit():
+            index, waitee = '', member
+        alternatives.setdefault(index, set()).add(waitee)
+    return list(alternatives.values())
+
+
+# Deadlock detect - cycle detect in wait-for graph
+# DFS checking rediscovering of vertex in path.  Owner waiting for any
+# of alternatives is blocked only when each of them has a waitee blocked
+# by cycle, so cycle through one alternative is not deadlock while
+# another can be granted.
+#
+# waitees = owner -> alternatives of owner
+#
+# returns cycles blocking current, list of path from current to the
+# waitor of one in path, None if not blocked
+def _blocking_cycles(current, waitees, visited, path):
+    if current in path:
+        logger.debug("_cyclic: [%s]", '->'.join(path))
+        return [list(path)]
+    path.append(current)
+    cycles = list()
+    for alternative in waitees(current):
+        for adj in alternative:
+            found = None if adj in visited else \
+                _blocking_cycles(adj, waitees, visited, path)
+            if found:
+                cycles += found
+                break
+        else:
+            cycles = None
+            break
+    path.pop()
+    if not cycles:
+        visited.add(current)
+        return None
+    return cycles
+
+
+# Owners of connected clients, named 'redisrwlock:{owner}' by register
+def _active_owners(redis):
+    prefix = 'redisrwlock:'
+    return set(client['name'][len(prefix):]
+               for client in redis.client_list()
+               if client['name'].startswith(prefix))
+
+
+# Interface of lock backend
+#
+# RwlockClient keeps lock semantics (retry, timeout, deadlock detection
+# and victim selection) and asks backend for primitive operations on the
+# shared lock table.  Owner is '{node}/{pid}' string, time is integer
+# microseconds of the clock shared by all clients of the backend.
+class Backend:
+
+    # Whether waitors given priority or deadline are queued by rank
+    ranked = False
+
+    def register(self, owner):
+        """Makes owner known as active to gc"""
+        raise NotImplementedError
+
+    def register_proxy(self, agent, owner):
+        """Makes owner proxied by agent, an owner registered, known as
+        active to gc while agent is active"""
+        raise NotImplementedError
+
+    def unregister_proxy(self, agent, owner):
+        raise NotImplementedError
+
+    def now(self):
+        """Current time in microseconds"""
+        raise NotImplementedError
+
+    def grant(self, name, mode, owner, time, capacity=1, rank=None,
+              notify=True):
+        """Atomically grants lock if no conflicting lock of others,
+        and for COUNTED mode, others hold less than capacity,
+        returns True if granted, fencing token (positive integer) for
+        WRITE, False if not.  Raises ValueError if others hold COUNTED
+        with other capacity, for backends storing capacity.  When rank
+        given, not granted while waitor of conflicting mode with lower
+        rank is queued, if the backend supports queue.  When notify,
+        owners keeping grants that block it are asked to give them up,
+        if the backend supports kept grants"""
+        raise NotImplementedError
+
+    def release(self, name, mode, owner):
+        """Atomically releases lock, returns False if not granted"""
+        raise NotImplementedError
+
+    def release_all(self, owner):
+        """Atomically releases all locks and waits of owner,
+        returns number of locks released"""
+        raise NotImplementedError
+
+    def release_many(self, locks, owner=None):
+        """Releases locks, list of (name, mode) of owner, or of
+        (name, mode, owner) if owner not given, each atomically,
+        returns list of results of release"""
+        return [self.release(lock[0], lock[1],
+                             lock[2] if owner is None else owner)
+                for lock in locks]
+
+    def grant_many(self, requests):
+        """Grants requests, list of (name, mode, owner, time, capacity,
+        notify, rank), each atomically, returns list of results of grant,
+        ValueError instead of raised"""
+        results = list()
+        for name, mode, owner, time, capacity, notify, rank in requests:
+            try:
+                results.append(self.grant(name, mode, owner, time, capacity,
+                                          rank, notify))
+            except ValueError as e:
+                results.append(e)
+        return results
+
+    def grant_any(self, names, mode, owner, time, capacity=1, offset=0,
+                  rank=None, notify=True):
+        """Grants lock on first available of names, tried in order from
+        offset, returns index of name granted and fencing token (None
+        unless WRITE), None if none granted"""
+        for i in range(len(names)):
+            index = (offset + i) % len(names)
+            granted = self.grant(names[index], mode, owner, time, capacity,
+                                 rank, notify)
+            if granted:
+                return index, None if granted is True else granted
+        return None
+
+    def waitset(self, owner, names, mode, capacity=1, rank=None,
+                urgency=None):
+        """Updates wait set of owner waiting for any of names with
+        waiting owners of conflicting locks (and conflicting waitors
+        queued with lower rank), returns list of waitees for each of
+        names, empty if some of names not blocked by waiting owners.
+        When urgency, (priority, deadline), given, queues owner with
+        rank, if the backend supports queue"""
+        raise NotImplementedError
+
+    def waitees(self, owner):
+        """Alternatives owner waits for any of, list of set of owners
+        blocking each, may lag behind if read from replica"""
+        raise NotImplementedError
+
+    def confirm_cycle(self, path):
+        """Whether each waitor of path still waits for the next, and
+        the last for one of path, as read from primary"""
+        return True
+
+    def clear_wait(self, owner):
+        raise NotImplementedError
+
+    def oldest_grant_time(self, owner):
+        """Time of oldest lock granted to owner, None if no lock"""
+        raise NotImplementedError
+
+    def urgency(self, owner):
+        """Priority and deadline of waiting owner, (0, None) if not
+        given"""
+        return 0, None
+
+    def gc(self):
+        """Removes locks and waits of owners no more active,
+        returns (lock count, wait count, owner count) removed"""
+        raise NotImplementedError
+
+    def version(self, name):
+        """Version of resource, odd while write lock granted"""
+        raise NotImplementedError
+
+    def annotate(self, owner, name, mode, site):
+        """Notes call site of lock held by owner, removes note if site
+        is None, for backends supporting notes"""
+        pass
+
+    def holders(self, name):
+        """Holders of resource, list of (mode, owner, site noted or
+        None)"""
+        raise NotImplementedError
+
+    def revoke(self, name, mode, owner):
+        """Asks owners keeping grants of name conflicting with mode to
+        give them up, for backends supporting kept grants"""
+        pass
+
+    def clear_all(self):
+        """Removes everything, returns True if anything removed"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
 
-    def __init__(self, redis=None, node=None, pid=None):
+
+class RedisBackend(Backend):
+    """Lock table stored in redis-server (default backend)
+
+    When replica given, read-only scans of gc and memory_usage, and wait
+    sets walked by deadlock detection are read from replica.  Anything
+    decided by them is read again from primary before acted on, as
+    replica may lag behind.
+    """
+
+    ranked = True
+
+    def __init__(self, redis=None, replica=None):
         if redis is None:
             redis = StrictRedis()
-        if node is None:
-            node = socket.gethostname()
-        if pid is None:
-            pid = os.getpid()
         self.redis = redis
-        self.node = node
-        self.pid = str(pid)
-        self.redis.client_setname('redisrwlock:' + self.node + '/' + self.pid)
+        self.replica = redis if replica is None else replica
+        self._clock = _RedisClock(redis)
+        # EVALSHA, not to send script text every call
+        self._lock_script = redis.register_script(_LOCK_SCRIPT)
+        self._lock_any_script = redis.register_script(_LOCK_ANY_SCRIPT)
+        self._unlock_script = redis.register_script(_UNLOCK_SCRIPT)
+        self._unlock_all_script = redis.register_script(_UNLOCK_ALL_SCRIPT)
+        self._revoke_script = redis.register_script(_REVOKE_SCRIPT)
+        self._owner_keys = dict()
+        self._queued = dict()  # owner -> (names, entry) queued by waitset
 
-    def get_owner(self):
-        return self.node + '/' + self.pid
+    def register(self, owner):
+        self.redis.client_setname('redisrwlock:' + owner)
 
-    def owner_key(self):
-        return 'owner:' + self.get_owner()
+    def register_proxy(self, agent, owner):
+        self.redis.sadd('agent:' + agent, owner)
 
-    def redis_time(self):
-        sec, usec = self.redis.time()
-        return str(sec) + '.' + str(usec)
+    def unregister_proxy(self, agent, owner):
+        self.redis.srem('agent:' + agent, owner)
+
+    def now(self):
+        return self._clock.now()
+
+    # Encoded owner_key, otime_key and wait_key, built once per owner
+    def _keys(self, owner):
+        keys = self._owner_keys.get(owner)
+        if keys is None:
+            if len(self._owner_keys) >= 1024:
+                self._owner_keys.clear()
+            encoded = owner.encode()
+            keys = (b'owner:' + encoded, b'otime:' + encoded,
+                    b'wait:' + encoded)
+            self._owner_keys[owner] = keys
+        return keys
 
     # Avoid use of 'KEYS'
     # return scan_iter with specified matching pattern and count=128
     # I just assume key length 32 bytes and 4K bytes unit i/o
-    def _redis_scan_iter(self, pattern):
-        return self.redis.scan_iter(match=pattern, count=128)
+    def _redis_scan_iter(self, pattern, redis=None):
+        redis = self.redis if redis is None else redis
+        return redis.scan_iter(match=pattern, count=128)
 
-    def lock(self, name, mode, timeout=0, retry_interval=0.1):
-        """Locks on a named resource with mode in timeout.
+    def grant(self, name, mode, owner, time, capacity=1, rank=None,
+              notify=True):
+        args = (time, capacity, int(notify))
+        if rank is not None:
+            args += (rank,)
+        retval = self._granted(name, self._lock_script(
+            self._lock_keys(name, mode, owner), args))
+        if isinstance(retval, ValueError):
+            raise retval
+        return retval
 
-        Specify timeout 0 (default) for no-wait, no-retry and
-        timeout FOREVER waits until lock success or deadlock.
+    def _lock_keys(self, name, mode, owner):
+        owner_key, otime_key, wait_key = self._keys(owner)
+        return ('rsrc:' + name, 'lock:' + name + ':' + mode + ':' + owner,
+                owner_key, otime_key, 'ver:' + name, 'queue:' + name,
+                'sticky', 'cap:' + name)
 
-        When requested lock is not available, this method sleep
-        given retry_interval seconds and retry until lock success,
-        deadlock or timeout.
+    # Result of lock script, ValueError if capacity differs
+    @staticmethod
+    def _granted(name, retval):
+        if isinstance(retval, int):
+            if retval < 0:
+                return ValueError('capacity differs from holders of ' + name)
+            return retval
+        return retval == b'true'
 
-        returns rwlock, check status field to know lock obtained or failed
-        """
-        t1 = t2 = time.monotonic()
-        redis_time = self.redis_time()
-        rwlock = Rwlock(name, mode, self.node, self.pid)
-        while timeout == Rwlock.FOREVER or t2 - t1 <= timeout:
-            retval = self.redis.eval(
-                _LOCK_SCRIPT, 3,
-                rwlock.rsrc_key(), rwlock.lock_key(), self.owner_key(),
-                redis_time)
-            lock_ok = True if retval == b'true' else False
-            if lock_ok:
-                rwlock.status = Rwlock.OK
-                break
-            elif timeout == 0:
-                rwlock.status = Rwlock.FAIL
-                break
-            elif self._deadlock(name, mode):
-                rwlock.status = Rwlock.DEADLOCK
-                break
-            time.sleep(retry_interval)
-            t2 = time.monotonic()
-        else:
-            rwlock.status = Rwlock.TIMEOUT
-        self.redis.delete('wait:' + self.get_owner())
-        return rwlock
+    # One round trip for all
+    def grant_many(self, requests):
+        pipe = self.redis.pipeline(transaction=False)
+        for name, mode, owner, time, capacity, notify, rank in requests:
+            args = (time, capacity, int(notify))
+            if rank is not None:
+                args += (rank,)
+            self._lock_script(self._lock_keys(name, mode, owner), args,
+                              client=pipe)
+        return [self._granted(request[0], retval)
+                for request, retval in zip(requests, pipe.execute())]
 
-    def unlock(self, rwlock):
-        """Unlocks rwlock previously acquired with lock method
+    def grant_any(self, names, mode, owner, time, capacity=1, offset=0,
+                  rank=None, notify=True):
+        keys = list(self._keys(owner)[:2]) + ['sticky']
+        for name in names:
+            keys += ['rsrc:' + name, 'lock:' + name + ':' + mode + ':' + owner,
+                     'ver:' + name, 'queue:' + name, 'cap:' + name]
+        args = (time, capacity, offset, int(notify))
+        if rank is not None:
+            args += (rank,)
+        retval = self._lock_any_script(keys, args)
+        if retval == -1:
+            return None
+        if retval[1] < 0:
+            raise ValueError('capacity differs from holders of ' +
+                             names[retval[0]])
+        return retval[0], retval[1] or None
 
-        returns true for successfull unlock
-        false if there is no such lock to unlock
-        """
-        retval = self.redis.eval(
-            _UNLOCK_SCRIPT, 3,
-            rwlock.rsrc_key(), rwlock.lock_key(), self.owner_key())
+    def release(self, name, mode, owner):
+        owner_key, otime_key, wait_key = self._keys(owner)
+        retval = self._unlock_script(
+            ('rsrc:' + name, 'lock:' + name + ':' + mode + ':' + owner,
+             owner_key, otime_key, 'ver:' + name))
         return retval == b'true'
 
-    def gc(self):
-        """Removes stale locks, waits, and owner itself created by
-        crashed/exit clients without unlocking or proper cleanup.
+    def release_all(self, owner):
+        owner_key, otime_key, wait_key = self._keys(owner)
+        while True:
+            accesses = [access.decode() for access
+                        in self.redis.smembers(owner_key)]
+            keys = [owner_key, otime_key, wait_key, 'prio:' + owner,
+                    'site:' + owner]
+            for access in accesses:
+                mode, name = access[:1], access[2:]
+                keys += ['rsrc:' + name,
+                         'lock:' + name + ':' + mode + ':' + owner,
+                         'ver:' + name]
+            count = self._unlock_all_script(keys, [owner] + accesses)
+            if count >= 0:
+                return count
 
-        Used by garbage collecting daemon or monitor
-        """
+    # One round trip for all
+    def release_many(self, locks, owner=None):
+        pipe = self.redis.pipeline(transaction=False)
+        for lock in locks:
+            name, mode = lock[:2]
+            lock_owner = lock[2] if owner is None else owner
+            owner_key, otime_key, wait_key = self._keys(lock_owner)
+            self._unlock_script(
+                ('rsrc:' + name,
+                 'lock:' + name + ':' + mode + ':' + lock_owner,
+                 owner_key, otime_key, 'ver:' + name), client=pipe)
+        return [retval == b'true' for retval in pipe.execute()]
+
+    def gc(self):
         # We get owners and waitors before active client list
         # Otherwise, we may mistakenly remove some lock, owner, or wait
         # made by last clients not included in the client list
         #
         # And we avoid scan of lock list
-        # by exploiting owner -> { set of access }
+        # by exploiting owner -> { set of access },
+        # released in order of lock time by otime index
         #
         # (1) find out stale owners and waitors
         # (2) delete locks and grants of stale owners
-        # (3) delete stale waits
-        # (4) delete stale owners
-        owners = set()
-        for owner_key in self._redis_scan_iter('owner:*'):
-            owners.add(re.match(r'owner:(.+)', owner_key.decode()).group(1))
-        waitors = set()
-        for wait_key in self._redis_scan_iter('wait:*'):
-            waitors.add(re.match(r'wait:(.+)', wait_key.decode()).group(1))
-        active_clients = set()
-        for client in self.redis.client_list():
-            m = re.match(r'redisrwlock:(.+)', client['name'])
-            if m:
-                active_clients.add(m.group(1))
+        # (3) delete stale waits, and queue entries of stale waitors
+        # (4) delete stale owners, and stale owners of sticky set
+        #
+        # Scans may read replica.  Lagging replica shows older keys, so
+        # still taken before client list, and accesses and agent sets
+        # are read from primary.
+        owners = set(owner_key.decode()[len('owner:'):] for owner_key
+                     in self._redis_scan_iter('owner:*', self.replica))
+        waitors = set(wait_key.decode()[len('wait:'):] for wait_key
+                      in self._redis_scan_iter('wait:*', self.replica))
+        agents = set(agent_key.decode()[len('agent:'):] for agent_key
+                     in self._redis_scan_iter('agent:*', self.replica))
+        queued = dict()  # queue_key -> entries
+        for queue_key in self._redis_scan_iter('queue:*', self.replica):
+            queued[queue_key] = self.replica.zrange(queue_key, 0, -1)
+        sticky = set(owner.decode() for owner
+                     in self.replica.smembers('sticky'))
+        active_clients = _active_owners(self.redis)
+        # Owners proxied by active agents are active, too
+        for agent in agents:
+            if agent in active_clients:
+                for owner in self.redis.smembers('agent:' + agent):
+                    active_clients.add(owner.decode())
+            else:
+                self.redis.delete('agent:' + agent)
+                logger.info('gc: ' + 'agent:' + agent)
         # (1) Find out stale owners and waits
         stale_owners = set()
         for owner in owners:
@@ -283,98 +1345,797 @@ class RwlockClient:
             if waitor not in active_clients:
                 stale_waitors.add(waitor)
         # (2) Gc locks and grants of stale owners
+        # Deletes are pipelined per owner, in order of lock time
         stale_lock_count = 0
         for owner in stale_owners:
-            for access in self.redis.smembers('owner:' + owner):
-                m = re.match(r'([RW]):(.+)', access.decode())
-                mode, name = m.group(1, 2)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zrange('otime:' + owner, 0, -1)
+            pipe.smembers('owner:' + owner)
+            accesses, members = pipe.execute()
+            indexed = set(accesses)
+            accesses += [access for access in members
+                         if access not in indexed]
+            for access in accesses:
+                access = access.decode()
+                mode, name = access[:1], access[2:]
                 lock = name + ':' + mode + ':' + owner
-                self.redis.delete('lock:' + lock)
-                self.redis.srem('rsrc:' + name, mode + ':' + owner)
+                pipe.delete('lock:' + lock)
+                pipe.srem('rsrc:' + name, mode + ':' + owner)
+                if mode == Rwlock.WRITE:
+                    pipe.incr('ver:' + name)
                 stale_lock_count += 1
                 logger.info('gc: ' + 'lock:' + lock)
+            pipe.execute()
         # (3) Gc waitors and waitees? of stale owners
         stale_wait_count = 0
         for waitor in stale_waitors:
-            self.redis.delete('wait:' + waitor)
+            self.redis.delete('wait:' + waitor, 'prio:' + waitor)
             stale_wait_count += 1
             logger.info('gc: ' + 'wait:' + waitor)
             # Note: 'SREM' from other waitors having this waitor as member
             # This seems not required, because active waitors rebuild
             # their wait sets when they retry locking.
+        pipe = self.redis.pipeline(transaction=False)
+        for queue_key, entries in queued.items():
+            for entry in entries:
+                if entry.decode()[2:] not in active_clients:
+                    pipe.zrem(queue_key, entry)
+                    logger.info('gc: %s %s', queue_key.decode(),
+                                entry.decode())
+        pipe.execute()
         # (4) Gc stale owners
         stale_owner_count = 0
         for owner in stale_owners:
-            self.redis.delete('owner:' + owner)
+            self.redis.delete('owner:' + owner, 'otime:' + owner,
+                              'site:' + owner)
             stale_owner_count += 1
             logger.info('gc: ' + 'owner:' + owner)
+        stale_sticky = sticky - active_clients
+        if stale_sticky:
+            self.redis.srem('sticky', *stale_sticky)
+        return stale_lock_count, stale_wait_count, stale_owner_count
+
+    # Make sure wait set is up to date before deadlock detection
+    # This could be done in _LOCK_SCRIPT, but here to satisfy redis
+    # EVAL KEYS semantic
+    #
+    # Round trips are pipelined: grants and waitors queued ahead, then
+    # their wait sets, then update of own wait set
+    def waitset(self, owner, names, mode, capacity=1, rank=None,
+                urgency=None):
+        wait_key = self._keys(owner)[2]
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.smembers('rsrc:' + name)
+            if rank is not None:
+                pipe.zrangebyscore('queue:' + name, '-inf', '(' + str(rank))
+        pipe.sadd(wait_key, _DUMMY_SEED_WAITEE)
+        if urgency is not None:
+            # queued after wait set exists, so never seen as left
+            priority, deadline = urgency
+            entry = mode + ':' + owner
+            for name in names:
+                pipe.zadd('queue:' + name, {entry: rank})
+            pipe.set('prio:' + owner, '%d:%s' % (
+                priority, '' if deadline is None else deadline))
+            self._queued[owner] = (names, entry)
+        results = pipe.execute()[:len(names) * (1 if rank is None else 2)]
+        if rank is None:
+            results = [(grants, ()) for grants in results]
+        else:
+            results = zip(results[0::2], results[1::2])
+        blockers, owners = list(), set()
+        for grants, queued in results:
+            conflicts, holders = list(), list()
+            for grant in grants:
+                grant = grant.decode()
+                grant_mode, grant_owner = grant[:1], grant[2:]
+                if grant_owner != owner:
+                    if grant_mode == mode == Rwlock.COUNTED:
+                        holders.append(grant_owner)
+                    elif _conflicts(mode, grant_mode):
+                        conflicts.append(grant_owner)
+            for entry in queued:
+                entry = entry.decode()
+                queued_mode, queued_owner = entry[:1], entry[2:]
+                if queued_owner != owner and _conflicts(mode, queued_mode):
+                    conflicts.append(queued_owner)
+            blockers.append((conflicts, holders))
+            owners.update(conflicts, holders)
+        if not owners:
+            return list()
+        owners = list(owners)
+        for grant_owner in owners:
+            pipe.scard(self._keys(grant_owner)[2])
+        waiting = dict(zip(owners, pipe.execute()))
+        alternatives = _blocking_waitees(blockers, waiting, capacity)
+        # Replaced in MULTI, never seen empty
+        pipe = self.redis.pipeline()
+        pipe.delete(wait_key)
+        pipe.sadd(wait_key, _DUMMY_SEED_WAITEE,
+                  *_wait_members(alternatives))
+        pipe.execute()
+        return [list(waitees) for waitees in alternatives]
+
+    def waitees(self, owner):
+        return _wait_alternatives(
+            member.decode() for member
+            in self.replica.smembers(self._keys(owner)[2]))
+
+    def confirm_cycle(self, path):
+        if self.replica is self.redis:
+            return True
+        pipe = self.redis.pipeline(transaction=False)
+        for waitor in path:
+            pipe.smembers(self._keys(waitor)[2])
+        waits = [set().union(*_wait_alternatives(
+                     member.decode() for member in members))
+                 for members in pipe.execute()]
+        for i in range(len(path) - 1):
+            if path[i + 1] not in waits[i]:
+                return False
+        return not waits[-1].isdisjoint(path)
+
+    def clear_wait(self, owner):
+        queued = self._queued.pop(owner, None)
+        if queued is None:
+            self.redis.delete(self._keys(owner)[2])
+            return
+        names, entry = queued
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(self._keys(owner)[2], 'prio:' + owner)
+        for name in names:
+            pipe.zrem('queue:' + name, entry)
+        pipe.execute()
+
+    def version(self, name):
+        return int(self.redis.get('ver:' + name) or 0)
+
+    def annotate(self, owner, name, mode, site):
+        if site is None:
+            self.redis.hdel('site:' + owner, mode + ':' + name)
+        else:
+            self.redis.hset('site:' + owner, mode + ':' + name, site)
+
+    def revoke(self, name, mode, owner):
+        self._revoke_script(('rsrc:' + name, 'sticky'), (mode, owner))
+
+    def holders(self, name):
+        grants = [grant.decode() for grant
+                  in self.redis.smembers('rsrc:' + name)]
+        pipe = self.redis.pipeline(transaction=False)
+        for grant in grants:
+            pipe.hget('site:' + grant[2:], grant[:1] + ':' + name)
+        return [(grant[:1], grant[2:], site.decode() if site else None)
+                for grant, site in zip(grants, pipe.execute())]
+
+    # Oldest lock access time,
+    # the representative (oldest) lock access time of this waitor
+    def oldest_grant_time(self, owner):
+        owner_key, otime_key, wait_key = self._keys(owner)
+        oldest = self.redis.zrange(otime_key, 0, 0, withscores=True)
+        if oldest:
+            return int(oldest[0][1])
+        # Older clients keep no otime index, read their locks instead.
+        # Empty, too, if DEADLOCK victim unlocked already
+        accesses = [access.decode()
+                    for access in self.redis.smembers(owner_key)]
+        if not accesses:
+            return None
+        pipe = self.redis.pipeline(transaction=False)
+        for access in accesses:
+            pipe.get('lock:' + access[2:] + ':' + access[:1] + ':' + owner)
+        times = [_time_usec(lock.decode().partition(':')[2])
+                 for lock in pipe.execute() if lock is not None]
+        return min(times) if times else None
+
+    def urgency(self, owner):
+        prio = self.redis.get('prio:' + owner)
+        if prio is None:
+            return 0, None
+        priority, deadline = prio.decode().split(':')
+        return int(priority), int(deadline) if deadline else None
+
+    def clear_all(self):
+        count = 0
+        for lock in self._redis_scan_iter('lock:*:[RWS]:*'):
+            logger.debug('_clear_all: ' + lock.decode())
+            count += self.redis.delete(lock.decode())
+        for rsrc in self._redis_scan_iter('rsrc:*'):
+            logger.debug('_clear_all: ' + rsrc.decode())
+            count += self.redis.delete(rsrc.decode())
+        for owner in self._redis_scan_iter('owner:*'):
+            logger.debug('_clear_all: ' + owner.decode())
+            count += self.redis.delete(owner.decode())
+        for otime in self._redis_scan_iter('otime:*'):
+            logger.debug('_clear_all: ' + otime.decode())
+            count += self.redis.delete(otime.decode())
+        for agent in self._redis_scan_iter('agent:*'):
+            logger.debug('_clear_all: ' + agent.decode())
+            count += self.redis.delete(agent.decode())
+        for wait in self._redis_scan_iter('wait:*'):
+            logger.debug('_clear_all: ' + wait.decode())
+            count += self.redis.delete(wait.decode())
+        for queue in self._redis_scan_iter('queue:*'):
+            logger.debug('_clear_all: ' + queue.decode())
+            count += self.redis.delete(queue.decode())
+        for prio in self._redis_scan_iter('prio:*'):
+            logger.debug('_clear_all: ' + prio.decode())
+            count += self.redis.delete(prio.decode())
+        for site in self._redis_scan_iter('site:*'):
+            logger.debug('_clear_all: ' + site.decode())
+            count += self.redis.delete(site.decode())
+        # Versions outlive locks, not counted as leftovers
+        for ver in self._redis_scan_iter('ver:*'):
+            logger.debug('_clear_all: ' + ver.decode())
+            self.redis.delete(ver.decode())
+        for cap in self._redis_scan_iter('cap:*'):
+            logger.debug('_clear_all: ' + cap.decode())
+            self.redis.delete(cap.decode())
+        self.redis.delete('sticky')
+        return True if count > 0 else False
+
+    def memory_usage(self):
+        """returns bytes used by keys of this layout and number of grants"""
+        total, grants = 0, 0
+        for pattern in ('rsrc:*', 'lock:*:[RWS]:*', 'owner:*', 'otime:*'):
+            for key in self._redis_scan_iter(pattern, self.replica):
+                total += self.replica.memory_usage(key, samples=0) or 0
+                if key.startswith(b'lock:'):
+                    grants += 1
+        return total, grants
+
+
+class RwlockClient:
+
+    # Seconds a lock request ages per priority level, and budget of
+    # request without deadline, used to rank waitors.  Clients locking
+    # same resources should agree on them.
+    aging = 1.0
+    budget = 60.0
+
+    def __init__(self, redis=None, node=None, pid=None,
+                 conflict_cache=False, backend=None, tracer=None, linger=0,
+                 defer_unlock=0, replica=None, watchdog=0,
+                 on_long_hold=None):
+        if backend is None:
+            backend = RedisBackend(redis, replica)
+        elif replica is not None:
+            raise ValueError('replica given to backend, not client')
+        if node is None:
+            node = socket.gethostname()
+        if pid is None:
+            pid = os.getpid()
+        self.backend = backend
+        self.redis = getattr(backend, 'redis', None)
+        self.node = node
+        self.pid = str(pid)
+        self._owner = self.node + '/' + self.pid
+        self._hash = zlib.crc32(self._owner.encode())
+        self._offset = self._hash  # rotated by lock_any
+        self._register()
+        if conflict_cache and not isinstance(self.backend, RedisBackend):
+            raise ValueError('conflict_cache requires redis backend')
+        self._conflict_cache = _ConflictCache(self.redis) \
+            if conflict_cache else None
+        self._tracer = tracer
+        if linger and not isinstance(self.backend, RedisBackend):
+            raise ValueError('linger requires redis backend')
+        self._sticky = _StickyGrants(self.backend, self._owner, linger) \
+            if linger else None
+        self._deferred = _DeferredUnlocks(self.backend, self._owner,
+                                          defer_unlock) \
+            if defer_unlock else None
+        self._watchdog = _Watchdog(self.backend, self._owner, watchdog,
+                                   on_long_hold) \
+            if watchdog else None
+
+    def close(self):
+        """Stops background activities of this client, if any"""
+        if self._conflict_cache is not None:
+            self._conflict_cache.close()
+            self._conflict_cache = None
+        if self._sticky is not None:
+            self._sticky.close()
+            self._sticky = None
+        if self._deferred is not None:
+            self._deferred.close()
+            self._deferred = None
+        if self._watchdog is not None:
+            self._watchdog.close()
+            self._watchdog = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock_all()
+        self.close()
+
+    def release_on_exit(self, signals=(signal.SIGTERM,)):
+        """Calls unlock_all when process exits normally or by signals.
+
+        Previous handler of each signal is called after unlock_all,
+        default action is taken if there was no handler.
+        Must be called in main thread when signals are given.
+        """
+        atexit.register(self.unlock_all)
+        for signum in signals:
+            previous = signal.getsignal(signum)
+
+            def handler(signum, frame, previous=previous):
+                self.unlock_all()
+                if callable(previous):
+                    previous(signum, frame)
+                elif previous != signal.SIG_IGN:
+                    signal.signal(signum, signal.SIG_DFL)
+                    os.kill(os.getpid(), signum)
+            signal.signal(signum, handler)
+
+    # Makes this owner known as active to gc
+    def _register(self):
+        self.backend.register(self.get_owner())
+
+    def get_owner(self):
+        return self._owner
+
+    def redis_time(self):
+        """Time of the backend clock, 'sec.usec'"""
+        usec = self.backend.now()
+        return '%d.%06d' % divmod(usec, 1000000)
+
+    def lock(self, name, mode, timeout=0, retry_interval=0.1, capacity=1,
+             priority=0, deadline=None, stripes=1):
+        """Locks on a named resource with mode in timeout.
+
+        Specify timeout 0 (default) for no-wait, no-retry and
+        timeout FOREVER waits until lock success or deadlock.
+
+        When requested lock is not available, this method sleep
+        given retry_interval seconds and retry until lock success,
+        deadlock or timeout.
+
+        When the client was created with conflict_cache=True, no-wait
+        lock known to conflict with locks held by others fails without
+        asking redis-server.  When created with linger, lock kept after
+        unlock is taken back without asking redis-server.  When created
+        with defer_unlock, unlocks of name queued before are done first,
+        and all of them before waiting.
+
+        COUNTED mode is granted while less than capacity owners hold
+        the resource in COUNTED mode, and no one holds READ or WRITE.
+        Capacity is stored with the resource, and other capacity raises
+        ValueError while others hold the resource in COUNTED mode.
+
+        Waiting with priority (higher first) or deadline (seconds from
+        now, timeout not longer than that) queues the request, so it is
+        granted before conflicting requests ranked later, and survives
+        deadlock against waitors of lower priority or later deadline.
+        Requests rank by deadline (budget if none) advanced by aging per
+        priority level, so none waits behind newer requests forever.
+
+        With stripes more than 1, the resource is split into that many
+        stripes to spread readers of hot resource over redis keys.
+        READ locks one stripe chosen by hash of owner, WRITE locks all
+        stripes in order, each waiting and checking deadlock as lock.
+        Lockers of a resource should agree on its stripes.
+
+        returns rwlock, check status field to know lock obtained or failed
+        """
+        if stripes > 1:
+            return self._lock_striped(name, mode, timeout, retry_interval,
+                                      priority, deadline, stripes)
+        rwlock = Rwlock(name, mode, self.node, self.pid)
+        t1 = t2 = time.monotonic()
+        sticky = self._sticky
+        if sticky is not None:
+            entry = sticky.take(name, mode)
+            if entry is not None:
+                rwlock.status = Rwlock.OK
+                rwlock.token = entry[1]
+                if self._watchdog is not None:
+                    self._watchdog.acquired(name, mode)
+                if self._tracer is not None:
+                    self._trace_lock(rwlock, [name], capacity, timeout,
+                                     retry_interval, t1, 0, priority,
+                                     deadline)
+                return rwlock
+        if self._deferred is not None and self._deferred.pending():
+            self._deferred.join([name])
+        cache = self._conflict_cache if timeout == 0 else None
+        if cache is not None:
+            if cache.conflicts(name, mode):
+                rwlock.status = Rwlock.FAIL
+                if cache.notify(name):
+                    self.backend.revoke(name, mode, self._owner)
+                if self._tracer is not None:
+                    self._trace_lock(rwlock, [name], capacity, timeout,
+                                     retry_interval, t1, 0, priority,
+                                     deadline)
+                return rwlock
+            token = cache.begin(name)
+        owner = self._owner
+        waited = False
+        attempts = 0
+        lock_time = self.backend.now()
+        rank, urgency, timeout = self._rank(lock_time, timeout, priority,
+                                            deadline)
+        try:
+            while timeout == Rwlock.FOREVER or t2 - t1 <= timeout:
+                attempts += 1
+                lock_ok = self.backend.grant(name, mode, owner, lock_time,
+                                             capacity, rank, attempts == 1)
+                if lock_ok:
+                    rwlock.status = Rwlock.OK
+                    if lock_ok is not True:
+                        rwlock.token = lock_ok
+                    if sticky is not None:
+                        sticky.acquired(name, mode)
+                    if self._watchdog is not None:
+                        self._watchdog.acquired(name, mode)
+                    break
+                elif timeout == 0:
+                    rwlock.status = Rwlock.FAIL
+                    if cache is not None:
+                        cache.add(name, mode, token)
+                    break
+                waited = True
+                if self._deadlock([name], mode, capacity, rank, urgency):
+                    rwlock.status = Rwlock.DEADLOCK
+                    break
+                time.sleep(retry_interval)
+                t2 = time.monotonic()
+            else:
+                rwlock.status = Rwlock.TIMEOUT
+        finally:
+            # Wait set is made only by deadlock detection, and
+            # queued entries by it, cleared even if interrupted
+            if waited:
+                self.backend.clear_wait(owner)
+        if self._tracer is not None:
+            self._trace_lock(rwlock, [name], capacity, timeout,
+                             retry_interval, t1, attempts, priority,
+                             deadline)
+        return rwlock
+
+    def lock_any(self, names, mode, timeout=0, retry_interval=0.1,
+                 capacity=1, offset=None, priority=0, deadline=None):
+        """Locks first available resource among names with mode in
+        timeout, all of them tried in one atomic call.
+
+        Names are tried in order from offset, rotated by each call from
+        a start differing by client when offset is not given, so callers
+        spread across the names.  When none available, waits for any of
+        them the same way as lock method, deadlock only when each of
+        names is blocked by a cycle of waiting owners.  Priority and
+        deadline are the same as lock method.  Raises ValueError if
+        names is empty.
+
+        returns rwlock, check status field to know lock obtained or failed,
+        name field is the name locked, None if not locked
+        """
+        names = list(names)
+        if not names:
+            raise ValueError('no names to lock')
+        if offset is None:
+            offset = self._offset
+            self._offset += 1
+        offset %= len(names)
+        rwlock = Rwlock(None, mode, self.node, self.pid)
+        owner = self._owner
+        waited = False
+        attempts = 0
+        t1 = t2 = time.monotonic()
+        sticky = self._sticky
+        if sticky is not None:
+            for i in range(len(names)):
+                name = names[(offset + i) % len(names)]
+                entry = sticky.take(name, mode)
+                if entry is not None:
+                    rwlock.name, rwlock.token = name, entry[1]
+                    rwlock.status = Rwlock.OK
+                    if self._watchdog is not None:
+                        self._watchdog.acquired(name, mode)
+                    if self._tracer is not None:
+                        self._trace_lock(rwlock, names, capacity, timeout,
+                                         retry_interval, t1, 0, priority,
+                                         deadline)
+                    return rwlock
+        if self._deferred is not None and self._deferred.pending():
+            self._deferred.join(names)
+        lock_time = self.backend.now()
+        rank, urgency, timeout = self._rank(lock_time, timeout, priority,
+                                            deadline)
+        try:
+            while timeout == Rwlock.FOREVER or t2 - t1 <= timeout:
+                attempts += 1
+                granted = self.backend.grant_any(names, mode, owner, lock_time,
+                                                 capacity, offset, rank,
+                                                 attempts == 1)
+                if granted is not None:
+                    index, rwlock.token = granted
+                    rwlock.name = names[index]
+                    rwlock.status = Rwlock.OK
+                    if sticky is not None:
+                        sticky.acquired(rwlock.name, mode)
+                    if self._watchdog is not None:
+                        self._watchdog.acquired(rwlock.name, mode)
+                    break
+                elif timeout == 0:
+                    rwlock.status = Rwlock.FAIL
+                    break
+                waited = True
+                if self._deadlock(names, mode, capacity, rank, urgency):
+                    rwlock.status = Rwlock.DEADLOCK
+                    break
+                time.sleep(retry_interval)
+                t2 = time.monotonic()
+            else:
+                rwlock.status = Rwlock.TIMEOUT
+        finally:
+            # Wait set is made only by deadlock detection, and
+            # queued entries by it, cleared even if interrupted
+            if waited:
+                self.backend.clear_wait(owner)
+        if self._tracer is not None:
+            self._trace_lock(rwlock, names, capacity, timeout,
+                             retry_interval, t1, attempts, priority,
+                             deadline)
+        return rwlock
+
+    # Stripe i of striped resource, named as '{name#i}'.  Stripes are
+    # keys of their own, not one 'rsrc:' set for all readers.  Note the
+    # hash tag does not make scripts cluster-safe, as they touch keys of
+    # owners, too.
+    @staticmethod
+    def _stripe(name, i):
+        return '{%s#%d}' % (name, i)
+
+    # Stripes locked by rwlock of striped resource, in order locked
+    def _stripes(self, rwlock):
+        if rwlock.mode == Rwlock.WRITE:
+            return [self._stripe(rwlock.name, i)
+                    for i in range(rwlock.stripes)]
+        return [self._stripe(rwlock.name, self._hash % rwlock.stripes)]
+
+    # Locks stripes one by one within timeout (and deadline) of all,
+    # unlocks stripes locked when one failed
+    def _lock_striped(self, name, mode, timeout, retry_interval, priority,
+                      deadline, stripes):
+        if mode == Rwlock.COUNTED:
+            raise ValueError('COUNTED lock can not be striped')
+        rwlock = Rwlock(name, mode, self.node, self.pid)
+        rwlock.stripes = stripes
+        t1 = time.monotonic()
+        locked = list()
+        for stripe in self._stripes(rwlock):
+            elapsed = time.monotonic() - t1
+            stripe_timeout = timeout \
+                if timeout in (0, Rwlock.FOREVER) \
+                else max(0, timeout - elapsed)
+            stripe_deadline = None if deadline is None \
+                else max(0, deadline - elapsed)
+            stripe_rwlock = self.lock(stripe, mode, stripe_timeout,
+                                      retry_interval, priority=priority,
+                                      deadline=stripe_deadline)
+            rwlock.status = stripe_rwlock.status
+            if rwlock.status == Rwlock.FAIL and timeout != 0:
+                rwlock.status = Rwlock.TIMEOUT  # tried in time left
+            if rwlock.status != Rwlock.OK:
+                for stripe_rwlock in reversed(locked):
+                    self.unlock(stripe_rwlock)
+                return rwlock
+            locked.append(stripe_rwlock)
+        # first stripe is locked by every WRITE, its token increases
+        rwlock.token = locked[0].token
+        return rwlock
+
+    # Rank of lock request in wait queue, lower granted first: time by
+    # which it should be granted, advanced by aging per priority level.
+    # Urgency is None unless priority or deadline given, then request
+    # is queued while waiting.  Timeout is cut at deadline.
+    def _rank(self, lock_time, timeout, priority, deadline):
+        if (priority or deadline is not None) and not self.backend.ranked:
+            raise ValueError('priority and deadline require backend '
+                             'queueing waitors')
+        budget = self.budget if deadline is None else deadline
+        rank = lock_time + int((budget - priority * self.aging) * 1000000)
+        if priority == 0 and deadline is None:
+            return rank, None, timeout
+        if deadline is None:
+            return rank, (priority, None), timeout
+        if timeout != 0 and (timeout == Rwlock.FOREVER or deadline < timeout):
+            timeout = deadline
+        return rank, (priority, lock_time + int(deadline * 1000000)), timeout
+
+    # Traces lock began at monotonic time t1, as wall clock time
+    def _trace_lock(self, rwlock, names, capacity, timeout, retry_interval,
+                    t1, attempts, priority=0, deadline=None):
+        wait = time.monotonic() - t1
+        self._tracer.lock(self._owner, names,
+                          rwlock.name if rwlock.status == Rwlock.OK else None,
+                          rwlock.mode, capacity, timeout, retry_interval,
+                          time.time() - wait, wait, attempts, rwlock.status,
+                          priority, deadline)
+
+    def unlock(self, rwlock):
+        """Unlocks rwlock previously acquired with lock method
+
+        When the client was created with linger, the last unlock of a
+        lock keeps it granted for linger seconds, released when others
+        request it or when linger expired.
+
+        When the client was created with defer_unlock, unlock is queued
+        for background thread, which pipelines queued unlocks in a
+        round trip, and returns true without waiting.  Queue holds at
+        most defer_unlock unlocks, unlock waits while it is full.  Use
+        flush to wait for them done.
+
+        returns true for successfull unlock
+        false if there is no such lock to unlock
+        """
+        if rwlock.stripes > 1:
+            ok = True
+            for stripe in reversed(self._stripes(rwlock)):
+                ok = self.unlock(Rwlock(stripe, rwlock.mode, rwlock.node,
+                                        rwlock.pid)) and ok
+            return ok
+        if self._watchdog is not None:
+            self._watchdog.released(rwlock.name, rwlock.mode)
+        ok = None
+        if self._sticky is not None:
+            ok = self._sticky.keep(rwlock.name, rwlock.mode, rwlock.token)
+        if ok is None and self._deferred is not None:
+            self._deferred.put(rwlock.name, rwlock.mode)
+            ok = True
+        elif ok is None:
+            ok = self.backend.release(rwlock.name, rwlock.mode,
+                                      self.get_owner())
+        if self._tracer is not None:
+            self._tracer.unlock(self._owner, rwlock.name, rwlock.mode,
+                                time.time(), ok)
+        return ok
+
+    def unlock_all(self):
+        """Unlocks all locks of this client in one atomic call,
+        regardless of lock count, and clears its wait set
+
+        returns number of locks unlocked
+        """
+        if self._deferred is not None:
+            self._deferred.join()
+        count = self.backend.release_all(self.get_owner())
+        if self._sticky is not None:
+            count -= self._sticky.clear()
+        if self._watchdog is not None:
+            self._watchdog.clear()
+        if self._tracer is not None:
+            self._tracer.unlock_all(self._owner, time.time(), count)
+        return count
+
+    def holders(self, name):
+        """Holders of resource, to see who blocks lock
+
+        returns list of (mode, owner, site), site is call site of lock
+        held longer than watchdog of the holder, None if not known
+        """
+        return self.backend.holders(name)
+
+    def flush(self):
+        """Waits until unlocks queued by defer_unlock done
+
+        returns number of them found no such lock to unlock since last
+        flush, 0 without defer_unlock
+        """
+        if self._deferred is None:
+            return 0
+        return self._deferred.flush()
+
+    def read_begin(self, name):
+        """Begins optimistic read of resource without locking
+
+        returns version to pass to read_validate,
+        None if write lock granted to someone at the moment
+        """
+        version = self.backend.version(name)
+        return None if version % 2 else version
+
+    def read_validate(self, name, version):
+        """Validates optimistic read begun with read_begin
+
+        returns true if no write lock granted on resource since then,
+        false if what was read must be discarded
+        """
+        return version is not None and self.backend.version(name) == version
+
+    def optimistic_read(self, name, func, retries=3,
+                        timeout=Rwlock.FOREVER, retry_interval=0.1):
+        """Calls func to read resource without locking, validated by
+        version of resource.  Retries when writer intervened, then falls
+        back to READ lock with timeout and retry_interval as lock method.
+
+        returns status and return value of func (None unless OK)
+        """
+        for retry in range(retries):
+            if retry:
+                time.sleep(retry_interval)
+            version = self.read_begin(name)
+            if version is not None:
+                result = func()
+                if self.read_validate(name, version):
+                    return Rwlock.OK, result
+        rwlock = self.lock(name, Rwlock.READ, timeout, retry_interval)
+        if rwlock.status != Rwlock.OK:
+            return rwlock.status, None
+        try:
+            return Rwlock.OK, func()
+        finally:
+            self.unlock(rwlock)
+
+    def gc(self):
+        """Removes stale locks, waits, and owner itself created by
+        crashed/exit clients without unlocking or proper cleanup.
+
+        Used by garbage collecting daemon or monitor
+
+        returns number of locks, waits, and owners removed
+        """
+        stale_lock_count, stale_wait_count, stale_owner_count = \
+            self.backend.gc()
         # Gc report
         logger.info('gc: ' + str(stale_lock_count) + ' lock(s), ' +
                     str(stale_wait_count) + ' wait(s), ' +
                     str(stale_owner_count) + ' owner(s)')
+        return stale_lock_count, stale_wait_count, stale_owner_count
 
-    def _deadlock(self, name, mode):
-        self._waitset(name, mode)
-        myself, visited, path = self.get_owner(), set(), list()
-        if self._cyclic(myself, visited, path):
-            return self._victim(path)
+    def _deadlock(self, names, mode, capacity=1, rank=None, urgency=None):
+        if self._deferred is not None:
+            self._deferred.join()  # not to wait holding locks unlocked
+        self._waitset(names, mode, capacity, rank, urgency)
+        myself = self.get_owner()
+        cycles = _blocking_cycles(myself, self.backend.waitees, set(),
+                                  list())
+        # Cycles found in replica, if any, confirmed in primary
+        if cycles and all(self.backend.confirm_cycle(path)
+                          for path in cycles):
+            path = list()
+            for waitor in sum(cycles, list()):
+                if waitor not in path:
+                    path.append(waitor)
+            victim = self._victim(path)
+            if self._tracer is not None:
+                self._tracer.deadlock(myself, time.time(), path, victim)
+            return victim
         return False
 
     # Make sure wait set is up to date before deadlock detection
-    # This could be done in _LOCK_SCRIPT, but here to satisfy redis
-    # EVAL KEYS semantic
-    def _waitset(self, name, mode):
+    def _waitset(self, names, mode, capacity=1, rank=None, urgency=None):
         myself = self.get_owner()
-        grants = self.redis.smembers('rsrc:' + name)
-        self.redis.sadd('wait:' + myself, '__dummy_seed_waitee__')
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
-            waitees = list()
-        for grant in grants:
-            m = re.match(r'([RW]):(.+)', grant.decode())
-            grant_mode, grant_owner = m.group(1, 2)
-            if grant_owner != myself:
-                if not (grant_mode == Rwlock.READ and mode == Rwlock.READ):
-                    retval = self.redis.scard('wait:' + grant_owner)
-                    if retval:
-                        self.redis.sadd('wait:' + myself, grant_owner)
-                        if logging.getLogger().isEnabledFor(logging.DEBUG):
-                            waitees.append(grant_owner)
-                    else:
-                        self.redis.srem('wait:' + myself, grant_owner)
-        if logging.getLogger().isEnabledFor(logging.DEBUG) and waitees:
-            logger.debug('waitset: %s waits {%s}', myself, ', '.join(waitees))
-
-    # Deadlock detect - cycle detect in wait-for graph (DAG)
-    # DFS checking rediscovering of vertex in path
-    def _cyclic(self, current, visited, path):
-        if current in path:
-            logger.debug("_cyclic: [%s]", '->'.join(path))
-            return True
-        adj_set = self.redis.smembers('wait:' + current)
-        for adj in adj_set:
-            adj = adj.decode()
-            if adj not in visited:
-                path.append(current)
-                if self._cyclic(adj, visited, path):
-                    return True
-                path.pop()
-        visited.add(current)
-        return False
+        alternatives = self.backend.waitset(myself, names, mode, capacity,
+                                            rank, urgency)
+        if alternatives and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('waitset: %s waits %s', myself, ' or '.join(
+                '{%s}' % ', '.join(waitees) for waitees in alternatives))
 
-    # Among the waitors in cycle, one who lives long with granted lock
-    # will survive.
-    # (1) oldest lock granted for each waitor
-    # (2) victim is waitor with youngest lock granted obtained from (1)
+    # Among the waitors in cycle, one of higher priority, then earlier
+    # deadline, then who lives long with granted lock will survive.
+    # (1) priority, deadline and oldest lock granted for each waitor
+    # (2) victim is waitor with lowest priority, latest deadline, and
+    #     youngest lock granted obtained from (1)
     def _victim(self, path):
-        victim, victim_time = None, None
+        victim, victim_rank = None, None
         for waitor in path:
             waitor_time = self._oldest_lock_access_time(waitor)
             # waitor_time can be None when waitor is other waitor who is
             # selected as victim and returned after remove its wait set.
             if waitor_time is None:
                 return False
-            if victim is None or _cmp_time(waitor_time, victim_time) > 0:
-                victim, victim_time = waitor, waitor_time
+            priority, deadline = self.backend.urgency(waitor)
+            waitor_rank = (-priority,
+                           float('inf') if deadline is None else deadline,
+                           waitor_time)
+            if victim is None or waitor_rank > victim_rank:
+                victim, victim_rank = waitor, waitor_rank
         assert victim is not None
         myself = self.get_owner()
         if victim != myself:
@@ -386,34 +2147,11 @@ class RwlockClient:
     # Oldest lock access time,
     # the representative (oldest) lock access time of this waitor
     def _oldest_lock_access_time(self, waitor):
-        waitor_time = None
-        for access in self.redis.smembers('owner:' + waitor):
-            mode, name = re.match(r'([RW]):(.+)', access.decode()).group(1, 2)
-            lock = self.redis.get('lock:' + name + ':' + mode + ':' + waitor)
-            # lock can be deleted if DEADLOCK victim unlocked already
-            if not lock:
-                continue
-            access_time = re.match(r'.+:(.+)', lock.decode()).group(1)
-            if waitor_time is None or _cmp_time(access_time, waitor_time) < 0:
-                waitor_time = access_time
-        return waitor_time
+        return self.backend.oldest_grant_time(waitor)
 
     # For test aid, not public
     def _clear_all(self):
-        count = 0
-        for lock in self._redis_scan_iter('lock:*:[RW]:*'):
-            logger.debug('_clear_all: ' + lock.decode())
-            count += self.redis.delete(lock.decode())
-        for rsrc in self._redis_scan_iter('rsrc:*'):
-            logger.debug('_clear_all: ' + rsrc.decode())
-            count += self.redis.delete(rsrc.decode())
-        for owner in self._redis_scan_iter('owner:*'):
-            logger.debug('_clear_all: ' + owner.decode())
-            count += self.redis.delete(owner.decode())
-        for wait in self._redis_scan_iter('wait:*'):
-            logger.debug('_clear_all: ' + wait.decode())
-            count += self.redis.delete(wait.decode())
-        return True if count > 0 else False
+        return self.backend.clear_all()
 
 
 # TODO: high availability! redis sentinel or replication?
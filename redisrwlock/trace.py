@@ -0,0 +1,336 @@
+from .redisrwlock import _blocking_cycles, _blocking_waitees, _conflicts
+from .redisrwlock import Rwlock, RwlockClient
+
+import heapq
+import itertools
+import json
+import threading
+
+# Trace of lock operations, one JSON object per line (NDJSON)
+#
+# lock:       ev, owner, names, name (granted, null if not), mode,
+#             capacity, timeout, retry, t, wait, attempts, status,
+#             priority, deadline (null if none)
+# unlock:     ev, owner, name, mode, t, ok
+# unlock_all: ev, owner, t, count
+# deadlock:   ev, owner, t, path, victim   (cycle found in wait-for graph)
+#
+# t    = wall clock seconds when operation began
+# wait = seconds taken by lock until status decided
+#
+# Replay feeds a trace into discrete-event simulation of the same grant,
+# retry, timeout and deadlock rules, with each owner doing its recorded
+# operations separated by the recorded gaps, so latency can be predicted
+# under different retry interval, timeout or lock granularity.  Waitors
+# with priority or deadline are queued by rank and chosen as victim by
+# them, as RwlockClient does with the default aging and budget.  Traces
+# without them (older traces) replay as requests of neither.
+
+_STATUS_NAMES = {
+    Rwlock.OK: 'OK',
+    Rwlock.FAIL: 'FAIL',
+    Rwlock.TIMEOUT: 'TIMEOUT',
+    Rwlock.DEADLOCK: 'DEADLOCK',
+}
+
+
+class Tracer:
+    """Writes lock operations of RwlockClient to file as NDJSON"""
+
+    def __init__(self, file):
+        self._owned = isinstance(file, str)
+        self._file = open(file, 'a', buffering=1) if self._owned else file
+        self._mutex = threading.Lock()
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    def emit(self, event):
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self._mutex:
+            self._file.write(line)
+
+    def lock(self, owner, names, name, mode, capacity, timeout, retry,
+             t, wait, attempts, status, priority=0, deadline=None):
+        self.emit(dict(ev='lock', owner=owner, names=names, name=name,
+                       mode=mode, capacity=capacity, timeout=timeout,
+                       retry=retry, t=t, wait=wait, attempts=attempts,
+                       status=_STATUS_NAMES[status], priority=priority,
+                       deadline=deadline))
+
+    def unlock(self, owner, name, mode, t, ok):
+        self.emit(dict(ev='unlock', owner=owner, name=name, mode=mode, t=t,
+                       ok=ok))
+
+    def unlock_all(self, owner, t, count):
+        self.emit(dict(ev='unlock_all', owner=owner, t=t, count=count))
+
+    def deadlock(self, owner, t, path, victim):
+        self.emit(dict(ev='deadlock', owner=owner, t=t, path=path,
+                       victim=victim))
+
+
+def load(file):
+    """Reads events from trace file (path or file object)"""
+    if isinstance(file, str):
+        with open(file) as f:
+            return load(f)
+    return [json.loads(line) for line in file if line.strip()]
+
+
+def summary(results):
+    """Summarizes lock results, list of (status, wait, attempts)
+
+    returns dict of count, status counts, attempts, and wait mean, p50,
+    p99 and max in seconds
+    """
+    waits = sorted(wait for status, wait, attempts in results)
+    statuses = dict()
+    for status, wait, attempts in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def percentile(p):
+        if not waits:
+            return 0.0
+        return waits[min(len(waits) - 1, int(len(waits) * p))]
+    return dict(count=len(results), status=statuses,
+                attempts=sum(attempts for status, wait, attempts in results),
+                mean=sum(waits) / len(waits) if waits else 0.0,
+                p50=percentile(0.5), p99=percentile(0.99),
+                max=waits[-1] if waits else 0.0)
+
+
+def recorded(events):
+    """Lock results recorded in trace, list of (status, wait, attempts)"""
+    return [(event['status'], event['wait'], event['attempts'])
+            for event in events if event['ev'] == 'lock']
+
+
+# Operations of each owner, in order, with gap since previous operation
+# of the owner completed (since trace began for the first)
+def _programs(events, rename):
+    programs, done = dict(), dict()
+    events = sorted((event for event in events if event['ev'] != 'deadlock'),
+                    key=lambda event: event['t'])
+    start = events[0]['t'] if events else 0.0
+    for event in events:
+        owner = event['owner']
+        gap = max(0.0, event['t'] - done.get(owner, start))
+        if event['ev'] == 'lock':
+            op = dict(event, names=[rename(name) for name in event['names']],
+                      name=rename(event['name'])
+                      if event['name'] is not None else None)
+            done[owner] = event['t'] + event['wait']
+        else:
+            op = dict(event)
+            if 'name' in op:
+                op['name'] = rename(op['name'])
+            done[owner] = event['t']
+        programs.setdefault(owner, list()).append((gap, op))
+    return programs
+
+
+class _Simulation:
+
+    def __init__(self, programs, timeout, retry_interval):
+        self.programs = programs
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.grants = dict()    # name -> {(mode, owner): rcnt}
+        self.accesses = dict()  # owner -> {(mode, name): time}
+        self.waiting = dict()   # owner -> request waiting
+        self.renamed = dict()   # owner -> {traced name: simulated name}
+        self.results = list()
+        self._queue = list()
+        self._seq = itertools.count()
+
+    def schedule(self, time, owner, state):
+        heapq.heappush(self._queue, (time, next(self._seq), owner, state))
+
+    def run(self):
+        for owner, program in self.programs.items():
+            self.schedule(program[0][0], owner, (0, None))
+        while self._queue:
+            now, seq, owner, (pc, request) = heapq.heappop(self._queue)
+            program = self.programs[owner]
+            op = program[pc][1]
+            if op['ev'] == 'lock':
+                request = self.attempt(now, owner, op, request)
+                if request is not None:
+                    self.schedule(request['next'], owner, (pc, request))
+                    continue
+            elif op['ev'] == 'unlock':
+                name = self.renamed.get(owner, dict()).get(
+                    op['name'], op['name'])
+                self.release(owner, name, op['mode'])
+            else:
+                self.release_all(owner)
+            if pc + 1 < len(program):
+                self.schedule(now + program[pc + 1][0], owner, (pc + 1, None))
+            else:
+                # owners leave nothing behind at end of trace
+                self.release_all(owner)
+        return self.results
+
+    # One try of lock request, returns request to retry or None if done
+    def attempt(self, now, owner, op, request):
+        if request is None:
+            timeout = op['timeout'] if self.timeout is None else self.timeout
+            retry = op['retry'] if self.retry_interval is None \
+                else self.retry_interval
+            priority = op.get('priority', 0)
+            deadline = op.get('deadline')
+            budget = RwlockClient.budget if deadline is None else deadline
+            if deadline is not None and timeout != 0 and \
+                    (timeout == Rwlock.FOREVER or deadline < timeout):
+                timeout = deadline
+            request = dict(start=now, attempts=0, timeout=timeout,
+                           retry=retry, names=op['names'], mode=op['mode'],
+                           capacity=op['capacity'], priority=priority,
+                           deadline=None if deadline is None
+                           else now + deadline,
+                           rank=now + budget - priority * RwlockClient.aging,
+                           queued=bool(priority) or deadline is not None)
+        request['attempts'] += 1
+        names, mode, capacity = op['names'], op['mode'], op['capacity']
+        # tried from traced name, as offset is not traced
+        first = names.index(op['name']) if op['name'] in names else 0
+        for i in range(len(names)):
+            name = names[(first + i) % len(names)]
+            if self.grant(owner, name, mode, capacity, now,
+                          request['rank']):
+                if op['name'] is not None:
+                    self.renamed.setdefault(owner, dict())[op['name']] = name
+                return self.done(now, owner, request, Rwlock.OK)
+        if request['timeout'] == 0:
+            return self.done(now, owner, request, Rwlock.FAIL)
+        self.waiting[owner] = request
+        if self.deadlock(owner):
+            return self.done(now, owner, request, Rwlock.DEADLOCK)
+        request['next'] = now + request['retry']
+        if request['timeout'] != Rwlock.FOREVER and \
+                request['next'] - request['start'] > request['timeout']:
+            return self.done(request['next'], owner, request, Rwlock.TIMEOUT)
+        return request
+
+    def done(self, now, owner, request, status):
+        self.waiting.pop(owner, None)
+        self.results.append((_STATUS_NAMES[status], now - request['start'],
+                             request['attempts']))
+        return None
+
+    # Queued waitors of lower rank in conflicting mode for name
+    def queued_ahead(self, owner, name, mode, rank):
+        return [waitor for waitor, request in self.waiting.items()
+                if waitor != owner and request['queued'] and
+                request['rank'] < rank and name in request['names'] and
+                not (request['mode'] == mode != Rwlock.WRITE)]
+
+    def grant(self, owner, name, mode, capacity, now, rank):
+        if self.queued_ahead(owner, name, mode, rank):
+            return False
+        grants = self.grants.get(name, dict())
+        holders = 0
+        for grant_mode, grant_owner in grants:
+            if grant_owner != owner:
+                if grant_mode == mode == Rwlock.COUNTED:
+                    holders += 1
+                elif _conflicts(mode, grant_mode):
+                    return False
+        if mode == Rwlock.COUNTED and holders >= capacity:
+            return False
+        self.grants[name] = grants
+        grants[(mode, owner)] = grants.get((mode, owner), 0) + 1
+        self.accesses.setdefault(owner, dict()).setdefault((mode, name), now)
+        return True
+
+    def release(self, owner, name, mode):
+        grants = self.grants.get(name, dict())
+        rcnt = grants.get((mode, owner))
+        if rcnt is None:
+            return
+        if rcnt > 1:
+            grants[(mode, owner)] = rcnt - 1
+            return
+        del grants[(mode, owner)]
+        if not grants:
+            del self.grants[name]
+        accesses = self.accesses[owner]
+        del accesses[(mode, name)]
+        if not accesses:
+            del self.accesses[owner]
+
+    def release_all(self, owner):
+        for mode, name in list(self.accesses.get(owner, ())):
+            del self.grants[name][(mode, owner)]
+            if not self.grants[name]:
+                del self.grants[name]
+        self.accesses.pop(owner, None)
+        self.renamed.pop(owner, None)
+
+    def waitees(self, owner):
+        if owner not in self.waiting:
+            return list()
+        request = self.waiting[owner]
+        names, mode = request['names'], request['mode']
+        capacity, rank = request['capacity'], request['rank']
+        blockers, owners = list(), set()
+        for name in names:
+            conflicts, holders = list(), list()
+            for grant_mode, grant_owner in self.grants.get(name, ()):
+                if grant_owner != owner:
+                    if grant_mode == mode == Rwlock.COUNTED:
+                        holders.append(grant_owner)
+                    elif _conflicts(mode, grant_mode):
+                        conflicts.append(grant_owner)
+            for waitor in self.queued_ahead(owner, name, mode, rank):
+                if _conflicts(mode, self.waiting[waitor]['mode']):
+                    conflicts.append(waitor)
+            blockers.append((conflicts, holders))
+            owners.update(conflicts, holders)
+        waiting = dict((grant_owner, grant_owner in self.waiting)
+                       for grant_owner in owners)
+        return _blocking_waitees(blockers, waiting, capacity)
+
+    # Same as RwlockClient: cycle from owner, victim is the waitor in
+    # cycle of lowest priority, then latest deadline, then whose oldest
+    # grant is youngest
+    def deadlock(self, owner):
+        cycles = _blocking_cycles(owner, self.waitees, set(), list())
+        if cycles is None:
+            return False
+        path = list()
+        for waitor in sum(cycles, list()):
+            if waitor not in path:
+                path.append(waitor)
+        ranks = list()
+        for waitor in path:
+            if waitor not in self.accesses:
+                return False
+            request = self.waiting.get(waitor, dict())
+            deadline = request.get('deadline')
+            ranks.append((-request.get('priority', 0),
+                          float('inf') if deadline is None else deadline,
+                          min(self.accesses[waitor].values())))
+        return path[ranks.index(max(ranks))] == owner
+
+
+def replay(events, timeout=None, retry_interval=None, rename=None):
+    """Simulates locks of traced events under grant and deadlock rules
+
+    Each owner does its traced operations in order, separated by traced
+    gaps, and lock waits poll every retry_interval until timeout as
+    RwlockClient.lock does.  timeout and retry_interval override traced
+    values when given, rename maps traced names to simulated names to
+    try different granularity of resources.
+
+    returns simulated lock results, list of (status, wait, attempts)
+    """
+    if rename is None:
+        def rename(name):
+            return name
+    programs = _programs(events, rename)
+    return _Simulation(programs, timeout, retry_interval).run()
@@ -1,13 +1,16 @@
-from redisrwlock import Rwlock, RwlockClient
+from redisrwlock import Fence, Rwlock, RwlockClient
 from test_redisrwlock_connection import (
     runRedisServer, terminateRedisServer, cleanUpRedisKeys)
 
 import unittest
 import logging
 import os
+import redis
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 
 logging.basicConfig(
@@ -79,6 +82,56 @@ class TestRedisRwlock(unittest.TestCase):
         client.unlock(rwlock)
         self.assertEqual(client.unlock(rwlock), False)
 
+    def test_unlock_all(self):
+        """test unlock all locks in one call"""
+        client = RwlockClient()
+        client.lock('N1', Rwlock.READ)
+        client.lock('N1', Rwlock.READ)
+        client.lock('N1', Rwlock.WRITE)
+        rwlock = client.lock('N2', Rwlock.WRITE)
+        self.assertEqual(client.unlock_all(), 3)
+        self.assertEqual(client.unlock_all(), 0)
+        self.assertEqual(client.unlock(rwlock), False)
+
+    def test_unlock_all_context(self):
+        """test unlock all when leaving with statement"""
+        with RwlockClient() as client:
+            rwlock = client.lock('N1', Rwlock.WRITE)
+            self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertFalse(client.redis.exists(rwlock.lock_key()))
+
+    def test_release_on_exit(self):
+        """test unlock all on exit and on signal"""
+        command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+import time
+client = RwlockClient()
+client.release_on_exit()
+client.lock('N-EXIT', Rwlock.WRITE)
+if sys.argv[1] == 'wait':
+    print('locked', flush=True)
+    time.sleep(10)
+'''
+        client = RwlockClient()
+        # normal exit
+        process = subprocess.Popen(['python3', '-c', command, 'exit'])
+        self.assertEqual(process.wait(), 0)
+        rwlock = client.lock('N-EXIT', Rwlock.WRITE)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        client.unlock(rwlock)
+        # terminated by signal, still terminated by default action
+        process = subprocess.Popen(['python3', '-c', command, 'wait'],
+                                   stdout=subprocess.PIPE,
+                                   universal_newlines=True)
+        process.stdout.readline()
+        process.terminate()
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+        process.stdout.close()
+        rwlock = client.lock('N-EXIT', Rwlock.WRITE)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        client.unlock(rwlock)
+
     def test_lock_nesting(self):
         """
         test lock again for already owned one
@@ -103,6 +156,38 @@ class TestRedisRwlock(unittest.TestCase):
         client.unlock(rwlock2)
         client.unlock(rwlock1)
 
+    def test_owner_index(self):
+        """test grants of owner indexed by lock time"""
+        client = RwlockClient()
+        rwlock1 = client.lock('N1', Rwlock.READ)
+        rwlock2 = client.lock('N2', Rwlock.WRITE)
+        rwlock3 = client.lock('N1', Rwlock.READ)
+        otime_key = 'otime:' + client.get_owner()
+        self.assertEqual(client.redis.zrange(otime_key, 0, -1),
+                         [b'R:N1', b'W:N2'])
+        oldest = client._oldest_lock_access_time(client.get_owner())
+        self.assertEqual(client.redis.get(rwlock1.lock_key()).decode(),
+                         '2:' + str(oldest))
+        client.unlock(rwlock3)
+        client.unlock(rwlock1)
+        self.assertEqual(client.redis.zrange(otime_key, 0, -1),
+                         [b'W:N2'])
+        client.unlock(rwlock2)
+        self.assertIsNone(
+            client._oldest_lock_access_time(client.get_owner()))
+
+    def test_owner_index_fallback(self):
+        """test oldest grant of older client without index"""
+        client = RwlockClient()
+        # as written by older clients, 'sec.usec' time and no otime
+        client.redis.sadd('owner:old/1', 'R:N1', 'W:N2', 'R:N3')
+        client.redis.set('lock:N1:R:old/1', '1:12.345')
+        client.redis.set('lock:N2:W:old/1', '1:11.500000')
+        self.assertEqual(client._oldest_lock_access_time('old/1'),
+                         11500000)
+        client.redis.delete('owner:old/1', 'lock:N1:R:old/1',
+                            'lock:N2:W:old/1')
+
     def test_lock_fail_nowait(self):
         """test lock fail with no wait"""
         # Simulate other process
@@ -126,6 +211,619 @@ class TestRedisRwlock(unittest.TestCase):
         self.assertEqual(rwlock2.status, Rwlock.TIMEOUT)
         client1.unlock(rwlock1)
 
+    def test_lock_counted(self):
+        """test counted lock granted up to capacity"""
+        clients = [RwlockClient(pid=str(os.getpid() - i)) for i in range(3)]
+        rwlock0 = clients[0].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock0.status, Rwlock.OK)
+        rwlock1 = clients[1].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock1.status, Rwlock.OK)
+        rwlock2 = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        # capacity is stored with the resource
+        with self.assertRaises(ValueError):
+            clients[2].lock('N1', Rwlock.COUNTED, capacity=3)
+        with self.assertRaises(ValueError):
+            clients[2].lock_any(['N1'], Rwlock.COUNTED, capacity=3)
+        # nesting does not count
+        rwlock = clients[1].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        clients[1].unlock(rwlock)
+        for mode in (Rwlock.READ, Rwlock.WRITE):
+            rwlock = clients[2].lock('N1', mode)
+            self.assertEqual(rwlock.status, Rwlock.FAIL)
+        clients[0].unlock(rwlock0)
+        rwlock2 = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        self.assertEqual(clients[1].unlock_all(), 1)
+        self.assertEqual(clients[2].unlock_all(), 1)
+        # another capacity once nobody holds it
+        rwlock0 = clients[0].lock('N1', Rwlock.COUNTED, capacity=3)
+        self.assertEqual(rwlock0.status, Rwlock.OK)
+        self.assertTrue(clients[0].unlock(rwlock0))
+
+    def test_lock_any(self):
+        """test lock any of names, from offset"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient()
+        names = ['N1', 'N2', 'N3']
+        client1.lock('N1', Rwlock.WRITE)
+        rwlock = client2.lock_any(names, Rwlock.WRITE, offset=0)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N2'))
+        rwlock = client2.lock_any(names, Rwlock.WRITE, offset=0)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N2'))
+        client2.unlock(rwlock)
+        rwlock = client2.lock_any(names, Rwlock.WRITE, offset=2)
+        self.assertEqual(rwlock.name, 'N3')
+        client1.unlock_all()
+        client2.unlock_all()
+        # rotated without offset
+        rwlock1 = client1.lock_any(names, Rwlock.READ)
+        rwlock2 = client1.lock_any(names, Rwlock.READ)
+        self.assertNotEqual(rwlock1.name, rwlock2.name)
+        client1.unlock_all()
+        client1.lock('N1', Rwlock.WRITE)
+        rwlock = client2.lock_any(names[:1], Rwlock.READ)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.FAIL, None))
+        threading.Timer(0.3, client1.unlock_all).start()
+        rwlock = client2.lock_any(names[:1], Rwlock.READ, timeout=2)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N1'))
+        client2.unlock(rwlock)
+        with self.assertRaises(ValueError):
+            client2.lock_any([], Rwlock.READ)
+
+    def test_lock_priority(self):
+        """test queued waitor granted before others ranked later"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient(pid=str(os.getpid() - 2))
+        client3 = RwlockClient()
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        result = dict()
+
+        def wait_with_priority():
+            result['rwlock'] = client2.lock('N1', Rwlock.WRITE, timeout=2,
+                                            priority=5)
+        thread = threading.Thread(target=wait_with_priority)
+        thread.start()
+        t1 = time.monotonic()
+        while not client3.redis.exists('queue:N1'):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        self.assertEqual(client3.backend.urgency(client2.get_owner()),
+                         (5, None))
+        # READ is not granted while WRITE of higher priority waits
+        rwlock3 = client3.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock3.status, Rwlock.FAIL)
+        # but a request of close deadline goes first
+        rwlock3 = client3.lock('N1', Rwlock.READ, deadline=0.05)
+        self.assertEqual(rwlock3.status, Rwlock.OK)
+        client3.unlock(rwlock3)
+        client1.unlock(rwlock1)
+        thread.join()
+        self.assertEqual(result['rwlock'].status, Rwlock.OK)
+        self.assertFalse(client3.redis.exists('queue:N1', 'prio:' +
+                                              client2.get_owner()))
+        rwlock3 = client3.lock('N1', Rwlock.READ, timeout=0.3, deadline=0.1)
+        self.assertEqual(rwlock3.status, Rwlock.TIMEOUT)
+        client2.unlock(result['rwlock'])
+
+    def test_lock_priority_interrupted(self):
+        """test queued waitor removed when wait interrupted"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient(pid=str(os.getpid() - 2))
+        client3 = RwlockClient()
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        deadlock = client2._deadlock
+
+        def interrupted(*args):
+            deadlock(*args)
+            raise RuntimeError('interrupted')
+        client2._deadlock = interrupted
+        owner2 = client2.get_owner()
+        with self.assertRaises(RuntimeError):
+            client2.lock('N1', Rwlock.WRITE, timeout=2, priority=5)
+        self.assertFalse(client3.redis.exists('queue:N1', 'prio:' + owner2,
+                                              'wait:' + owner2))
+        with self.assertRaises(RuntimeError):
+            client2.lock_any(['N1'], Rwlock.WRITE, timeout=2, priority=5)
+        self.assertFalse(client3.redis.exists('queue:N1', 'prio:' + owner2,
+                                              'wait:' + owner2))
+        # READ is not held back by the writer gone
+        rwlock3 = client3.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock3.status, Rwlock.OK)
+        client3.unlock(rwlock3)
+        client1.unlock(rwlock1)
+
+    def test_fencing_token(self):
+        """test fencing token increases with each WRITE grant"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient()
+        fence = Fence()
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock1.token, int(client1.redis.get('ver:N1')))
+        self.assertEqual(client1.lock('N1', Rwlock.WRITE).token,
+                         rwlock1.token)
+        self.assertIsNone(client1.lock('N1', Rwlock.READ).token)
+        self.assertTrue(fence.admit('N1', rwlock1.token))
+        # lost lock, as if gc-ed while paused
+        client1.unlock_all()
+        rwlock2 = client2.lock_any(['N1'], Rwlock.WRITE)
+        self.assertGreater(rwlock2.token, rwlock1.token)
+        self.assertTrue(fence.admit('N1', rwlock2.token))
+        self.assertTrue(fence.admit('N1', rwlock2.token))
+        self.assertFalse(fence.admit('N1', rwlock1.token))
+        self.assertFalse(fence.admit('N1', None))
+        self.assertTrue(fence.admit('N2', rwlock1.token))
+        client2.unlock(rwlock2)
+
+    def test_lock_striped(self):
+        """test readers spread over stripes, writer locks all"""
+        readers = [RwlockClient(pid=str(os.getpid() - i))
+                   for i in range(1, 9)]
+        writer = RwlockClient()
+        rwlocks = [reader.lock('N1', Rwlock.READ, stripes=4)
+                   for reader in readers]
+        self.assertEqual([rwlock.status for rwlock in rwlocks],
+                         [Rwlock.OK] * 8)
+        used = [i for i in range(4) if writer.redis.exists('rsrc:{N1#%d}' % i)]
+        self.assertGreater(len(used), 1)
+        self.assertFalse(writer.redis.exists('rsrc:N1'))
+        rwlock = writer.lock('N1', Rwlock.WRITE, stripes=4)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        rwlock = writer.lock('N1', Rwlock.WRITE, timeout=0.2, stripes=4)
+        self.assertEqual(rwlock.status, Rwlock.TIMEOUT)
+        # stripes locked before failed one are unlocked
+        self.assertIsNone(writer.backend.oldest_grant_time(
+            writer.get_owner()))
+        for reader, rwlock in zip(readers, rwlocks):
+            self.assertTrue(reader.unlock(rwlock))
+        rwlock = writer.lock('N1', Rwlock.WRITE, stripes=4)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertIsInstance(rwlock.token, int)
+        for reader in readers:
+            self.assertEqual(reader.lock('N1', Rwlock.READ, stripes=4).status,
+                             Rwlock.FAIL)
+        self.assertTrue(writer.unlock(rwlock))
+        self.assertFalse(writer.unlock(rwlock))
+        self.assertEqual(readers[0].lock('N1', Rwlock.READ, stripes=4).status,
+                         Rwlock.OK)
+        self.assertEqual(readers[0].unlock_all(), 1)
+        with self.assertRaises(ValueError):
+            writer.lock('N1', Rwlock.COUNTED, stripes=4)
+        # lock_any rotating its offset does not move stripe of reader
+        rwlock = readers[0].lock('N1', Rwlock.READ, stripes=4)
+        readers[0].unlock(readers[0].lock_any(['N2', 'N3'], Rwlock.READ))
+        self.assertTrue(readers[0].unlock(rwlock))
+        self.assertIsNone(readers[0].backend.oldest_grant_time(
+            readers[0].get_owner()))
+
+    def test_clock(self):
+        """test estimated redis time close to redis time"""
+        client = RwlockClient()
+        sec, usec = client.redis.time()
+        self.assertTrue(abs(client.backend.now() -
+                            (sec * 1000000 + usec)) < 50000)
+        rwlock = client.lock('N1', Rwlock.READ)
+        lock_time = client.redis.get(rwlock.lock_key()).decode()
+        self.assertRegex(lock_time, r'^1:[0-9]+$')
+        client.unlock(rwlock)
+
+
+class TestRedisRwlock_conflict_cache(unittest.TestCase):
+
+    def setUp(self):
+        cleanUpRedisKeys()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    def test_conflict_cache(self):
+        """test try-lock fails locally until conflicting lock released"""
+        # Simulate other process
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient(conflict_cache=True)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        # Invalidation by the lock above arriving after try-lock begun
+        # keeps the conflict out of cache, try again until cached
+        t1 = time.monotonic()
+        while not client2._conflict_cache.conflicts('N1', Rwlock.READ):
+            self.assertTrue(time.monotonic() - t1 < 0.5)
+            rwlock2 = client2.lock('N1', Rwlock.READ)
+            self.assertEqual(rwlock2.status, Rwlock.FAIL)
+            time.sleep(0.01)
+        self.assertTrue(client2._conflict_cache.conflicts('N1', Rwlock.WRITE))
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        client1.unlock(rwlock1)
+        # Wait for invalidation, but not as long as ttl
+        t1 = time.monotonic()
+        while client2._conflict_cache.conflicts('N1', Rwlock.READ):
+            self.assertTrue(time.monotonic() - t1 < 0.5)
+            time.sleep(0.01)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+        client2.close()
+
+    def test_conflict_cache_readers(self):
+        """test failed WRITE due to readers does not fail READ locally"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient(conflict_cache=True)
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        self.assertFalse(client2._conflict_cache.conflicts('N1', Rwlock.READ))
+        rwlock2 = client2.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+        client1.unlock(rwlock1)
+        client2.close()
+
+
+    def cache_conflict(self, client, name, mode):
+        # Invalidation by the lock above arriving after try-lock begun
+        # keeps the conflict out of cache, try again until cached
+        t1 = time.monotonic()
+        while not client._conflict_cache.conflicts(name, mode):
+            self.assertTrue(time.monotonic() - t1 < 0.5)
+            self.assertEqual(client.lock(name, mode).status, Rwlock.FAIL)
+            time.sleep(0.01)
+
+    def test_conflict_cache_revoke(self):
+        """test try-lock failed locally asks sticky holder to give up"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1), linger=5)
+        client2 = RwlockClient(conflict_cache=True)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.cache_conflict(client2, 'N1', Rwlock.READ)
+        calls = client2.redis.info('commandstats').get(
+            'cmdstat_publish', dict()).get('calls', 0)
+        for i in range(3):
+            self.assertEqual(client2.lock('N1', Rwlock.READ).status,
+                             Rwlock.FAIL)
+        # once for the entry
+        self.assertEqual(client2.redis.info('commandstats').get(
+            'cmdstat_publish', dict()).get('calls', 0), calls + 1)
+        client1.unlock(rwlock1)
+        self.assertFalse(client1.redis.exists(rwlock1.lock_key()))
+        client1.close()
+        client2.close()
+
+    def test_conflict_cache_reconnect(self):
+        """test tracking enabled again when listener reconnected"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient(conflict_cache=True)
+        for client in client1.redis.client_list():
+            if 't' in client['flags']:
+                client1.redis.client_kill_filter(_id=client['id'])
+        t1 = time.monotonic()
+        while not any('t' in client['flags']
+                      for client in client1.redis.client_list()):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.cache_conflict(client2, 'N1', Rwlock.READ)
+        client1.unlock(rwlock1)
+        # Wait for invalidation, but not as long as ttl
+        t1 = time.monotonic()
+        while client2._conflict_cache.conflicts('N1', Rwlock.READ):
+            self.assertTrue(time.monotonic() - t1 < 0.5)
+            time.sleep(0.01)
+        client2.close()
+
+
+class TestRedisRwlock_sticky(unittest.TestCase):
+
+    def setUp(self):
+        cleanUpRedisKeys()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    def evalsha_calls(self, redis):
+        return redis.info('commandstats').get(
+            'cmdstat_evalsha', dict()).get('calls', 0)
+
+    def test_sticky(self):
+        """test grant kept after unlock, taken back without redis"""
+        client1 = RwlockClient(linger=5)
+        client2 = RwlockClient(pid=str(os.getpid() - 1))
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertTrue(client1.unlock(rwlock1))
+        self.assertFalse(client1.unlock(rwlock1))
+        self.assertTrue(client1.redis.exists(rwlock1.lock_key()))
+        calls = self.evalsha_calls(client1.redis)
+        for i in range(10):
+            rwlock = client1.lock('N1', Rwlock.WRITE)
+            self.assertEqual((rwlock.status, rwlock.token),
+                             (Rwlock.OK, rwlock1.token))
+            self.assertTrue(client1.unlock(rwlock))
+        self.assertEqual(self.evalsha_calls(client1.redis), calls)
+        # conflicting request makes holder give it up
+        t1 = time.monotonic()
+        rwlock2 = client2.lock('N1', Rwlock.READ, timeout=2)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        self.assertLess(time.monotonic() - t1, 1)
+        self.assertEqual(client1.lock('N1', Rwlock.WRITE).status,
+                         Rwlock.FAIL)
+        client2.unlock(rwlock2)
+        client1.close()
+
+    def test_sticky_revoked_in_use(self):
+        """test grant requested while in use released by unlock"""
+        client1 = RwlockClient(linger=5)
+        client2 = RwlockClient(pid=str(os.getpid() - 1))
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        rwlock2 = client1.lock('N1', Rwlock.WRITE)
+        self.assertEqual(client2.lock('N1', Rwlock.READ).status,
+                         Rwlock.FAIL)
+        time.sleep(0.2)
+        client1.unlock(rwlock2)
+        client1.unlock(rwlock1)
+        self.assertFalse(client1.redis.exists(rwlock1.lock_key()))
+        client1.close()
+
+    def publish_calls(self, redis):
+        return redis.info('commandstats').get(
+            'cmdstat_publish', dict()).get('calls', 0)
+
+    def test_sticky_revoke_notified(self):
+        """test revoke published to sticky owners, on first attempt"""
+        client1 = RwlockClient()
+        client2 = RwlockClient(pid=str(os.getpid() - 1), linger=5)
+        client3 = RwlockClient(pid=str(os.getpid() - 2))
+        self.assertEqual(client1.redis.smembers('sticky'),
+                         {client2.get_owner().encode()})
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        calls = self.publish_calls(client1.redis)
+        self.assertEqual(client3.lock('N1', Rwlock.READ, timeout=0.3,
+                                      retry_interval=0.05).status,
+                         Rwlock.TIMEOUT)
+        self.assertEqual(self.publish_calls(client1.redis), calls)
+        client1.unlock(rwlock1)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(client3.lock('N1', Rwlock.READ, timeout=0.3,
+                                      retry_interval=0.05).status,
+                         Rwlock.TIMEOUT)
+        self.assertEqual(self.publish_calls(client1.redis), calls + 1)
+        client2.unlock(rwlock2)
+        client2.close()
+        self.assertFalse(client1.redis.exists('sticky'))
+
+    def test_sticky_expire(self):
+        """test grant kept released by linger expired, or by close"""
+        client = RwlockClient(linger=0.2)
+        rwlock = client.lock('N1', Rwlock.READ)
+        client.unlock(rwlock)
+        self.assertTrue(client.redis.exists(rwlock.lock_key()))
+        time.sleep(0.5)
+        self.assertFalse(client.redis.exists(rwlock.lock_key()))
+        client.unlock(client.lock('N1', Rwlock.READ))
+        client.unlock(client.lock_any(['N2'], Rwlock.READ))
+        client.lock('N3', Rwlock.READ)
+        self.assertEqual(client.unlock_all(), 1)
+        client.unlock(client.lock('N1', Rwlock.READ))
+        client.close()
+        self.assertFalse(client.redis.exists(rwlock.lock_key()))
+
+
+class TestRedisRwlock_deferred_unlock(unittest.TestCase):
+
+    def setUp(self):
+        cleanUpRedisKeys()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    def test_deferred_unlock(self):
+        """test unlock queued, done by flush and before next lock"""
+        client1 = RwlockClient(defer_unlock=4)
+        client2 = RwlockClient(pid=str(os.getpid() - 1))
+        rwlocks = [client1.lock('N-#' + str(i), Rwlock.WRITE)
+                   for i in range(10)]
+        for rwlock in rwlocks:
+            self.assertTrue(client1.unlock(rwlock))
+        self.assertTrue(client1.unlock(rwlocks[0]))
+        self.assertEqual(client1.flush(), 1)
+        self.assertEqual(client1.flush(), 0)
+        for rwlock in rwlocks:
+            self.assertFalse(client1.redis.exists(rwlock.lock_key()))
+        # unlock queued before lock done first
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        client1.unlock(rwlock1)
+        self.assertEqual(client1.lock('N1', Rwlock.READ).status, Rwlock.OK)
+        self.assertFalse(client1.redis.exists(rwlock1.lock_key()))
+        self.assertEqual(client2.lock('N1', Rwlock.WRITE).status,
+                         Rwlock.FAIL)
+        self.assertEqual(client1.unlock_all(), 1)
+        client1.close()
+
+    def test_deferred_unlock_all(self):
+        """test unlock_all after queued unlocks"""
+        client = RwlockClient(defer_unlock=100)
+        client.lock('N1', Rwlock.WRITE)
+        client.unlock(client.lock('N2', Rwlock.WRITE))
+        self.assertEqual(client.unlock_all(), 1)
+        self.assertEqual(client.flush(), 0)
+        client.close()
+
+
+class TestRedisRwlock_replica(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.dumper = runRedisServer(7822, '--replicaof',
+                                                'localhost', '6379')
+        cls.replica = redis.StrictRedis(port=7822)
+
+    @classmethod
+    def tearDownClass(cls):
+        terminateRedisServer(cls.server, cls.dumper)
+
+    def setUp(self):
+        cleanUpRedisKeys()
+        self.client = RwlockClient(replica=self.replica)
+        self.sync()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    # Waits until replica has all writes to primary so far
+    def sync(self):
+        t1 = time.monotonic()
+        while self.client.redis.wait(1, 1000) < 1:
+            self.assertTrue(time.monotonic() - t1 < 10)
+
+    def calls(self, redis, command):
+        return redis.info('commandstats').get(
+            'cmdstat_' + command, dict()).get('calls', 0)
+
+    def test_gc_replica(self):
+        """test gc scans replica, removes stale locks from primary"""
+        other = RwlockClient(pid='999999')
+        other.lock('N-GC1', Rwlock.READ)
+        other.lock('N-GC2', Rwlock.WRITE)
+        other.redis.client_setname('other')
+        self.sync()
+        scans = self.calls(self.client.redis, 'scan')
+        self.assertEqual(self.client.gc(), (2, 0, 1))
+        self.assertEqual(self.calls(self.client.redis, 'scan'), scans)
+        self.assertGreater(self.calls(self.replica, 'scan'), 0)
+        self.assertEqual(self.client.lock('N-GC2', Rwlock.WRITE).status,
+                         Rwlock.OK)
+        self.assertEqual(self.client.unlock_all(), 1)
+        with self.assertRaises(ValueError):
+            RwlockClient(backend=self.client.backend, replica=self.replica)
+
+    def test_deadlock_replica(self):
+        """test cycle of lagging replica confirmed in primary"""
+        backend = self.client.backend
+        myself = self.client.get_owner()
+        self.client.redis.sadd('wait:' + myself, 'other')
+        self.client.redis.sadd('wait:other', myself)
+        self.sync()
+        self.assertEqual(backend.waitees(myself), [{'other'}])
+        self.assertTrue(backend.confirm_cycle([myself, 'other']))
+        # replica not seeing wait removed yet
+        self.replica.replicaof('NO', 'ONE')
+        try:
+            self.client.redis.delete('wait:other')
+            self.assertEqual(backend.waitees('other'), [{myself}])
+            self.assertFalse(backend.confirm_cycle([myself, 'other']))
+        finally:
+            self.client.redis.delete('wait:' + myself)
+            self.replica.replicaof('localhost', 6379)
+            self.sync()
+
+
+class TestRedisRwlock_watchdog(unittest.TestCase):
+
+    def setUp(self):
+        cleanUpRedisKeys()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    def test_watchdog(self):
+        """test long hold reported with call site, noted for others"""
+        reports = list()
+        reported = threading.Event()
+
+        def on_long_hold(name, mode, held, site, stack):
+            reports.append((name, mode, held, site, stack))
+            reported.set()
+        client = RwlockClient(watchdog=0.1, on_long_hold=on_long_hold)
+        other = RwlockClient(pid=str(os.getpid() - 1))
+        client.unlock(client.lock('N2', Rwlock.WRITE))
+        rwlock = client.lock('N1', Rwlock.WRITE)
+        self.assertEqual(other.holders('N1'),
+                         [(Rwlock.WRITE, client.get_owner(), None)])
+        self.assertTrue(reported.wait(2))
+        name, mode, held, site, stack = reports[0]
+        self.assertEqual((name, mode), ('N1', Rwlock.WRITE))
+        self.assertGreater(held, 0.1)
+        self.assertIn('test_redisrwlock.py:', site)
+        self.assertTrue(site.endswith(' in test_watchdog'))
+        self.assertIn('test_watchdog', stack)
+        self.assertEqual(other.holders('N1'),
+                         [(Rwlock.WRITE, client.get_owner(),
+                           site + ' [MainThread]')])
+        client.unlock(rwlock)
+        self.assertFalse(client.redis.exists('site:' + client.get_owner()))
+        client.lock('N1', Rwlock.READ)
+        time.sleep(0.3)
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(client.unlock_all(), 1)
+        self.assertFalse(client.redis.exists('site:' + client.get_owner()))
+        client.close()
+
+
+class TestRedisRwlock_optimistic_read(unittest.TestCase):
+
+    def setUp(self):
+        cleanUpRedisKeys()
+
+    def tearDown(self):
+        self.assertFalse(cleanUpRedisKeys())
+
+    def test_version(self):
+        """test version odd while write lock granted"""
+        client = RwlockClient()
+        version = client.read_begin('N1')
+        self.assertEqual(version, 0)
+        rwlock1 = client.lock('N1', Rwlock.WRITE)
+        rwlock2 = client.lock('N1', Rwlock.WRITE)
+        self.assertIsNone(client.read_begin('N1'))
+        client.unlock(rwlock2)
+        self.assertIsNone(client.read_begin('N1'))
+        client.unlock(rwlock1)
+        self.assertEqual(client.read_begin('N1'), 2)
+        self.assertFalse(client.read_validate('N1', version))
+        # READ lock does not change version
+        rwlock = client.lock('N1', Rwlock.READ)
+        client.unlock(rwlock)
+        self.assertTrue(client.read_validate('N1', 2))
+        # unlock_all and gc release write lock, too
+        client.lock('N1', Rwlock.WRITE)
+        client.unlock_all()
+        self.assertEqual(client.read_begin('N1'), 4)
+        client_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+RwlockClient().lock('N1', Rwlock.WRITE)
+'''
+        subprocess.Popen(['python3', '-c', client_command]).wait()
+        self.assertIsNone(client.read_begin('N1'))
+        client.gc()
+        self.assertEqual(client.read_begin('N1'), 6)
+
+    def test_optimistic_read(self):
+        """test optimistic read retries, then falls back to lock"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient()
+        calls = list()
+
+        def read():
+            calls.append(client2.redis.exists('rsrc:N1'))
+            return len(calls)
+        self.assertEqual(client2.optimistic_read('N1', read), (Rwlock.OK, 1))
+        self.assertEqual(calls, [0])
+
+        # writer intervenes every read
+        def write():
+            rwlock = client1.lock('N1', Rwlock.WRITE)
+            client1.unlock(rwlock)
+            return read()
+        calls.clear()
+        self.assertEqual(client2.optimistic_read('N1', write,
+                                                 retry_interval=0),
+                         (Rwlock.OK, 4))
+        # read under READ lock at last
+        self.assertEqual(calls, [0, 0, 0, 1])
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertEqual(client2.optimistic_read('N1', read, retries=1,
+                                                 timeout=0),
+                         (Rwlock.FAIL, None))
+        client1.unlock(rwlock1)
+
 
 class TestRedisRwlock_gc(unittest.TestCase):
 
@@ -155,6 +853,23 @@ client.lock('N-GC1', Rwlock.READ)
         self.assertEqual(rwlock2.status, Rwlock.OK)
         client2.unlock(rwlock2)
 
+    def test_gc_counted(self):
+        """test gc of counted lock"""
+        client1_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+client = RwlockClient()
+client.lock('N-GC1', Rwlock.COUNTED, capacity=1)
+'''
+        client1 = subprocess.Popen(['python3', '-c', client1_command])
+        client1.wait()
+        client2 = RwlockClient()
+        rwlock2 = client2.lock('N-GC1', Rwlock.COUNTED, capacity=1)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        self.assertEqual(client2.gc(), (1, 0, 1))
+        rwlock2 = client2.lock('N-GC1', Rwlock.COUNTED, capacity=1)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+
     def test_gc_wait(self):
         """test gc when there is stale wait set"""
         # Client1: N-GC1 ------------ terminate client2 --- gc
@@ -175,6 +890,32 @@ rwlock2_1 = client.lock('N-GC1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
         self.assertTrue(runGcExpect(message))
         client1.unlock(rwlock1_1)
 
+    def test_gc_queue(self):
+        """test gc removes queued waitor no more active"""
+        client1 = RwlockClient(pid=str(os.getpid() - 1))
+        client2 = RwlockClient()
+        rwlock1_1 = client1.lock('N-GC1', Rwlock.READ)
+        client3_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+client = RwlockClient()
+client.lock('N-GC1', Rwlock.WRITE, timeout=Rwlock.FOREVER, priority=5)
+'''
+        client3 = subprocess.Popen(['python3', '-c', client3_command])
+        t1 = time.monotonic()
+        while not client2.redis.exists('queue:N-GC1'):
+            self.assertTrue(time.monotonic() - t1 < 5)
+            time.sleep(0.01)
+        client3.terminate()
+        client3.wait()
+        self.assertEqual(client2.lock('N-GC1', Rwlock.READ).status,
+                         Rwlock.FAIL)
+        self.assertEqual(client2.gc(), (0, 1, 0))
+        self.assertFalse(client2.redis.exists('queue:N-GC1'))
+        rwlock2_1 = client2.lock('N-GC1', Rwlock.READ)
+        self.assertEqual(rwlock2_1.status, Rwlock.OK)
+        client2.unlock(rwlock2_1)
+        client1.unlock(rwlock1_1)
+
 
 class TestRedisRwlock_deadlock(unittest.TestCase):
 
@@ -211,10 +952,134 @@ sys.exit(status)
         client1.unlock(rwlock1_2)
         self.assertEqual(client2.wait(), 0)
 
+    def test_deadlock_priority(self):
+        """test deadlock victim of lower priority"""
+        # Client1: N-DL1 --------------- N-DL2 (victim)
+        # Client2:       N-DL2 --- N-DL1 (priority 1)
+        client1 = RwlockClient()
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+client = RwlockClient()
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER,
+                        priority=1)
+status = 0 if rwlock2_1.status == Rwlock.OK else 1
+client.unlock_all()
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command])
+        time.sleep(1)
+        rwlock1_2 = client1.lock('N-DL2', Rwlock.READ, timeout=2)
+        self.assertEqual(rwlock1_2.status, Rwlock.DEADLOCK)
+        client1.unlock(rwlock1_1)
+        self.assertEqual(client2.wait(), 0)
+
+    def test_deadlock_counted(self):
+        """test deadlock detection with counted lock at capacity"""
+        # Client1: N-DL1(counted) --------------- N-DL2
+        # Client2:          N-DL2 --- N-DL1(counted) (victim)
+        client1 = RwlockClient()
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.COUNTED, capacity=1)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+client = RwlockClient()
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.COUNTED, timeout=Rwlock.FOREVER,
+                        capacity=1)
+status = 0 if rwlock2_1.status == Rwlock.DEADLOCK else 1
+client.unlock(rwlock2_2) # unblock client1 from lock
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command])
+        time.sleep(1)
+        rwlock1_2 = client1.lock('N-DL2', Rwlock.WRITE, timeout=2)
+        self.assertEqual(rwlock1_2.status, Rwlock.OK)
+        client1.unlock(rwlock1_1)
+        client1.unlock(rwlock1_2)
+        self.assertEqual(client2.wait(), 0)
+
+    def test_deadlock_lock_any(self):
+        """test waiting for any of names is not deadlock while one of
+        them is held by owner not waiting"""
+        # Client1: N-DL1 ------- N-DL2 or N-DL3 ------ (N-DL3 granted)
+        # Client2:       N-DL2 -------------- N-DL1 -------- (granted)
+        # Client3: N-DL3 ------------------------ unlock
+        client1 = RwlockClient()
+        client3 = RwlockClient(pid=str(os.getpid() - 1))
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.WRITE)
+        client3.lock('N-DL3', Rwlock.WRITE)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+client = RwlockClient()
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+status = 0 if rwlock2_1.status == Rwlock.OK else 1
+client.unlock_all()
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command])
+        time.sleep(1)
+        threading.Timer(1, client3.unlock_all).start()
+        rwlock1_2 = client1.lock_any(['N-DL2', 'N-DL3'], Rwlock.WRITE,
+                                     timeout=3)
+        self.assertEqual((rwlock1_2.status, rwlock1_2.name),
+                         (Rwlock.OK, 'N-DL3'))
+        client1.unlock(rwlock1_1)
+        client1.unlock(rwlock1_2)
+        self.assertEqual(client2.wait(), 0)
+
+    def test_deadlock_lock_any_waiting(self):
+        """test waiting for any of names is not deadlock while one of
+        them is held by owner waiting out of cycle"""
+        # Client1: N-DL1 ------- N-DL2 or N-DL3 ------ (N-DL3 granted)
+        # Client2:       N-DL2 -------------- N-DL1 -------- (granted)
+        # Client3: N-DL3 --- N-DL4 ----------- (timeout) unlock
+        # Client4: N-DL4
+        client1 = RwlockClient()
+        client4 = RwlockClient(pid=str(os.getpid() - 1))
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.WRITE)
+        client4.lock('N-DL4', Rwlock.WRITE)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+client = RwlockClient()
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+status = 0 if rwlock2_1.status == Rwlock.OK else 1
+client.unlock_all()
+sys.exit(status)
+'''
+        client3_command = '''\
+from redisrwlock import Rwlock, RwlockClient
+import sys
+client = RwlockClient()
+rwlock3_3 = client.lock('N-DL3', Rwlock.WRITE)
+rwlock3_4 = client.lock('N-DL4', Rwlock.WRITE, timeout=2)
+status = 0 if rwlock3_4.status == Rwlock.TIMEOUT else 1
+client.unlock_all()
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command])
+        client3 = subprocess.Popen(['python3', '-c', client3_command])
+        time.sleep(1)
+        rwlock1_2 = client1.lock_any(['N-DL2', 'N-DL3'], Rwlock.WRITE,
+                                     timeout=4)
+        self.assertEqual((rwlock1_2.status, rwlock1_2.name),
+                         (Rwlock.OK, 'N-DL3'))
+        client1.unlock(rwlock1_1)
+        client1.unlock(rwlock1_2)
+        client4.unlock_all()
+        self.assertEqual(client2.wait(), 0)
+        self.assertEqual(client3.wait(), 0)
+
     def test_deadlock_with_many_locks(self):
         """test deadlock when victim has many granted locks.
 
-        cover [lock can be deleted if DEADLOCK victim unlocked]
+        cover [empty if DEADLOCK victim unlocked already]
         in _oldest_lock_access_time()"""
         # Client1: N-DL1 ------------------- N-DL2
         # Client2:       ... N-DL2 --- N-DL1 (victim)
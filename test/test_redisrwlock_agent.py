@@ -0,0 +1,207 @@
+from redisrwlock import Rwlock, RwlockClient, RwlockAgent, RwlockAgentClient
+from redisrwlock import CompactRedisBackend
+from test_redisrwlock_connection import runRedisServer, terminateRedisServer
+
+import unittest
+import json
+import os
+import redis
+import socket
+import tempfile
+import threading
+import time
+
+
+def setUpModule():
+    global _server, _dumper
+    _server, _dumper = runRedisServer(port=7799)
+
+
+def tearDownModule():
+    global _server, _dumper
+    terminateRedisServer(_server, _dumper)
+
+
+class TestRedisRwlock_agent(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(port=7799)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'agent.sock')
+        self.agent = RwlockAgent(redis.StrictRedis(port=7799), self.path)
+        self.agent.start()
+
+    def tearDown(self):
+        self.agent.stop()
+        self.tempdir.cleanup()
+        self.assertFalse(RwlockClient(self.redis)._clear_all())
+
+    def test_agent_lock(self):
+        """test lock and unlock through agent"""
+        client = RwlockAgentClient(self.path)
+        rwlock = client.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertEqual(rwlock.pid, str(os.getpid()))
+        self.assertEqual(rwlock.token, 1)
+        self.assertTrue(self.redis.exists(rwlock.lock_key()))
+        self.assertTrue(client.unlock(rwlock))
+        self.assertFalse(client.unlock(rwlock))
+        client.close()
+
+    def test_agent_priority(self):
+        """test agent requests ranked with queued waitors"""
+        client1 = RwlockClient(self.redis, pid=str(os.getpid() - 1))
+        client2 = RwlockClient(self.redis, pid=str(os.getpid() - 2))
+        client3 = RwlockAgentClient(self.path)
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        result = dict()
+
+        def wait_with_priority():
+            result['rwlock'] = client2.lock('N1', Rwlock.WRITE, timeout=2,
+                                            priority=5)
+        thread = threading.Thread(target=wait_with_priority)
+        thread.start()
+        t1 = time.monotonic()
+        while not self.redis.exists('queue:N1'):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        # READ through agent is not granted while WRITE of higher
+        # priority waits, but a request of close deadline goes first
+        rwlock3 = client3.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock3.status, Rwlock.FAIL)
+        rwlock3 = client3.lock('N1', Rwlock.READ, deadline=0.05)
+        self.assertEqual(rwlock3.status, Rwlock.OK)
+        client3.unlock(rwlock3)
+        client1.unlock(rwlock1)
+        thread.join()
+        self.assertEqual(result['rwlock'].status, Rwlock.OK)
+        client2.unlock(result['rwlock'])
+        client3.close()
+
+    def test_agent_conflict(self):
+        """test agent client conflicts with direct client"""
+        client1 = RwlockClient(self.redis, pid=str(os.getpid() - 1))
+        client2 = RwlockAgentClient(self.path)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        rwlock2 = client2.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        rwlock2 = client2.lock('N1', Rwlock.READ, timeout=0.2)
+        self.assertEqual(rwlock2.status, Rwlock.TIMEOUT)
+        client1.unlock(rwlock1)
+        rwlock1 = client1.lock('N1', Rwlock.COUNTED, capacity=2)
+        with self.assertRaises(ValueError):
+            client2.lock('N1', Rwlock.COUNTED, capacity=3)
+        client1.unlock(rwlock1)
+        client2.close()
+
+    def test_agent_wait(self):
+        """test agent waits for readers on behalf of local processes"""
+        client1 = RwlockClient(self.redis, pid=str(os.getpid() - 1))
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        statuses = list()
+
+        def reader(pid):
+            client = RwlockAgentClient(self.path, pid=pid)
+            rwlock = client.lock('N1', Rwlock.READ, timeout=2,
+                                 retry_interval=0.05)
+            statuses.append(rwlock.status)
+            client.unlock(rwlock)
+            client.close()
+        readers = [threading.Thread(target=reader, args=(os.getpid() + i,))
+                   for i in range(1, 4)]
+        for thread in readers:
+            thread.start()
+        time.sleep(0.3)
+        client1.unlock(rwlock1)
+        for thread in readers:
+            thread.join()
+        self.assertEqual(statuses, [Rwlock.OK] * 3)
+
+    def test_agent_gc(self):
+        """test gc keeps locks of proxied owner, released on disconnect"""
+        client = RwlockAgentClient(self.path, pid=os.getpid() + 1)
+        rwlock = client.lock('N1', Rwlock.WRITE)
+        client.lock('N1', Rwlock.WRITE)
+        RwlockClient(self.redis).gc()
+        self.assertTrue(self.redis.exists(rwlock.lock_key()))
+        client.close()
+        # wait agent notices disconnect
+        t1 = time.monotonic()
+        while self.redis.sismember(self.agent.agent_key(),
+                                   client.get_owner()):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        self.assertFalse(self.redis.exists(rwlock.lock_key()))
+
+    def test_agent_disconnect(self):
+        """test waiting request cancelled when local process gone"""
+        client1 = RwlockClient(self.redis, pid=str(os.getpid() - 1))
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        owner = 'test/' + str(os.getpid() + 1)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        stream = sock.makefile('rwb')
+        stream.write(json.dumps(dict(op='hello', node='test',
+                                     pid=os.getpid() + 1)).encode() + b'\n')
+        stream.flush()
+        self.assertEqual(json.loads(stream.readline().decode()), dict())
+        stream.write(json.dumps(dict(op='lock', name='N1', mode=Rwlock.WRITE,
+                                     timeout=Rwlock.FOREVER,
+                                     retry_interval=0.05)).encode() + b'\n')
+        stream.flush()
+        time.sleep(0.2)
+        self.assertTrue(self.redis.exists('wait:' + owner))
+        stream.close()
+        sock.close()
+        # wait agent notices disconnect
+        t1 = time.monotonic()
+        while self.redis.sismember(self.agent.agent_key(), owner) or \
+                self.redis.exists('wait:' + owner):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        client1.unlock(rwlock1)
+        time.sleep(0.2)
+        self.assertFalse(self.redis.exists(
+            Rwlock('N1', Rwlock.WRITE, 'test', str(os.getpid() + 1))
+            .lock_key()))
+
+
+class TestRedisRwlock_agent_compact(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(port=7799)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'agent.sock')
+        self.agent = RwlockAgent(
+            path=self.path,
+            backend=CompactRedisBackend(redis.StrictRedis(port=7799)))
+        self.agent.start()
+
+    def tearDown(self):
+        self.agent.stop()
+        self.tempdir.cleanup()
+        self.assertFalse(CompactRedisBackend(self.redis).gc()[0])
+        # only interned owners and versions remain
+        for key in self.redis.scan_iter(match='{c}:*'):
+            self.assertIn(key, (b'{c}:oid', b'{c}:owner', b'{c}:next',
+                                b'{c}:ver'))
+        CompactRedisBackend(self.redis).clear_all()
+
+    def test_agent_compact(self):
+        """test agent locks through compact layout backend"""
+        client1 = RwlockClient(backend=CompactRedisBackend(self.redis),
+                               pid=str(os.getpid() - 1))
+        client2 = RwlockAgentClient(self.path)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        rwlock2 = client2.lock('N1', Rwlock.READ, timeout=0.2)
+        self.assertEqual(rwlock2.status, Rwlock.TIMEOUT)
+        client1.unlock(rwlock1)
+        rwlock2 = client2.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        self.assertEqual(client1.lock('N1', Rwlock.WRITE).status, Rwlock.FAIL)
+        self.assertTrue(client2.unlock(rwlock2))
+        self.assertFalse(client2.unlock(rwlock2))
+        # No queue in this layout
+        with self.assertRaises(ValueError):
+            client2.lock('N1', Rwlock.WRITE, timeout=1, priority=1)
+        client2.close()
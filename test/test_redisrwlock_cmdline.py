@@ -1,10 +1,15 @@
 # Coverage test of __main__.py, no tight checks on output messages
+from redisrwlock import Rwlock, RwlockAgentClient, RwlockClient
+from redisrwlock.gcdaemon import RwlockGcDaemon
+from redis import StrictRedis
 from test_redisrwlock_connection import runRedisServer, terminateRedisServer
 
 import unittest
 import os
 import signal
 import subprocess
+import tempfile
+import time
 
 
 # Run command return exit status and output messages.
@@ -81,6 +86,101 @@ class TestRedisRwlock_cmdline(unittest.TestCase):
         cmd, output = runCmdOutput(['-p', '7788', '-i', '1000'])
         self.assertEqual(cmd.returncode, os.EX_OK)
 
+    def test_agent(self):
+        """test agent command and --socket option"""
+        # empty socket path
+        cmd, output = runCmdOutput(['agent', '-p', '7788', '-u', ''])
+        self.assertEqual(cmd.returncode, os.EX_USAGE)
+        # run agent, see 1 line, lock through it, then kill -INT
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'agent.sock')
+            cmd, output = runCmdOutput(['agent', '-p', '7788', '-u', path],
+                                       wait=False, limit=1)
+            t1 = time.monotonic()
+            while not os.path.exists(path):
+                self.assertTrue(time.monotonic() - t1 < 5)
+                time.sleep(0.01)
+            client = RwlockAgentClient(path)
+            rwlock = client.lock('N1', Rwlock.WRITE)
+            self.assertEqual(rwlock.status, Rwlock.OK)
+            client.close()
+            cmd.send_signal(signal.SIGINT)
+            self.assertEqual(cmd.wait(), 1)
+            cmd.stdout.close()
+            self.assertFalse(os.path.exists(path))
+
+    def test_targets(self):
+        """test --target and --config options"""
+        for option in (['-t', ':7788'], ['-t', 'localhost:x'],
+                       ['-t', 'localhost@:7788'], ['--replica', 'localhost/1'],
+                       ['-t', 'localhost:7788', '--replica', 'localhost'],
+                       ['-c', '/nonexistent']):
+            cmd, output = runCmdOutput(option)
+            self.assertEqual(cmd.returncode, os.EX_USAGE)
+        cmd, output = runCmdOutput(['-t', 'localhost:7788',
+                                    '-t', 'localhost:7788/1'])
+        self.assertEqual(cmd.returncode, os.EX_OK)
+        self.assertTrue(any('localhost:7788/1' in line for line in output))
+        cmd, output = runCmdOutput(['-t', 'localhost:7788/1@localhost:7788'])
+        self.assertEqual(cmd.returncode, os.EX_OK)
+        self.assertTrue(any('localhost:7788/1@localhost:7788' in line
+                            for line in output))
+        cmd, output = runCmdOutput(['-p', '7788',
+                                    '--replica', 'localhost:7788'])
+        self.assertEqual(cmd.returncode, os.EX_OK)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'targets')
+            with open(path, 'w') as f:
+                f.write('# gc targets\nlocalhost:7788/2\n\n')
+            cmd, output = runCmdOutput(['-c', path])
+            self.assertEqual(cmd.returncode, os.EX_OK)
+            with open(path, 'a') as f:
+                f.write('localhost:7789  # not running\n')
+            cmd, output = runCmdOutput(['-c', path])
+            self.assertEqual(cmd.returncode, os.EX_UNAVAILABLE)
+
+    def test_gc_daemon(self):
+        """test gc interval adapts to stale locks found"""
+        daemon = RwlockGcDaemon([('localhost', 7788, 3)], interval=8)
+        target = daemon.targets[0]
+        client = RwlockClient(StrictRedis(port=7788, db=3), pid='999999')
+        client.lock('N-GC1', Rwlock.READ)
+        client.redis.client_setname('other')
+        self.assertEqual(daemon.run_once(), [(1, 0, 1)])
+        self.assertEqual(target.interval, 4)
+        self.assertEqual(daemon.run_once(), [(0, 0, 0)])
+        self.assertEqual(target.interval, 8)
+
+    def test_replay(self):
+        """test replay command and its options"""
+        # no trace file
+        cmd, output = runCmdOutput(['replay'])
+        self.assertEqual(cmd.returncode, os.EX_USAGE)
+        for option in (['--timeout', '-2'], ['--retry-interval', '0'],
+                       ['--name-depth', 'x']):
+            cmd, output = runCmdOutput(['replay'] + option + ['trace'])
+            self.assertEqual(cmd.returncode, os.EX_USAGE)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'trace.ndjson')
+            with open(path, 'w') as f:
+                f.write('{"ev":"lock","owner":"A","names":["T:1"],'
+                        '"name":"T:1","mode":"W","capacity":1,'
+                        '"timeout":0,"retry":0.1,"t":0,"wait":0,'
+                        '"attempts":1,"status":"OK"}\n')
+                f.write('{"ev":"lock","owner":"B","names":["T:2"],'
+                        '"name":"T:2","mode":"W","capacity":1,'
+                        '"timeout":0,"retry":0.1,"t":0.1,"wait":0,'
+                        '"attempts":1,"status":"OK"}\n')
+                f.write('{"ev":"unlock_all","owner":"A","t":1,"count":1}\n')
+            cmd, output = runCmdOutput(['replay', path])
+            self.assertEqual(cmd.returncode, os.EX_OK)
+            self.assertIn('OK 2', output[1])
+            cmd, output = runCmdOutput(['replay', '--name-depth', '1',
+                                        '--timeout', '0.5',
+                                        '--retry-interval', '0.2', path])
+            self.assertEqual(cmd.returncode, os.EX_OK)
+            self.assertIn('OK 1', output[1])
+
     def test_option_server_port(self):
         """test --server and --port options"""
         # empty redis-server host name
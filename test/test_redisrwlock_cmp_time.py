@@ -17,3 +17,7 @@ class TestRedisRwlock(unittest.TestCase):
         self.assertTrue(_cmp_time('0.30', '0.4') > 0)
         self.assertTrue(_cmp_time('0.3', '0.3') == 0)
         self.assertTrue(_cmp_time('0.3', '0.4') < 0)
+        # integer micro-seconds, and mixed with 'sec.usec'
+        self.assertTrue(_cmp_time('30000000', '4000000') > 0)
+        self.assertTrue(_cmp_time('4000000', '4.0') == 0)
+        self.assertTrue(_cmp_time('4000001', '4.2') < 0)
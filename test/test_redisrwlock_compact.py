@@ -0,0 +1,252 @@
+from redisrwlock import Rwlock, RwlockClient, CompactRedisBackend
+from redisrwlock.compact import migrate
+from test_redisrwlock_connection import runRedisServer, terminateRedisServer
+
+import unittest
+import os
+import redis
+import subprocess
+import time
+
+
+def setUpModule():
+    global _server, _dumper
+    _server, _dumper = runRedisServer(port=7800)
+
+
+def tearDownModule():
+    global _server, _dumper
+    terminateRedisServer(_server, _dumper)
+
+
+class TestRedisRwlock_compact(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.StrictRedis(port=7800)
+
+    def tearDown(self):
+        self.assertFalse(RwlockClient(self.redis)._clear_all())
+        backend = CompactRedisBackend(self.redis)
+        self.assertFalse(backend.gc()[0])
+        # only interned owners and versions remain
+        for key in self.redis.scan_iter(match='{c}:*'):
+            self.assertIn(key, (b'{c}:oid', b'{c}:owner', b'{c}:next',
+                                b'{c}:ver'))
+        backend.clear_all()
+
+    def client(self, pid=None):
+        return RwlockClient(backend=CompactRedisBackend(self.redis), pid=pid)
+
+    def test_lock(self):
+        """test lock, nesting and unlock"""
+        client = self.client()
+        rwlock1 = client.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock1.status, Rwlock.OK)
+        rwlock2 = client.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        rwlock3 = client.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock3.status, Rwlock.OK)
+        self.assertTrue(client.unlock(rwlock3))
+        self.assertTrue(client.unlock(rwlock2))
+        self.assertTrue(client.unlock(rwlock1))
+        self.assertFalse(client.unlock(rwlock1))
+        # resource id released with its last grant
+        self.assertFalse(self.redis.hexists('{c}:rid', 'N1'))
+
+    def test_lock_conflict(self):
+        """test readers share, writer excludes"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        rwlock2 = client2.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE, timeout=0.2)
+        self.assertEqual(rwlock2.status, Rwlock.TIMEOUT)
+        client1.unlock(rwlock1)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        self.assertEqual(client2.unlock_all(), 1)
+
+    def test_holders(self):
+        """test holders of resource with owners resolved"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        self.assertEqual(client2.holders('N1'), [])
+        client1.lock('N1', Rwlock.READ)
+        client2.lock('N1', Rwlock.READ)
+        self.assertEqual(sorted(client2.holders('N1')),
+                         sorted([(Rwlock.READ, client1.get_owner(), None),
+                                 (Rwlock.READ, client2.get_owner(), None)]))
+        client1.unlock_all()
+        client2.unlock_all()
+        self.assertEqual(client2.holders('N1'), [])
+
+    def test_lock_counted(self):
+        """test counted lock granted up to capacity"""
+        clients = [self.client(pid=os.getpid() - i) for i in range(3)]
+        for client in clients[:2]:
+            rwlock = client.lock('N1', Rwlock.COUNTED, capacity=2)
+            self.assertEqual(rwlock.status, Rwlock.OK)
+        rwlock = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        with self.assertRaises(ValueError):
+            clients[2].lock('N1', Rwlock.COUNTED, capacity=3)
+        with self.assertRaises(ValueError):
+            clients[2].lock_any(['N1'], Rwlock.COUNTED, capacity=3)
+        rwlock = clients[2].lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        self.assertEqual(clients[0].unlock_all(), 1)
+        rwlock = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertEqual(clients[1].unlock_all(), 1)
+        self.assertEqual(clients[2].unlock_all(), 1)
+        rwlock = clients[0].lock('N1', Rwlock.COUNTED, capacity=3)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertEqual(clients[0].unlock_all(), 1)
+
+    def test_lock_any(self):
+        """test lock any of names, from offset"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        client1.lock('N1', Rwlock.WRITE)
+        rwlock = client2.lock_any(['N1', 'N2', 'N3'], Rwlock.WRITE, offset=0)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N2'))
+        rwlock = client2.lock_any(['N1', 'N2', 'N3'], Rwlock.WRITE, offset=2)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N3'))
+        rwlock = client2.lock_any(['N1'], Rwlock.READ, timeout=0.2)
+        self.assertEqual((rwlock.status, rwlock.name),
+                         (Rwlock.TIMEOUT, None))
+        self.assertEqual(client2.unlock_all(), 2)
+        self.assertEqual(client1.unlock_all(), 1)
+        with self.assertRaises(ValueError):
+            client2.lock('N1', Rwlock.WRITE, timeout=1, deadline=0.5)
+        with self.assertRaises(ValueError):
+            client2.lock_any(['N1'], Rwlock.WRITE, priority=1)
+
+    def test_fencing_token(self):
+        """test fencing token increases with each WRITE grant"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertEqual(client1.lock('N1', Rwlock.WRITE).token,
+                         rwlock1.token)
+        self.assertIsNone(client1.lock('N1', Rwlock.READ).token)
+        client1.unlock_all()
+        rwlock2 = client2.lock_any(['N1'], Rwlock.WRITE)
+        self.assertGreater(rwlock2.token, rwlock1.token)
+        self.assertIsNone(client2.lock_any(['N2'], Rwlock.READ).token)
+        self.assertEqual(client2.unlock_all(), 2)
+
+    def test_optimistic_read(self):
+        """test version bumped by write lock, unlock and unlock_all"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        version = client2.read_begin('N1')
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertIsNone(client2.read_begin('N1'))
+        self.assertFalse(client2.read_validate('N1', version))
+        self.assertEqual(client2.optimistic_read('N1', lambda: 1, retries=1,
+                                                 timeout=0),
+                         (Rwlock.FAIL, None))
+        client1.unlock(rwlock1)
+        self.assertEqual(client2.optimistic_read('N1', lambda: 1),
+                         (Rwlock.OK, 1))
+        client1.lock('N1', Rwlock.WRITE)
+        client1.unlock_all()
+        self.assertEqual(client2.read_begin('N1'), version + 4)
+
+    def test_deadlock(self):
+        """test deadlock detection between processes"""
+        # Client1: N-DL1 --------------- N-DL2
+        # Client2:       N-DL2 --- N-DL1 (victim)
+        client1 = self.client()
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.WRITE)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient, CompactRedisBackend
+import redis, sys
+backend = CompactRedisBackend(redis.StrictRedis(port=7800))
+client = RwlockClient(backend=backend)
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+status = 0 if rwlock2_1.status == Rwlock.DEADLOCK else 1
+client.unlock(rwlock2_2) # unblock client1 from lock
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command])
+        time.sleep(1)
+        rwlock1_2 = client1.lock('N-DL2', Rwlock.READ, timeout=2)
+        self.assertEqual(rwlock1_2.status, Rwlock.OK)
+        client1.unlock(rwlock1_1)
+        client1.unlock(rwlock1_2)
+        self.assertEqual(client2.wait(), 0)
+
+    def test_gc(self):
+        """test gc by lock then exit without unlock"""
+        client1_command = '''\
+from redisrwlock import Rwlock, RwlockClient, CompactRedisBackend
+import redis
+backend = CompactRedisBackend(redis.StrictRedis(port=7800))
+client = RwlockClient(backend=backend)
+client.lock('N-GC1', Rwlock.READ)
+client.lock('N-GC2', Rwlock.WRITE)
+'''
+        client1 = subprocess.Popen(['python3', '-c', client1_command])
+        client1.wait()
+        client2 = self.client()
+        rwlock2 = client2.lock('N-GC1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        self.assertEqual(client2.gc(), (2, 0, 1))
+        rwlock2 = client2.lock('N-GC1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+
+    def test_migrate(self):
+        """test migration from default layout uses less memory"""
+        client = RwlockClient(redis.StrictRedis(port=7800))
+        for i in range(0, 100):
+            client.lock('N-#' + str(i), Rwlock.READ)
+        client.lock('N-#0', Rwlock.READ)
+        before = client.backend.memory_usage()
+        self.assertEqual(before[1], 100)
+        # refused while owner of default layout active
+        with self.assertRaises(ValueError):
+            migrate(self.redis)
+        client.redis.connection_pool.disconnect()
+        self.assertEqual(migrate(self.redis), 100)
+        compact = self.client()
+        after = compact.backend.memory_usage()
+        self.assertEqual(after[1], 100)
+        self.assertLess(after[0], before[0])
+        # ref-count and lock time moved, too
+        self.assertEqual(client.backend.memory_usage(), (0, 0))
+        self.assertTrue(compact.unlock(Rwlock('N-#0', Rwlock.READ,
+                                              client.node, client.pid)))
+        self.assertIsNotNone(compact.backend.oldest_grant_time(
+            client.get_owner()))
+        self.assertEqual(compact.unlock_all(), 100)
+
+    def test_migrate_conflict(self):
+        """test lock conflicting in compact layout kept, capacity moved"""
+        client = RwlockClient(redis.StrictRedis(port=7800),
+                              pid=str(os.getpid() + 1))
+        client.lock('N1', Rwlock.READ)
+        client.lock('N2', Rwlock.COUNTED, capacity=2)
+        client.redis.connection_pool.disconnect()
+        compact = self.client(pid=str(os.getpid() - 1))
+        rwlock = compact.lock('N1', Rwlock.WRITE)
+        with self.assertRaises(ValueError):
+            migrate(self.redis)
+        self.assertTrue(self.redis.exists(
+            Rwlock('N1', Rwlock.READ, client.node, client.pid).lock_key()))
+        compact.unlock(rwlock)
+        migrate(self.redis)
+        self.assertFalse(self.redis.exists('cap:N2'))
+        with self.assertRaises(ValueError):
+            compact.lock('N2', Rwlock.COUNTED, capacity=3)
+        self.assertEqual(compact.lock('N2', Rwlock.COUNTED,
+                                      capacity=2).status, Rwlock.OK)
+        self.assertEqual(compact.unlock_all(), 1)
+        self.assertEqual(self.client(pid=client.pid).unlock_all(), 2)
@@ -12,13 +12,13 @@ import subprocess
 _REDIS_READY_MESSAGE = 'ready to accept connections on port '
 
 
-def runRedisServer(port=6379):
-    """runs redis-server"""
+def runRedisServer(port=6379, *args):
+    """runs redis-server, with extra args of redis-server if given"""
     # waits until it can accept client connection by reading its all
     # startup messages until it says 'ready to accept ...', then
     # redirect any following output to DEVNULL.
     port = str(port)
-    server = subprocess.Popen(['redis-server', '--port', port],
+    server = subprocess.Popen(['redis-server', '--port', port] + list(args),
                               stdout=subprocess.PIPE,
                               universal_newlines=True)
     message = _REDIS_READY_MESSAGE + port
@@ -0,0 +1,245 @@
+from redisrwlock import Rwlock, RwlockClient, LocalBackend
+
+import unittest
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class TestRedisRwlock_local(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'locks')
+
+    def tearDown(self):
+        self.assertFalse(LocalBackend(self.path).clear_all())
+        self.tempdir.cleanup()
+
+    def client(self, pid=None):
+        return RwlockClient(backend=LocalBackend(self.path), pid=pid)
+
+    def test_lock(self):
+        """test lock, nesting and unlock"""
+        client = self.client()
+        rwlock1 = client.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock1.status, Rwlock.OK)
+        rwlock2 = client.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        self.assertTrue(client.unlock(rwlock2))
+        self.assertTrue(client.unlock(rwlock1))
+        self.assertFalse(client.unlock(rwlock1))
+        with self.assertRaises(ValueError):
+            RwlockClient(backend=LocalBackend(self.path), linger=1)
+
+    def test_clock(self):
+        """test client time read from backend clock"""
+        client = self.client()
+        self.assertTrue(abs(float(client.redis_time()) - time.time()) < 1)
+
+    def test_lock_conflict(self):
+        """test readers share, writer excludes"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        rwlock2 = client2.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        t1 = time.monotonic()
+        rwlock2 = client2.lock('N1', Rwlock.WRITE, timeout=0.2)
+        self.assertTrue(time.monotonic() - t1 > 0.2)
+        self.assertEqual(rwlock2.status, Rwlock.TIMEOUT)
+        client1.unlock(rwlock1)
+        rwlock2 = client2.lock('N1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
+
+    def test_grow(self):
+        """test table grows beyond initial size"""
+        client = RwlockClient(backend=LocalBackend(self.path, size=256))
+        other = self.client(pid=os.getpid() - 1)
+        for i in range(0, 100):
+            client.lock('N-#' + str(i), Rwlock.WRITE)
+        rwlock = other.lock('N-#99', Rwlock.WRITE)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        self.assertEqual(client.unlock_all(), 100)
+
+    def test_untrusted_file(self):
+        """test table file of other user or symlink refused"""
+        link = os.path.join(self.tempdir.name, 'link')
+        os.symlink(self.path, link)
+        with self.assertRaises(OSError):
+            LocalBackend(link)
+        self.assertFalse(os.path.exists(self.path))
+        LocalBackend(self.path).close()
+        if os.getuid() != 0:
+            return
+        os.chown(self.path, 1, -1)
+        with self.assertRaises(PermissionError):
+            LocalBackend(self.path)
+        os.chown(self.path, 0, -1)
+
+    def test_lock_counted(self):
+        """test counted lock granted up to capacity"""
+        clients = [self.client(pid=os.getpid() - i) for i in range(3)]
+        for client in clients[:2]:
+            rwlock = client.lock('N1', Rwlock.COUNTED, capacity=2)
+            self.assertEqual(rwlock.status, Rwlock.OK)
+        rwlock = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        with self.assertRaises(ValueError):
+            clients[2].lock('N1', Rwlock.COUNTED, capacity=3)
+        with self.assertRaises(ValueError):
+            clients[2].lock_any(['N1'], Rwlock.COUNTED, capacity=3)
+        rwlock = clients[2].lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock.status, Rwlock.FAIL)
+        self.assertEqual(clients[0].unlock_all(), 1)
+        rwlock = clients[2].lock('N1', Rwlock.COUNTED, capacity=2)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertEqual(clients[1].unlock_all(), 1)
+        self.assertEqual(clients[2].unlock_all(), 1)
+        rwlock = clients[0].lock('N1', Rwlock.COUNTED, capacity=3)
+        self.assertEqual(rwlock.status, Rwlock.OK)
+        self.assertEqual(clients[0].unlock_all(), 1)
+
+    def test_lock_any(self):
+        """test lock any of names, from offset"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        client1.lock('N1', Rwlock.WRITE)
+        rwlock = client2.lock_any(['N1', 'N2', 'N3'], Rwlock.WRITE, offset=0)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N2'))
+        rwlock = client2.lock_any(['N1', 'N2', 'N3'], Rwlock.WRITE, offset=2)
+        self.assertEqual((rwlock.status, rwlock.name), (Rwlock.OK, 'N3'))
+        rwlock = client2.lock_any(['N1'], Rwlock.READ, timeout=0.2)
+        self.assertEqual((rwlock.status, rwlock.name),
+                         (Rwlock.TIMEOUT, None))
+        self.assertEqual(client2.unlock_all(), 2)
+        self.assertEqual(client1.unlock_all(), 1)
+
+    def test_lock_priority(self):
+        """test queued waitor granted before others ranked later"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client(pid=os.getpid() - 2)
+        client3 = self.client()
+        rwlock1 = client1.lock('N1', Rwlock.READ)
+        result = dict()
+
+        def wait_with_priority():
+            result['rwlock'] = client2.lock('N1', Rwlock.WRITE, timeout=2,
+                                            priority=5)
+        thread = threading.Thread(target=wait_with_priority)
+        thread.start()
+        t1 = time.monotonic()
+        while client3.backend.urgency(client2.get_owner()) != (5, None):
+            self.assertTrue(time.monotonic() - t1 < 1)
+            time.sleep(0.01)
+        rwlock3 = client3.lock('N1', Rwlock.READ)
+        self.assertEqual(rwlock3.status, Rwlock.FAIL)
+        rwlock3 = client3.lock('N1', Rwlock.READ, deadline=0.05)
+        self.assertEqual(rwlock3.status, Rwlock.OK)
+        client3.unlock(rwlock3)
+        client1.unlock(rwlock1)
+        thread.join()
+        self.assertEqual(result['rwlock'].status, Rwlock.OK)
+        self.assertEqual(client3.backend.urgency(client2.get_owner()),
+                         (0, None))
+        client2.unlock(result['rwlock'])
+
+    def test_fencing_token(self):
+        """test fencing token increases with each WRITE grant"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertEqual(client1.lock('N1', Rwlock.WRITE).token,
+                         rwlock1.token)
+        self.assertIsNone(client1.lock('N1', Rwlock.READ).token)
+        client1.unlock_all()
+        rwlock2 = client2.lock_any(['N1'], Rwlock.WRITE)
+        self.assertGreater(rwlock2.token, rwlock1.token)
+        self.assertIsNone(client2.lock_any(['N2'], Rwlock.READ).token)
+        self.assertEqual(client2.unlock_all(), 2)
+
+    def test_watchdog(self):
+        """test call site of long hold noted for others"""
+        client = RwlockClient(backend=LocalBackend(self.path), watchdog=0.1)
+        other = self.client(pid=os.getpid() - 1)
+        with self.assertLogs('redisrwlock.redisrwlock', 'WARNING') as logs:
+            rwlock = client.lock('N1', Rwlock.READ)
+            t1 = time.monotonic()
+            while not logs.output:
+                self.assertTrue(time.monotonic() - t1 < 2)
+                time.sleep(0.05)
+        self.assertIn('R:N1', logs.output[0])
+        self.assertIn(' in test_watchdog [MainThread]',
+                      other.holders('N1')[0][2])
+        client.unlock(rwlock)
+        self.assertEqual(other.holders('N1'), [])
+        client.close()
+
+    def test_optimistic_read(self):
+        """test version bumped by write lock, unlock and unlock_all"""
+        client1 = self.client(pid=os.getpid() - 1)
+        client2 = self.client()
+        version = client2.read_begin('N1')
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        self.assertIsNone(client2.read_begin('N1'))
+        self.assertFalse(client2.read_validate('N1', version))
+        self.assertEqual(client2.optimistic_read('N1', lambda: 1, retries=1,
+                                                 timeout=0),
+                         (Rwlock.FAIL, None))
+        client1.unlock(rwlock1)
+        self.assertEqual(client2.optimistic_read('N1', lambda: 1),
+                         (Rwlock.OK, 1))
+        client1.lock('N1', Rwlock.WRITE)
+        client1.unlock_all()
+        self.assertEqual(client2.read_begin('N1'), version + 4)
+
+    def test_deadlock(self):
+        """test deadlock detection between processes"""
+        # Client1: N-DL1 --------------- N-DL2
+        # Client2:       N-DL2 --- N-DL1 (victim)
+        client1 = self.client()
+        rwlock1_1 = client1.lock('N-DL1', Rwlock.WRITE)
+        client2_command = '''\
+from redisrwlock import Rwlock, RwlockClient, LocalBackend
+import sys
+client = RwlockClient(backend=LocalBackend(sys.argv[1]))
+rwlock2_2 = client.lock('N-DL2', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+rwlock2_1 = client.lock('N-DL1', Rwlock.WRITE, timeout=Rwlock.FOREVER)
+status = 0 if rwlock2_1.status == Rwlock.DEADLOCK else 1
+client.unlock(rwlock2_2) # unblock client1 from lock
+sys.exit(status)
+'''
+        client2 = subprocess.Popen(['python3', '-c', client2_command,
+                                    self.path])
+        time.sleep(1)
+        rwlock1_2 = client1.lock('N-DL2', Rwlock.READ, timeout=2)
+        self.assertEqual(rwlock1_2.status, Rwlock.OK)
+        client1.unlock(rwlock1_1)
+        client1.unlock(rwlock1_2)
+        self.assertEqual(client2.wait(), 0)
+
+    def test_gc(self):
+        """test gc by lock then exit without unlock"""
+        client1_command = '''\
+from redisrwlock import Rwlock, RwlockClient, LocalBackend
+import sys
+client = RwlockClient(backend=LocalBackend(sys.argv[1]))
+client.lock('N-GC1', Rwlock.READ)
+client.lock('N-GC2', Rwlock.WRITE)
+'''
+        client1 = subprocess.Popen(['python3', '-c', client1_command,
+                                    self.path])
+        client1.wait()
+        client2 = self.client()
+        rwlock2 = client2.lock('N-GC1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.FAIL)
+        self.assertEqual(client2.gc(), (2, 0, 1))
+        rwlock2 = client2.lock('N-GC1', Rwlock.WRITE)
+        self.assertEqual(rwlock2.status, Rwlock.OK)
+        client2.unlock(rwlock2)
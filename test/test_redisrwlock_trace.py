@@ -0,0 +1,140 @@
+from redisrwlock import Rwlock, RwlockClient, LocalBackend, Tracer
+from redisrwlock.trace import load, recorded, replay, summary
+
+import unittest
+import io
+import os
+import tempfile
+
+
+def lock(owner, name, mode, t, wait=0.0, status='OK', timeout=0,
+         retry=0.1, names=None, priority=0):
+    return dict(ev='lock', owner=owner, names=names or [name],
+                name=name if status == 'OK' else None, mode=mode,
+                capacity=1, timeout=timeout, retry=retry, t=t, wait=wait,
+                attempts=1, status=status, priority=priority, deadline=None)
+
+
+def unlock(owner, name, mode, t):
+    return dict(ev='unlock', owner=owner, name=name, mode=mode, t=t, ok=True)
+
+
+class TestRedisRwlock_trace(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'locks')
+
+    def tearDown(self):
+        self.assertFalse(LocalBackend(self.path).clear_all())
+        self.tempdir.cleanup()
+
+    def test_trace(self):
+        """test lock, unlock and unlock_all traced as NDJSON"""
+        stream = io.StringIO()
+        tracer = Tracer(stream)
+        client1 = RwlockClient(backend=LocalBackend(self.path),
+                               pid=os.getpid() - 1)
+        client2 = RwlockClient(backend=LocalBackend(self.path),
+                               tracer=tracer)
+        rwlock1 = client1.lock('N1', Rwlock.WRITE)
+        client2.lock('N1', Rwlock.READ)
+        client2.lock('N1', Rwlock.READ, timeout=0.2, retry_interval=0.05)
+        rwlock2 = client2.lock_any(['N1', 'N2'], Rwlock.READ)
+        client2.unlock(rwlock2)
+        client1.unlock(rwlock1)
+        client2.lock('N1', Rwlock.READ)
+        self.assertEqual(client2.unlock_all(), 1)
+        tracer.close()
+        stream.seek(0)
+        events = load(stream)
+        self.assertEqual([event['ev'] for event in events],
+                         ['lock', 'lock', 'lock', 'unlock', 'lock',
+                          'unlock_all'])
+        self.assertEqual([event['status'] for event in events[:3]],
+                         ['FAIL', 'TIMEOUT', 'OK'])
+        self.assertEqual(events[0]['owner'], client2.get_owner())
+        self.assertEqual(events[0]['attempts'], 1)
+        self.assertGreater(events[1]['attempts'], 2)
+        self.assertGreater(events[1]['wait'], 0.2)
+        self.assertEqual((events[2]['names'], events[2]['name']),
+                         (['N1', 'N2'], 'N2'))
+        self.assertTrue(events[3]['ok'])
+        self.assertEqual(events[5]['count'], 1)
+        self.assertEqual([result[0] for result in recorded(events)],
+                         ['FAIL', 'TIMEOUT', 'OK', 'OK'])
+
+    def test_trace_file(self):
+        """test tracer appends to file given by path"""
+        path = os.path.join(self.tempdir.name, 'trace.ndjson')
+        tracer = Tracer(path)
+        client = RwlockClient(backend=LocalBackend(self.path), tracer=tracer)
+        client.unlock(client.lock('N1', Rwlock.WRITE, priority=3))
+        tracer.close()
+        events = load(path)
+        self.assertEqual([event['ev'] for event in events],
+                         ['lock', 'unlock'])
+        self.assertEqual((events[0]['priority'], events[0]['deadline']),
+                         (3, None))
+
+    def test_replay_retry_interval(self):
+        """test wait of lock predicted by retry interval"""
+        # A holds N1 until 0.95 second, B waits from 0.1 second
+        events = [lock('A', 'N1', 'W', 0.0),
+                  lock('B', 'N1', 'W', 0.1, wait=0.9, timeout=10),
+                  unlock('A', 'N1', 'W', 0.95),
+                  unlock('B', 'N1', 'W', 1.2)]
+        results = replay(events)
+        self.assertEqual([status for status, wait, attempts in results],
+                         ['OK', 'OK'])
+        self.assertAlmostEqual(results[1][1], 0.9)
+        self.assertEqual(results[1][2], 10)
+        results = replay(events, retry_interval=0.4)
+        self.assertAlmostEqual(results[1][1], 1.2)
+        self.assertEqual(results[1][2], 4)
+        results = replay(events, timeout=0.5)
+        self.assertEqual(results[1][0], 'TIMEOUT')
+        self.assertEqual(summary(results)['status'],
+                         dict(OK=1, TIMEOUT=1))
+
+    def test_replay_rename(self):
+        """test coarser names make conflicts"""
+        events = [lock('A', 'T:1', 'W', 0.0),
+                  lock('B', 'T:2', 'W', 0.1, timeout=10),
+                  unlock('A', 'T:1', 'W', 1.0),
+                  unlock('B', 'T:2', 'W', 1.0)]
+        self.assertEqual(summary(replay(events))['max'], 0.0)
+        results = replay(events, rename=lambda name: name.split(':')[0])
+        self.assertEqual(results[1][0], 'OK')
+        self.assertAlmostEqual(results[1][1], 1.0)
+
+    def test_replay_priority(self):
+        """test queued waitor of priority blocks later readers"""
+        # A reads N1 until 1.0, B waits to write with priority from 0.1
+        events = [lock('A', 'N1', 'R', 0.0),
+                  lock('B', 'N1', 'W', 0.1, wait=0.9, timeout=10,
+                       priority=5),
+                  lock('C', 'N1', 'R', 0.3, status='FAIL'),
+                  unlock('A', 'N1', 'R', 1.0),
+                  unlock('B', 'N1', 'W', 1.1)]
+        # in order of completion, C fails while B queued
+        self.assertEqual([result[0] for result in replay(events)],
+                         ['OK', 'FAIL', 'OK'])
+        events[1]['priority'] = 0
+        self.assertEqual([result[0] for result in replay(events)],
+                         ['OK', 'OK', 'OK'])
+
+    def test_replay_deadlock(self):
+        """test deadlock simulated, younger one is victim"""
+        # A: N1 --------- N2
+        # B:       N2 --- N1 (victim)
+        events = [lock('A', 'N1', 'W', 0.0),
+                  lock('B', 'N2', 'W', 0.1),
+                  lock('A', 'N2', 'W', 0.2, timeout=-1),
+                  lock('B', 'N1', 'W', 0.3, status='DEADLOCK', timeout=-1),
+                  unlock('B', 'N2', 'W', 0.35)]
+        results = replay(events)
+        self.assertEqual(summary(results)['status'],
+                         dict(OK=3, DEADLOCK=1))
+        self.assertEqual(results[3][0], 'OK')
+        self.assertAlmostEqual(results[3][1], 0.2)